@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic OLX courses, of any size, to benchmark against
+"""
+from __future__ import unicode_literals
+
+import os
+import random
+
+COURSE_XML = """\
+<%namespace file="/course.xml" name="course"/>\\
+<course
+  display_name="${course.display_name()} ${course.suffix()}"
+  url_name="${course.url_name()}"
+  course="${course.course()}"
+  org="${course.org()}">
+%for chapter in chapters:
+  <chapter url_name="${chapter}"/>
+%endfor
+</course>
+"""
+
+# The course.xml partial, as required by olx_partials.xml
+INCLUDE_COURSE_XML = """\
+<%def name="display_name()">Synthetic Course</%def>
+<%def name="course()">synth101</%def>
+<%def name="org()">Synth</%def>
+<%def name="url_name()">${run_name}</%def>
+<%def name="suffix()">${olx_helpers.suffix(run_suffix)}</%def>
+<%def name="start()">${olx_helpers.date(start_date)}</%def>
+<%def name="end()">${olx_helpers.date(end_date)}</%def>
+<%def name="invitation_only()">${u"false" if is_public else u"true"}</%def>
+<%def name="ispublic()">${u"true" if is_public else u"false"}</%def>
+"""
+
+CHAPTER_XML = """\
+<chapter display_name="Chapter {chapter}">
+{sequentials}
+</chapter>
+"""
+
+SEQUENTIAL_XML = """\
+<%inherit file="content.xml"/>\\
+<%def name="section_name()">Section {sequential}</%def>\\
+<%def name="units()">{verticals}</%def>\\
+"""
+
+# The partial every sequential inherits from, creating one vertical
+# holding one HTML block per unit
+INCLUDE_SEQUENTIAL_XML = """\
+<%namespace file='/olx_partials.xml' name='partials' inheritable="True"/>\\
+<%def name='section_name()'/>\\
+<%def name='units()'/>\\
+<%def name='unit_url(unit)'>${filename}_unit_${unit}</%def>\\
+<sequential
+  url_name="${filename}"
+  display_name="${self.section_name()}">
+% for u in range(int(capture(self.units))):
+<% unit = "{:02d}".format(u + 1) %>\\
+<vertical
+  url_name="${self.unit_url(unit)}"
+  display_name="Unit ${unit}">
+<html
+  url_name="${self.unit_url(unit)}"
+  filename="${self.unit_url(unit)}"
+  display_name="${self.section_name()} Unit ${unit}"/>
+</vertical>
+% endfor
+</sequential>
+"""
+
+HTML = """\
+<%include file="content.html"/>
+"""
+
+# The partial every HTML block includes, reading in its Markdown
+INCLUDE_HTML = """\
+${olx_helpers.markdown_file('static/markdown/%s.md' % filename)}
+"""
+
+MARKDOWN = """\
+# {title}
+
+{paragraphs}
+
+```python
+def unit():
+    return "{title}"
+```
+
+| Column | Value |
+| ------ | ----- |
+| Unit   | {title} |
+"""
+
+POLICY_JSON = """\
+<%namespace file="/course.xml" name="course"/>\\
+{
+  "course/${course.url_name()}": {
+    "display_name": "${course.display_name()} ${course.suffix()}",
+    "invitation_only": ${course.invitation_only()},
+    "ispublic": ${course.ispublic()},
+    "start": "${course.start()}",
+    "end": "${course.end()}"
+  }
+}
+"""
+
+GRADING_POLICY_JSON = """\
+{
+  "GRADER": [],
+  "GRADE_CUTOFFS": {
+    "Pass": 0.5
+  }
+}
+"""
+
+ASSETS_JSON = """\
+<%namespace file="/olx_partials.xml" import="asset_policy"/>\\
+{
+% for f in files:
+${asset_policy(u"images/" + f, u"application/octet-stream", True, False)}\\
+${u"" if loop.last else u","}
+% endfor
+}
+"""
+
+WORDS = ("learning is the process of acquiring new or modifying existing "
+         "knowledge behaviors skills values and preferences").split()
+
+
+def generate_course(directory,
+                    chapters=4,
+                    sequentials=4,
+                    verticals=4,
+                    paragraphs=5,
+                    static_files=20,
+                    static_size=64 * 1024,
+                    seed=0):
+    """Write a course template tree into directory, with the given
+    number of chapters, sequentials per chapter, and verticals (each
+    holding an HTML block rendered from Markdown) per sequential, plus
+    static files of static_size bytes each.
+
+    Return the number of files written."""
+    rng = random.Random(seed)
+    files = {}
+
+    def add(filename, content):
+        files[filename] = content
+
+    chapter_names = ['chapter_%02d' % (c + 1) for c in range(chapters)]
+    add('course.xml',
+        '<%! chapters = {!r} %>\\\n'.format(chapter_names) + COURSE_XML)
+    add('include/course.xml', INCLUDE_COURSE_XML)
+    add('include/sequential/content.xml', INCLUDE_SEQUENTIAL_XML)
+    add('include/html/content.html', INCLUDE_HTML)
+
+    for chapter in chapter_names:
+        sequential_names = ['%s_sequential_%02d' % (chapter, s + 1)
+                            for s in range(sequentials)]
+        add('chapter/%s.xml' % chapter,
+            CHAPTER_XML.format(
+                chapter=chapter,
+                sequentials='\n'.join(
+                    '  <sequential url_name="%s"/>' % s
+                    for s in sequential_names)))
+        for sequential in sequential_names:
+            add('sequential/%s.xml' % sequential,
+                SEQUENTIAL_XML.format(sequential=sequential,
+                                      verticals=verticals))
+            for vertical in range(verticals):
+                unit = '%s_unit_%02d' % (sequential, vertical + 1)
+                add('html/%s.html' % unit, HTML)
+                text = '\n\n'.join(
+                    ' '.join(rng.choice(WORDS) for _ in range(60))
+                    for _ in range(paragraphs))
+                add('static/markdown/%s.md' % unit,
+                    MARKDOWN.format(title=unit.replace('_', ' '),
+                                    paragraphs=text))
+
+    add('policies/_base/policy.json', POLICY_JSON)
+    add('policies/_base/grading_policy.json', GRADING_POLICY_JSON)
+    static_names = ['asset_%04d.bin' % i for i in range(static_files)]
+    add('policies/assets.json',
+        '<%! files = {!r} %>\\\n'.format(static_names) + ASSETS_JSON)
+
+    for filename, content in files.items():
+        path = os.path.join(directory, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    image_dir = os.path.join(directory, 'static', 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    for name in static_names:
+        with open(os.path.join(image_dir, name), 'wb') as f:
+            f.write(rng.getrandbits(static_size * 8).to_bytes(
+                static_size, 'little'))
+
+    return len(files) + len(static_names)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Time how long it takes to import the olx command line interface, as
+reported by python -X importtime, and fail if that exceeds a budget
+"""
+from __future__ import print_function, unicode_literals
+
+import re
+import sys
+import json
+
+from argparse import ArgumentParser
+from subprocess import run, PIPE
+
+CLI_MODULE = 'olxutils.cli'
+
+# Modules that the CLI must only import once a subcommand needs them
+HEAVY_MODULES = [
+    'importlib.metadata',
+    'mako',
+    'markdown2',
+    'pygments',
+    'requests',
+    'swiftclient',
+    'tarfile',
+    'xmltodict',
+]
+
+# "import time: <self us> | <cumulative us> | <indented module name>"
+LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def import_times(module):
+    """Import module in a fresh interpreter, and return the import
+    time report, as a list of (self, cumulative, depth, name) tuples,
+    in microseconds. Imports done by the interpreter's startup (by
+    the site module) are left out."""
+    result = run([sys.executable, '-X', 'importtime',
+                  '-c', 'import %s' % module],
+                 stdout=PIPE, stderr=PIPE, universal_newlines=True,
+                 check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if not match:
+            continue
+        own, cumulative, indent, name = match.groups()
+        entries.append((int(own), int(cumulative), len(indent) // 2, name))
+        if name == 'site' and not indent:
+            entries = []
+    return entries
+
+
+def measure(module, repeat=5):
+    """Return the fastest of repeat imports of module: its total time
+    (in seconds), the slowest modules it imported, and which heavy
+    modules it imported."""
+    best = None
+    for _ in range(repeat):
+        entries = import_times(module)
+        # Imports report their time when they finish, so everything
+        # a top-level import pulls in precedes it.
+        total = sum(cumulative for _, cumulative, depth, _ in entries
+                    if depth == 0)
+        if best is None or total < best[0]:
+            best = (total, entries)
+    total, entries = best
+    names = set(name for _, _, _, name in entries)
+    slowest = sorted(entries, reverse=True)[:10]
+    return {
+        'module': module,
+        'time': total / 1e6,
+        'slowest': [{'module': name, 'self': own / 1e6}
+                    for own, _, _, name in slowest],
+        'heavy': sorted(m for m in HEAVY_MODULES
+                        if m in names),
+    }
+
+
+def main(argv=sys.argv[1:]):
+    parser = ArgumentParser(description=("Time how long it takes to "
+                                         "import the olx CLI"))
+    parser.add_argument('-m', '--module', default=CLI_MODULE,
+                        help="The module to import (default: %(default)s)")
+    parser.add_argument('-b', '--budget', type=float, default=50,
+                        metavar='MS',
+                        help=("Fail if the import takes longer than "
+                              "this many milliseconds (default: "
+                              "%(default)s)"))
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Import this many times, and use the fastest")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Also write results to FILE, as JSON")
+    opts = parser.parse_args(argv)
+
+    results = measure(opts.module, opts.repeat)
+    results['budget'] = opts.budget / 1e3
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    print("import %s: %.1fms (budget: %.1fms)" % (opts.module,
+                                                  results['time'] * 1e3,
+                                                  opts.budget))
+    for entry in results['slowest']:
+        print("  %7.1fms  %s" % (entry['self'] * 1e3, entry['module']))
+
+    failed = False
+    if results['heavy']:
+        sys.stderr.write("%s imports %s\n" %
+                         (opts.module, ', '.join(results['heavy'])))
+        # Which is only a problem for the CLI itself
+        failed = opts.module == CLI_MODULE
+    if results['time'] > results['budget']:
+        sys.stderr.write("%s takes longer than %.1fms to import\n" %
+                         (opts.module, opts.budget))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Time the olx-utils pipeline (template discovery, rendering, archiving,
+and uploading) on a synthetic course
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import json
+import shutil
+import platform
+import statistics
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+import requests_mock
+
+from olxutils import __version__
+from olxutils.archive import ArchiveHelper
+from olxutils.cli import CLI
+from olxutils.helpers import markdown_cache
+from olxutils.templates import OLXTemplates
+from olxutils.upload import UploadHelper
+
+from benchmarks.course import generate_course
+
+RUN_NAME = 'synth'
+
+CMS_URL = 'https://cms.example.com'
+
+CONTEXT = {
+    'run_name': RUN_NAME,
+    'start_date': datetime(2020, 1, 1),
+    'end_date': datetime(2020, 12, 31, 23, 59, 59),
+    'run_suffix': None,
+    'is_public': False,
+}
+
+
+def timed(func, repeat, setup=None):
+    """Call func repeat times (calling setup, untimed, before each
+    call), and return the wall-clock time each call took."""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def io_counters():
+    """Return how many bytes this process has read and written so far
+    (including from and to the page cache), or None if we can't
+    tell."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f)
+    except (IOError, OSError):
+        return None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def measured_io(func):
+    """Call func, and return the bytes it read and wrote (or None)."""
+    before = io_counters()
+    func()
+    after = io_counters()
+    if before is None or after is None:
+        return None
+    return {'read': after[0] - before[0],
+            'written': after[1] - before[1]}
+
+
+def make_archive_copy(root_directory, base_name):
+    """Create an archive the way olx-utils used to: by copying all
+    files into a temporary directory first, and archiving that."""
+    tempdir = tempfile.mkdtemp()
+    try:
+        ArchiveHelper(root_directory, base_name).copy_files(tempdir)
+        return shutil.make_archive(base_name, 'gztar',
+                                   root_dir=tempdir,
+                                   base_dir='course')
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def clear_memory_caches():
+    markdown_cache.entries.clear()
+    markdown_cache.files.clear()
+
+
+def run_benchmarks(directory, jobs=1, repeat=3, **course):
+    """Generate a course in directory, and time each step of the
+    pipeline on it. Return the results as a dictionary."""
+    source = os.path.join(directory, 'source')
+    output = os.path.join(directory, 'output')
+    cache = os.path.join(directory, 'cache')
+    os.makedirs(source)
+    files = generate_course(source, **course)
+
+    timings = {}
+    cwd = os.getcwd()
+    os.chdir(source)
+    try:
+        timings['discovery'] = timed(
+            lambda: OLXTemplates(CONTEXT)._find_templates(),
+            repeat)
+
+        def render(cache_dir, output_dir, incremental=False):
+            OLXTemplates(CONTEXT,
+                         cache_dir=cache_dir,
+                         output_dir=output_dir,
+                         incremental=incremental).render(jobs)
+
+        def fresh(*directories):
+            def setup():
+                for d in directories:
+                    shutil.rmtree(d, ignore_errors=True)
+                clear_memory_caches()
+            return setup
+
+        # Nothing cached, either on disk or in memory
+        timings['render_cold'] = timed(
+            lambda: render(cache, output),
+            repeat,
+            fresh(cache, output))
+        # Compiled templates and Markdown cached on disk
+        timings['render_warm'] = timed(
+            lambda: render(cache, output),
+            repeat,
+            fresh(output))
+        # Rendering into an up-to-date output directory (once it has
+        # a manifest)
+        render(cache, output, incremental=True)
+        timings['render_noop'] = timed(
+            lambda: render(cache, output, incremental=True),
+            repeat)
+        CLI().create_symlinks(RUN_NAME, output)
+    finally:
+        os.chdir(cwd)
+
+    base_name = os.path.join(directory, 'archive')
+    archive = base_name + '.tar.gz'
+
+    def make_archive():
+        ArchiveHelper(output, base_name).make_archive()
+
+    def make_archive_copied():
+        make_archive_copy(output, base_name)
+
+    timings['make_archive'] = timed(make_archive, repeat)
+    timings['make_archive_threads'] = timed(
+        lambda: ArchiveHelper(output, base_name,
+                              os.cpu_count() or 1).make_archive(),
+        repeat)
+    timings['make_archive_copy'] = timed(make_archive_copied, repeat)
+    archive_io = {
+        'make_archive': measured_io(make_archive),
+        'make_archive_copy': measured_io(make_archive_copied),
+    }
+
+    helper = UploadHelper(CMS_URL, archive, 'token', 'course-v1:x+y+z')
+    timings['course_id_from_archive'] = timed(
+        helper.course_id_from_archive,
+        repeat)
+
+    def uploaded(request, context):
+        # Read a streamed body, as a server would
+        if not isinstance(request.body, bytes):
+            for _ in request.body:
+                pass
+        return {'task_id': 'task'}
+
+    with requests_mock.Mocker() as m:
+        m.register_uri('POST', helper.upload_url,
+                       json=uploaded)
+        m.register_uri('GET', helper.upload_url,
+                       json={'state': 'Succeeded'})
+        timings['upload'] = timed(lambda: helper.upload(wait=True),
+                                  repeat)
+        # Archiving and uploading in one go, as "olx publish" does
+        timings['publish'] = timed(
+            lambda: helper.upload_stream(
+                ArchiveHelper(output, None).iter_archive(),
+                wait=True),
+            repeat)
+
+    return {
+        'olx_utils': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict(course, jobs=jobs, repeat=repeat),
+        'files': files,
+        'archive_bytes': os.path.getsize(archive),
+        # Bytes read and written while archiving, streaming files
+        # into the archive vs. copying them to a temporary directory
+        # first
+        'archive_io': archive_io,
+        'timings': dict((name, {'min': min(times),
+                                'median': statistics.median(times),
+                                'runs': times})
+                        for name, times in timings.items()),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print how results compare to a baseline, and return the names
+    of the benchmarks that got slower by more than tolerance."""
+    regressions = []
+    if results['parameters'] != baseline['parameters']:
+        sys.stderr.write("Warning: the baseline was measured with "
+                         "different parameters: %s\n" %
+                         baseline['parameters'])
+    print("%-24s %10s %10s %8s" % ('benchmark', 'baseline', 'current',
+                                   'ratio'))
+    for name, timing in sorted(results['timings'].items()):
+        previous = baseline['timings'].get(name)
+        if not previous:
+            continue
+        # Compare the fastest runs, which are the least noisy
+        ratio = timing['min'] / previous['min']
+        print("%-24s %9.4fs %9.4fs %7.2fx" % (name, previous['min'],
+                                              timing['min'], ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=sys.argv[1:]):
+    parser = ArgumentParser(description=("Time the olx-utils pipeline "
+                                         "on a synthetic course"))
+    parser.add_argument('--chapters', type=int, default=4)
+    parser.add_argument('--sequentials', type=int, default=4,
+                        help="Sequentials per chapter")
+    parser.add_argument('--verticals', type=int, default=4,
+                        help="Verticals (HTML blocks) per sequential")
+    parser.add_argument('--paragraphs', type=int, default=5,
+                        help="Markdown paragraphs per HTML block")
+    parser.add_argument('--static-files', type=int, default=20)
+    parser.add_argument('--static-size', type=int, default=64 * 1024,
+                        help="Size of each static file, in bytes")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Render in this many processes")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Time each step this many times")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Write results to FILE (default: stdout)")
+    parser.add_argument('--compare', metavar='FILE',
+                        help=("Compare results to those in FILE, and "
+                              "fail if any step got slower"))
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help=("With --compare, how much slower (as a "
+                              "fraction) a step may get"))
+    opts = vars(parser.parse_args(argv))
+
+    output = opts.pop('output')
+    baseline = opts.pop('compare')
+    tolerance = opts.pop('tolerance')
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(directory, **opts)
+    finally:
+        shutil.rmtree(directory)
+
+    data = json.dumps(results, indent=1, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(data + '\n')
+    elif not baseline:
+        print(data)
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            sys.stderr.write("Slower than baseline: %s\n" %
+                             ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
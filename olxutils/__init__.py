@@ -1,8 +1,19 @@
-from importlib import metadata
 # __version__ attribute as suggested by (deferred) PEP 396:
 # https://www.python.org/dev/peps/pep-0396/
 #
 # Single-source package definition as suggested (among several
 # options) by:
 # https://packaging.python.org/guides/single-sourcing-package-version/
-__version__ = metadata.version('olx-utils')
+#
+# Looking up the version (and importing importlib.metadata to do so)
+# takes a while, so we only do it once someone asks for it (PEP 562).
+
+
+def __getattr__(name):
+    if name == '__version__':
+        from importlib import metadata
+        global __version__
+        __version__ = metadata.version('olx-utils')
+        return __version__
+    raise AttributeError("module %r has no attribute %r" % (__name__,
+                                                            name))
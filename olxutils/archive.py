@@ -2,82 +2,665 @@
 from __future__ import unicode_literals
 
 import os
+import gzip
+import hashlib
+import json
 import logging
+import queue
 import shutil
+import stat
+import tarfile
 import tempfile
+import threading
+import time
+
+from olxutils import __version__
+from olxutils.compress import ParallelGzipWriter
+from olxutils.git import GitTree
+from olxutils.references import ReferenceIndex
 
 
 class ArchiveHelper(object):
     """Helper class to facilitate the creation of course archives to be
     imported into Open edX Studio."""
 
-    def __init__(self, root_directory, base_name):
+    # We currently don't functionally distinguish between files
+    # and directories that are essential, and those that are
+    # (probably?) not.
+    DIRECTORIES = [
+        # apparently essential:
+        'about',
+        'chapter',
+        'html',
+        'info',
+        'policies',
+        'sequential',
+        'static',
+        # apparently not essential:
+        'assets',
+        'conditional',
+        'course',
+        'drafts',
+        'library_content',
+        'markdown',
+        'problem',
+        'split_test',
+        'tabs',
+        'vertical',
+        'video',
+    ]
+
+    FILES = [
+        # apparently essential:
+        'course.xml',
+    ]
+
+    # All archive members go into this directory.
+    PREFIX = 'course'
+
+    # Read course files, and write the archive, in chunks of this size
+    BUFSIZE = 1024 * 1024
+
+    # Kinds of archive members, by tar type
+    KINDS = {
+        tarfile.DIRTYPE: 'directory',
+        tarfile.SYMTYPE: 'symlink',
+    }
+
+    def __init__(self, root_directory, base_name, compress_threads=1,
+                 compression_level=9, reproducible=False, cache_dir=None,
+                 prune_unreferenced=False, ref=None):
         # The only format currently supported by Open edX Studio is
-        # gztar, i.e. a gzip-compressed tarball. If that ever changes,
-        # we can easily support others (via shutil.make_archive()).
+        # gztar, i.e. a gzip-compressed tarball.
         self.base_name = base_name
         self.root_directory = root_directory
         self.format = 'gztar'
+        # With more than one thread, compress blocks of the archive
+        # in parallel (see ParallelGzipWriter)
+        self.compress_threads = compress_threads
+        self.compression_level = compression_level
+        # A reproducible archive only depends on the content of the
+        # course, and on the settings it was created with, so it can
+        # be cached.
+        self.reproducible = reproducible
+        if reproducible and cache_dir:
+            self.cache = ArchiveCache(os.path.join(cache_dir, 'archives'))
+        else:
+            self.cache = None
+        # Leave out the files that the course doesn't refer to (see
+        # ReferenceIndex), and record how many there were, and how
+        # many bytes they took up.
+        self.prune_unreferenced = prune_unreferenced
+        self.pruned_files = 0
+        self.pruned_bytes = 0
+        # With a git ref, read the course from that commit in the
+        # repository in root_directory, rather than from the working
+        # tree.
+        self.tree = ref and GitTree(ref, root_directory)
         logging.info("Creating %s archive from %s" % (self.format,
                                                       self.root_directory))
 
     def copy_files(self, destdir):
-        # We currently don't functionally distinguish between files
-        # and directories that are essential, and those that are
-        # (probably?) not.
-        directories = [
-            # apparently essential:
-            'about',
-            'chapter',
-            'html',
-            'info',
-            'policies',
-            'sequential',
-            'static',
-            # apparently not essential:
-            'assets',
-            'conditional',
-            'course',
-            'drafts',
-            'library_content',
-            'markdown',
-            'problem',
-            'split_test',
-            'tabs',
-            'vertical',
-            'video',
-        ]
-        files = [
-            # apparently essential:
-            'course.xml',
-        ]
-        for d in directories:
-            source = os.path.join(self.root_directory, d)
-            if os.path.exists(source):
-                logging.debug("Adding directory %s" % source)
-                dest = os.path.join(destdir, 'course', d)
+        """Copy the files that go into the archive into destdir."""
+        for source, arcname in self.members():
+            dest = os.path.join(destdir, arcname)
+            if os.path.isdir(source) and not os.path.islink(source):
                 shutil.copytree(source, dest,
                                 symlinks=True)
             else:
-                logging.debug("Skipping directory %s (not found)" % source)
-        for f in files:
-            source = os.path.join(self.root_directory, f)
-            if os.path.exists(source):
-                logging.debug("Adding file %s" % source)
-                dest = os.path.join(destdir, 'course', f)
                 shutil.copy2(source, dest)
+
+    def members(self):
+        """Return the (path, name in the archive) of each allowlisted
+        directory and file that exists in the root directory."""
+        members = []
+        for name in self.DIRECTORIES + self.FILES:
+            if self.tree:
+                # The path in the git tree
+                source = name
+            else:
+                source = os.path.join(self.root_directory, name)
+            if self._exists(source):
+                logging.debug("Adding %s" % source)
+                members.append((source,
+                                '%s/%s' % (self.PREFIX, name)))
             else:
-                logging.debug("Skipping file %s (not found)" % source)
-
-    def make_archive(self):
-        # When dropping Python 2 support, this should be turned into
-        # using TemporaryFile as a content manager.
-        tempdir = tempfile.mkdtemp()
-        self.copy_files(destdir=tempdir)
-        filename = shutil.make_archive(self.base_name,
-                                       self.format,
-                                       root_dir=tempdir,
-                                       base_dir='course')
+                logging.debug("Skipping %s (not found)" % source)
+        return members
+
+    def entries(self):
+        """Return the (path, name in the archive) of everything that goes
+        into the archive, in order, with each directory's contents
+        sorted by name.
+
+        Allowlisted directories and files that are symlinks are
+        replaced by what they link to, as if they had been copied;
+        symlinks below them are archived as such.
+
+        With a git ref, paths are relative to the root of the git
+        tree, and allowlisted symlinks are archived as such, too.
+
+        With prune_unreferenced, leave out files that the course
+        doesn't refer to, and directories that are left empty."""
+        if self.tree:
+            entries = [('', self.PREFIX)]
+            for source, arcname in self.members():
+                entries.extend(self._walk_tree(source, arcname))
+        else:
+            entries = [(os.path.realpath(self.root_directory),
+                        self.PREFIX)]
+            for source, arcname in self.members():
+                entries.extend(self._walk(os.path.realpath(source),
+                                          arcname))
+        if self.prune_unreferenced:
+            entries = self._prune(entries)
+        return entries
+
+    def settings(self):
+        """Return everything besides the course content that goes into
+        a reproducible archive."""
+        return {
+            'version': __version__,
+            'compression_level': self.compression_level,
+            'blocksize': (ParallelGzipWriter.BLOCKSIZE
+                          if self.compress_threads > 1 else None),
+            'mtime': self.mtime(),
+        }
+
+    @staticmethod
+    def mtime():
+        """Return the timestamp of all members of a reproducible archive:
+        $SOURCE_DATE_EPOCH if set, and otherwise zero."""
+        return int(os.getenv('SOURCE_DATE_EPOCH') or 0)
+
+    def make_archive(self, report=None):
+        """Write the archive, reading course files straight from the
+        root directory, and return its filename.
+
+        If the archive is reproducible, and an archive of the same
+        content and settings is in the cache, use that instead (unless
+        a report is to be made; see write_archive)."""
+        filename = os.path.abspath(self.base_name + '.tar.gz')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        try:
+            entries = self.entries()
+            if self.cache:
+                key = self.cache.key(entries, self.settings(), self.tree)
+                if report is None and self.cache.get(key, filename):
+                    logging.info("Reused cached archive: %s" % filename)
+                    return filename
+
+            # Write a new file, rather than into filename, which may be
+            # a link to a cached archive.
+            tmp = filename + '.tmp'
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            try:
+                with open(tmp, 'xb', buffering=self.BUFSIZE) as f:
+                    self.write_archive(f, entries, report)
+                os.replace(tmp, filename)
+            except:  # noqa: E722
+                os.unlink(tmp)
+                raise
+        finally:
+            # Stop the git process reading blobs, which pruning may
+            # have started even if the archive came from the cache
+            if self.tree:
+                self.tree.close()
+        if self.cache:
+            self.cache.put(key, filename)
         logging.info("Created archive: %s" % filename)
-        shutil.rmtree(tempdir)
         return filename
+
+    def write_archive(self, fileobj, entries=None, report=None):
+        """Write the archive into fileobj, recording what went into it
+        in report (an ArchiveReport), if given."""
+        if entries is None:
+            entries = self.entries()
+        if report is not None:
+            fileobj = _CountingWriter(fileobj)
+        mtime = self.mtime() if self.reproducible else None
+        if self.compress_threads > 1:
+            gz = ParallelGzipWriter(fileobj,
+                                    self.compression_level,
+                                    self.compress_threads,
+                                    mtime=mtime)
+        else:
+            # Without a filename in the gzip header, which would
+            # differ from one archive to the next
+            gz = gzip.GzipFile(filename='',
+                               mode='wb',
+                               compresslevel=self.compression_level,
+                               fileobj=fileobj,
+                               mtime=mtime)
+        if report is not None:
+            gz = _MeteredWriter(gz, fileobj, report)
+        with gz, tarfile.open(None,
+                              'w|',
+                              fileobj=gz,
+                              bufsize=self.BUFSIZE,
+                              copybufsize=self.BUFSIZE) as tf:
+            for path, arcname in entries:
+                if self.tree:
+                    self._add_blob(tf, path, arcname, report)
+                else:
+                    self._add(tf, path, arcname, report)
+
+    def iter_archive(self):
+        """Generate the archive as a series of chunks of bytes, without
+        writing it to disk.
+
+        The archive is created in another thread, while the caller
+        consumes the chunks."""
+        writer = _QueueWriter(self.BUFSIZE)
+
+        def produce():
+            try:
+                self.write_archive(writer)
+                writer.close()
+            except BaseException as e:
+                writer.fail(e)
+            finally:
+                if self.tree:
+                    self.tree.close()
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            for chunk in writer.chunks():
+                yield chunk
+        finally:
+            # If the caller stopped early, make the producer give up.
+            writer.cancel()
+            thread.join()
+
+    def _prune(self, entries):
+        prefix = self.PREFIX + '/'
+        files = {}
+        for path, arcname in entries[1:]:
+            if self._islink(path) or not self._isdir(path):
+                files[arcname[len(prefix):]] = path
+        roots = [name for name in files
+                 if name.split('/', 1)[0] not in ReferenceIndex.PRUNED]
+        index = ReferenceIndex(self.root_directory, roots, self.tree)
+
+        # Keep the directories (or symlinks to them) holding anything
+        # referenced
+        parents = set()
+        for name in index.referenced:
+            while '/' in name:
+                name = name.rsplit('/', 1)[0]
+                parents.add(name)
+
+        kept = [entries[0]]
+        self.pruned_files = self.pruned_bytes = 0
+        for path, arcname in entries[1:]:
+            name = arcname[len(prefix):]
+            if name in parents or (name in files and name in index):
+                kept.append((path, arcname))
+            elif name in files:
+                logging.debug("Pruning %s (unreferenced)" % path)
+                self.pruned_files += 1
+                self.pruned_bytes += self._size(path)
+        logging.info("Pruned %d unreferenced files (%d bytes)" %
+                     (self.pruned_files, self.pruned_bytes))
+        return kept
+
+    def _walk(self, path, arcname):
+        yield path, arcname
+        if os.path.isdir(path) and not os.path.islink(path):
+            for name in sorted(os.listdir(path)):
+                yield from self._walk(os.path.join(path, name),
+                                      '%s/%s' % (arcname, name))
+
+    def _walk_tree(self, path, arcname):
+        yield path, arcname
+        if self.tree.isdir(path):
+            for name in self.tree.listdir(path):
+                yield from self._walk_tree('%s/%s' % (path, name),
+                                           '%s/%s' % (arcname, name))
+
+    def _exists(self, path):
+        if self.tree:
+            return self.tree.exists(path)
+        return os.path.exists(path)
+
+    def _isdir(self, path):
+        if self.tree:
+            return self.tree.isdir(path)
+        return os.path.isdir(path)
+
+    def _islink(self, path):
+        if self.tree:
+            return self.tree.islink(path)
+        return os.path.islink(path)
+
+    def _size(self, path):
+        if self.tree:
+            return self.tree.size(path)
+        return os.lstat(path).st_size
+
+    def _add_blob(self, tf, path, arcname, report=None):
+        # Git only records whether a file is executable, so archive
+        # members from a git tree always look normalized (but for
+        # their mtime, which is that of the commit).
+        tarinfo = tarfile.TarInfo(arcname)
+        if self.tree.isdir(path):
+            tarinfo.type = tarfile.DIRTYPE
+        elif self.tree.islink(path):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = self.tree.readlink(path)
+        else:
+            tarinfo.size = self.tree.size(path)
+            if self.tree.mode(path) & 0o111:
+                tarinfo.mode = 0o755
+        normalize(tarinfo,
+                  self.mtime() if self.reproducible else self.tree.mtime)
+        if tarinfo.isreg():
+            size, stream = self.tree.open(path)
+            self._addfile(tf, tarinfo, stream, report)
+            # The newline after the blob
+            stream.read(1)
+        else:
+            self._addfile(tf, tarinfo, None, report)
+
+    def _add(self, tf, path, arcname, report=None):
+        # Archive files with several hard links as regular files, as
+        # copying them would.
+        tf.inodes.clear()
+        tarinfo = tf.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # A socket, say
+            logging.debug("Skipping %s (not a file)" % path)
+            return
+        if self.reproducible:
+            normalize(tarinfo, self.mtime())
+        if tarinfo.isreg():
+            with open(path, 'rb') as f:
+                self._addfile(tf, tarinfo, f, report)
+        else:
+            self._addfile(tf, tarinfo, None, report)
+
+    def _addfile(self, tf, tarinfo, fileobj, report):
+        if report is None:
+            tf.addfile(tarinfo, fileobj)
+            return
+        reader = fileobj and report.reader(fileobj)
+        tf.addfile(tarinfo, reader)
+        report.add_member(tarinfo.name,
+                          self.KINDS.get(tarinfo.type, 'file'),
+                          tarinfo.size,
+                          reader)
+
+
+class _CountingWriter(object):
+    """A file object counting the bytes written through it to
+    another."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class _MeteredWriter(object):
+    """A file object timing the writes to a compressor, and recording
+    how much went into it, and came out of it (into a
+    _CountingWriter), in an ArchiveReport."""
+
+    def __init__(self, compressor, output, report):
+        self.compressor = compressor
+        self.output = output
+        self.archive = report.archive
+
+    def write(self, data):
+        start = time.monotonic()
+        self.compressor.write(data)
+        self.archive['compress'] += time.monotonic() - start
+        self.archive['bytes'] += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        start = time.monotonic()
+        self.compressor.close()
+        self.archive['compress'] += time.monotonic() - start
+        self.archive['compressed'] = self.output.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _QueueWriter(object):
+    """A file object handing what is written to it, in chunks of at
+    least bufsize bytes, to a consumer in another thread."""
+
+    # How many chunks may wait to be consumed
+    BACKLOG = 4
+
+    def __init__(self, bufsize):
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+        self.queue = queue.Queue(self.BACKLOG)
+        self.cancelled = threading.Event()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.bufsize:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._put(None)
+
+    def fail(self, exception):
+        """Make the consumer raise exception."""
+        try:
+            self._put(exception)
+        except IOError:
+            pass
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def chunks(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+
+    def _put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("Archive consumer went away")
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def normalize(tarinfo, mtime):
+    """Strip an archive member of everything that depends on when and by
+    whom its file was created, rather than on its content."""
+    tarinfo.mtime = mtime
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    if tarinfo.issym():
+        tarinfo.mode = 0o777
+    elif tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+    return tarinfo
+
+
+class ArchiveCache(object):
+    """
+    Cache of reproducible archives, keyed by a digest of everything
+    that goes into them.
+
+    Digesting a course means reading all of its files, unless they
+    have the same size and mtime as when they were last digested.
+
+    """
+    # How many archives to keep
+    SIZE = 8
+
+    # Digests of files, by path, along with their size and mtime, and
+    # when they were last used
+    FILES = 'files.json'
+
+    # Forget the digests of files that weren't archived for this long,
+    # in seconds, and the least recently used beyond this many files
+    FILES_AGE = 30 * 24 * 3600
+    FILES_SIZE = 100000
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, entries, settings, tree=None):
+        """Return the key of the archive of entries (see
+        ArchiveHelper.entries) with settings.
+
+        Entries from a GitTree are keyed by their git object names,
+        without reading them."""
+        digest = hashlib.sha256(
+            json.dumps(settings, sort_keys=True).encode('utf-8'))
+        if tree:
+            for path, arcname in entries:
+                digest.update(('%s\0%o\0%s\n' % (
+                    arcname,
+                    tree.mode(path),
+                    tree.sha(path))).encode('utf-8', 'surrogateescape'))
+            return digest.hexdigest()
+
+        files = self._load()
+        now = time.time()
+        for path, arcname in entries:
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                content = self._digest(files, path, st, now)
+            elif stat.S_ISLNK(st.st_mode):
+                content = os.readlink(path)
+            elif stat.S_ISDIR(st.st_mode):
+                content = ''
+            else:
+                continue
+            # Whether a file is executable is all that's left of its
+            # mode once normalized.
+            digest.update(('%s\0%o\0%d\0%s\n' % (
+                arcname,
+                stat.S_IFMT(st.st_mode),
+                bool(st.st_mode & 0o111),
+                content)).encode('utf-8', 'surrogateescape'))
+        self._save(files, now)
+        return digest.hexdigest()
+
+    def get(self, key, filename):
+        """Copy the cached archive with key to filename, and return
+        True, if there is one.
+
+        The archive is copied, not linked, so that nothing written to
+        filename later can change the cached archive."""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return False
+        tmp = filename + '.tmp'
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, filename)
+        except:  # noqa: E722
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return True
+
+    def put(self, key, filename):
+        """Add the archive in filename to the cache, under key."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp)
+            os.replace(tmp, self._path(key))
+        except:  # noqa: E722
+            os.unlink(tmp)
+            raise
+        self._prune()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.tar.gz')
+
+    def _digest(self, files, path, st, now):
+        previous = files.get(path)
+        if previous and previous[:2] == [st.st_size, st.st_mtime_ns]:
+            files[path] = previous[:3] + [now]
+            return previous[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ArchiveHelper.BUFSIZE), b''):
+                digest.update(chunk)
+        files[path] = [st.st_size, st.st_mtime_ns, digest.hexdigest(), now]
+        return files[path][2]
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.directory, self.FILES)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, files, now):
+        # Files of courses archived long ago, or files that are gone,
+        # would otherwise be remembered forever.
+        used = sorted(((entry[3] if len(entry) > 3 else 0, path)
+                       for path, entry in files.items()),
+                      reverse=True)
+        for last_used, path in used[self.FILES_SIZE:]:
+            del files[path]
+        for last_used, path in used[:self.FILES_SIZE]:
+            if last_used < now - self.FILES_AGE:
+                del files[path]
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with open(fd, 'w') as f:
+            json.dump(files, f)
+        os.replace(tmp, os.path.join(self.directory, self.FILES))
+
+    def _prune(self):
+        """Remove all but the SIZE most recently used archives."""
+        archives = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tar.gz'):
+                archives.append((entry.stat().st_mtime, entry.path))
+        for _, path in sorted(archives, reverse=True)[self.SIZE:]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
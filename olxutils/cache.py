@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import logging
+import time
+
+
+def default_cache_dir():
+    """Return the directory in which olx-utils keeps its caches.
+
+    That is $OLX_CACHE_DIR if set, and otherwise an "olx-utils"
+    directory in the user's cache directory, as defined by the XDG
+    Base Directory Specification."""
+    cache_dir = os.getenv('OLX_CACHE_DIR')
+    if cache_dir:
+        return cache_dir
+    base = (os.getenv('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'olx-utils')
+
+
+# Don't look for files to prune in a cache directory more often than
+# this, in seconds
+PRUNE_INTERVAL = 3600
+
+# Marks when a cache directory was last pruned
+PRUNED = '.pruned'
+
+
+def mark_used(path):
+    """Record that the cached file at path was used just now, for
+    prune_cache(), without changing its mtime (by which Python tells
+    whether a module's bytecode is up to date, say)."""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def prune_cache(directory, max_bytes, max_age):
+    """Remove the files in directory (and its subdirectories) that
+    went unused (see mark_used) or unmodified for more than max_age
+    seconds, and then the least recently used of the rest, until they
+    take up no more than max_bytes.
+
+    Do nothing if that happened less than PRUNE_INTERVAL seconds ago,
+    so that it may be called after every render."""
+    stamp = os.path.join(directory, PRUNED)
+    now = time.time()
+    try:
+        if os.stat(stamp).st_mtime > now - PRUNE_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        with open(stamp, 'w'):
+            pass
+    except OSError:
+        # No cache directory (yet)
+        return
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path == stamp:
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+
+    # Keep the most recently used files that fit
+    total = 0
+    removed = 0
+    for used, size, path in sorted(files, reverse=True):
+        if used >= now - max_age and total + size <= max_bytes:
+            total += size
+            continue
+        try:
+            os.unlink(path)
+            removed += 1
+        except OSError:
+            pass
+    if removed:
+        logging.info("Pruned %d files from %s" % (removed, directory))
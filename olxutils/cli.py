@@ -9,20 +9,21 @@ import sys
 
 import os
 
+import csv
+
 import warnings
 
 import logging
 
-from argparse import ArgumentParser, ArgumentTypeError
+from argparse import Action, ArgumentParser, ArgumentTypeError, SUPPRESS
 
 from datetime import datetime
 
-from olxutils import __version__
-from olxutils.templates import OLXTemplates, OLXTemplateException
-from olxutils.git import GitHelper, GitHelperException
-from olxutils.archive import ArchiveHelper
-from olxutils.token import TokenHelper
-from olxutils.upload import UploadHelper
+from olxutils.cache import default_cache_dir
+
+# Each subcommand imports the modules it needs (and thus Mako,
+# markdown2, requests, etc.) only when it runs, so that "olx
+# --version", "olx status", and the like start up quickly.
 
 # Under which name do we expect the CLI to be generally called?
 CANONICAL_COMMAND_NAME = 'olx'
@@ -32,6 +33,25 @@ class CLIException(Exception):
     pass
 
 
+class VersionAction(Action):
+    """Like argparse's "version" action, but only looks up our version
+    when asked to show it."""
+
+    def __init__(self, option_strings, dest=SUPPRESS, default=SUPPRESS,
+                 help=None):
+        super(VersionAction, self).__init__(option_strings=option_strings,
+                                            dest=dest,
+                                            default=default,
+                                            nargs=0,
+                                            help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from olxutils import __version__
+
+        print('%s %s' % (parser.prog, __version__))
+        parser.exit()
+
+
 class CLI(object):
 
     def __init__(self):
@@ -42,14 +62,156 @@ class CLI(object):
                 msg = "Not a valid date: '{0}'.".format(s)
                 raise ArgumentTypeError(msg)
 
+        def positive_int(s):
+            try:
+                value = int(s)
+            except ValueError:
+                value = 0
+            if value < 1:
+                msg = "Not a positive integer: '{0}'.".format(s)
+                raise ArgumentTypeError(msg)
+            return value
+
+        def compression_level(s):
+            try:
+                value = int(s)
+            except ValueError:
+                value = -1
+            if not 0 <= value <= 9:
+                msg = "Not a compression level (0-9): '{0}'.".format(s)
+                raise ArgumentTypeError(msg)
+            return value
+
+        def positive_float(s):
+            try:
+                value = float(s)
+            except ValueError:
+                value = 0
+            if not value > 0:
+                msg = "Not a positive number: '{0}'.".format(s)
+                raise ArgumentTypeError(msg)
+            return value
+
+        def non_negative_float(s):
+            try:
+                value = float(s)
+            except ValueError:
+                value = -1
+            if not value >= 0:
+                msg = "Not a non-negative number: '{0}'.".format(s)
+                raise ArgumentTypeError(msg)
+            return value
+
+        def add_progress_arguments(p):
+            p.add_argument('--progress-interval',
+                           type=non_negative_float,
+                           default=10,
+                           metavar='SECONDS',
+                           help=("Report upload progress and "
+                                 "throughput on stderr every SECONDS, "
+                                 "or never if 0 or with -q (default: "
+                                 "%(default)s)"))
+
+        def add_http_arguments(p):
+            # Defaults are HTTPClient's, which we don't import here,
+            # so as not to import requests unless we need it.
+            p.add_argument('--connect-timeout',
+                           type=positive_float,
+                           metavar='SECONDS',
+                           help=("How long to wait for a connection "
+                                 "(default: 10)"))
+            p.add_argument('--read-timeout',
+                           type=positive_float,
+                           metavar='SECONDS',
+                           help=("How long to wait for a response "
+                                 "(default: 300)"))
+
+        def add_wait_arguments(p):
+            # Defaults are UploadHelper's, which we don't import here.
+            p.add_argument('--timeout',
+                           type=positive_float,
+                           metavar='SECONDS',
+                           help=("With --wait, give up if the import "
+                                 "hasn't completed after SECONDS "
+                                 "(default: wait forever)"))
+            p.add_argument('--poll-interval',
+                           type=positive_float,
+                           metavar='SECONDS',
+                           help=("With --wait, check on the import "
+                                 "after SECONDS, and then at "
+                                 "increasing intervals (default: 1)"))
+            p.add_argument('--poll-max-interval',
+                           type=positive_float,
+                           metavar='SECONDS',
+                           help=("With --wait, check on the import at "
+                                 "least every SECONDS (default: 30)"))
+
+        def add_render_arguments(p, watch=False):
+            p.add_argument('-j', "--jobs",
+                           type=positive_int,
+                           metavar='N',
+                           help=("Render templates in N parallel "
+                                 "processes (default: number "
+                                 "of CPUs)"))
+            p.add_argument('-x', "--ignore",
+                           action="append",
+                           metavar='PATTERN',
+                           help=("Don't look for templates in "
+                                 "files or directories matching "
+                                 "PATTERN (relative to the course "
+                                 "root; may be repeated)"))
+            if not watch:
+                p.add_argument("--force",
+                               action="store_true",
+                               help=("With --output-dir, render all "
+                                     "templates, even those that "
+                                     "haven't changed since the "
+                                     "previous run"))
+            p.add_argument("--cache-dir",
+                           metavar='DIR',
+                           help=("Cache compiled templates in DIR "
+                                 "(default: $OLX_CACHE_DIR, or "
+                                 "~/.cache/olx-utils)"))
+            p.add_argument("--no-cache",
+                           action="store_true",
+                           help="Don't cache compiled templates")
+            if not watch:
+                p.add_argument("--profile",
+                               metavar='FILE',
+                               help=("Write a JSON report of where the "
+                                     "time went while rendering to "
+                                     "FILE, and print a summary of the "
+                                     "slowest templates and helpers"))
+
+        def add_archive_arguments(p):
+            p.add_argument('--compress-threads',
+                           type=positive_int,
+                           default=1,
+                           metavar='N',
+                           help=("Compress the archive in N parallel "
+                                 "threads (default: %(default)s)"))
+            p.add_argument('--compression-level',
+                           type=compression_level,
+                           default=9,
+                           metavar='LEVEL',
+                           help=("The gzip compression level, from 0 "
+                                 "(fastest) to 9 (smallest; the "
+                                 "default)"))
+            p.add_argument('--reproducible',
+                           action='store_true',
+                           help=("Create the same archive from the "
+                                 "same course every time, with "
+                                 "members sorted by name, and "
+                                 "without timestamps (other than "
+                                 "$SOURCE_DATE_EPOCH) or ownership"))
+
         parser = ArgumentParser(prog=CANONICAL_COMMAND_NAME,
                                 description="Open Learning XML (OLX) utility")
 
         subparsers = parser.add_subparsers(dest='subcommand')
         parser.add_argument('-V', '--version',
-                            action='version',
-                            help="show version",
-                            version='%(prog)s ' + __version__)
+                            action=VersionAction,
+                            help="show version")
         parser.add_argument('-v', '--verbose',
                             action='count',
                             dest='verbosity',
@@ -78,6 +240,13 @@ class CLI(object):
                                help="Make the course run public")
         nr_parser.add_argument('-s', "--suffix",
                                help="The run name suffix")
+        nr_parser.add_argument('-o', "--output-dir",
+                               metavar='DIR',
+                               help=("Render into DIR, rather than "
+                                     "overwriting templates in place. "
+                                     "Only files that change are "
+                                     "written."))
+        add_render_arguments(nr_parser)
         nr_parser.add_argument("name",
                                help="The run identifier")
         nr_parser.add_argument("start_date",
@@ -89,6 +258,82 @@ class CLI(object):
                                help="When the course run ends "
                                "(YYYY-MM-DD)")
 
+        nrs_help = 'Render several course runs listed in a schedule file'
+        nrs_epilog = ('The schedule is a CSV file with a header row, '
+                      'and one row per course run. The "name", '
+                      '"start_date", and "end_date" columns are '
+                      'required; "suffix" and "public" (true or false) '
+                      'are optional.')
+        nrs_parser = subparsers.add_parser('new-runs',
+                                           help=nrs_help,
+                                           epilog=nrs_epilog)
+        nrs_parser.add_argument('-o', "--output-dir",
+                                metavar='DIR',
+                                default='runs',
+                                help=("Render each run into its own "
+                                      "directory, DIR/NAME "
+                                      "(default: runs)"))
+        add_render_arguments(nrs_parser)
+        nrs_parser.add_argument("schedule",
+                                help="The schedule file")
+
+        w_help = ('Render a course run into a preview directory, and '
+                  're-render it whenever the source tree changes')
+        w_parser = subparsers.add_parser('watch',
+                                         help=w_help)
+        w_parser.add_argument('-p', "--public",
+                              action="store_true",
+                              help="Make the course run public")
+        w_parser.add_argument('-s', "--suffix",
+                              help="The run name suffix")
+        w_parser.add_argument('-o', "--output-dir",
+                              metavar='DIR',
+                              default='preview',
+                              help=("Render into DIR "
+                                    "(default: preview)"))
+        add_render_arguments(w_parser, watch=True)
+        w_parser.add_argument("name",
+                              help="The run identifier")
+        w_parser.add_argument("start_date",
+                              type=valid_date,
+                              help="When the course run starts "
+                              "(YYYY-MM-DD)")
+        w_parser.add_argument("end_date",
+                              type=valid_date,
+                              help="When the course run ends "
+                              "(YYYY-MM-DD)")
+
+        sv_help = ('Run a daemon that renders and archives courses, '
+                   'as requested via a local HTTP API')
+        sv_parser = subparsers.add_parser('serve',
+                                          help=sv_help)
+        sv_parser.add_argument('--socket',
+                               dest='socket_path',
+                               metavar='PATH',
+                               help=("Listen on a Unix socket at PATH "
+                                     "(default: $XDG_RUNTIME_DIR/olx.sock, "
+                                     "or olx.sock in the cache "
+                                     "directory)"))
+        sv_parser.add_argument('--port',
+                               type=positive_int,
+                               help=("Listen on this port on localhost "
+                                     "instead (8470, say), requiring "
+                                     "the token in the token file"))
+        sv_parser.add_argument('--token-file',
+                               metavar='PATH',
+                               help=("With --port, write the token "
+                                     "that clients must send to PATH "
+                                     "(default: serve.token in the "
+                                     "cache directory)"))
+        sv_parser.add_argument("--cache-dir",
+                               metavar='DIR',
+                               help=("Cache compiled templates in DIR "
+                                     "(default: $OLX_CACHE_DIR, or "
+                                     "~/.cache/olx-utils)"))
+        sv_parser.add_argument("--no-cache",
+                               action="store_true",
+                               help="Don't cache compiled templates")
+
         a_help = 'Create an archive for import into Open edX Studio'
         a_parser = subparsers.add_parser('archive',
                                          help=a_help)
@@ -98,6 +343,38 @@ class CLI(object):
         a_parser.add_argument('-b', '--base-name',
                               default='archive',
                               help="Name of the archive (without .tar.gz)")
+        add_archive_arguments(a_parser)
+        a_parser.add_argument('--from-ref',
+                              metavar='REF',
+                              help=("Read the course from git commit "
+                                    "REF (such as run/NAME) in the "
+                                    "repository in the root directory, "
+                                    "rather than from its working tree"))
+        a_parser.add_argument('--report',
+                              metavar='FILE',
+                              help=("Write a JSON report of the files, "
+                                    "bytes (before and after "
+                                    "compression), and time spent "
+                                    "reading and compressing, for each "
+                                    "directory and member of the "
+                                    "archive to FILE, and print a "
+                                    "summary, including the largest "
+                                    "members"))
+        a_parser.add_argument('--prune-unreferenced',
+                              action='store_true',
+                              help=("Leave out blocks and static assets "
+                                    "that the course doesn't refer to, "
+                                    "and report the bytes saved"))
+        a_parser.add_argument("--cache-dir",
+                              metavar='DIR',
+                              help=("With --reproducible, cache archives "
+                                    "in DIR, and reuse them if the course "
+                                    "is unchanged (default: "
+                                    "$OLX_CACHE_DIR, or "
+                                    "~/.cache/olx-utils)"))
+        a_parser.add_argument("--no-cache",
+                              action="store_true",
+                              help="Don't cache archives")
 
         t_help = 'Retrieve an Open edX CMS REST API token'
         t_epilog = ('You can also set the OLX_LMS_URL, '
@@ -125,6 +402,7 @@ class CLI(object):
                               metavar='SECRET',
                               help=('Open edX CMS Django OAuth '
                                     'Toolkit client secret'))
+        add_http_arguments(t_parser)
 
         u_help = 'Upload a course archive into the Open edX content store'
         u_epilog = ('You can also set the OLX_CMS_URL '
@@ -161,6 +439,55 @@ class CLI(object):
                                     'and returns a task ID that '
                                     'can subsequently be checked with '
                                     '"%s status".' % CANONICAL_COMMAND_NAME))
+        add_wait_arguments(u_parser)
+        add_progress_arguments(u_parser)
+        add_http_arguments(u_parser)
+
+        p_help = ('Create a course archive and upload it into the Open '
+                  'edX content store in one go, without writing it to '
+                  'disk')
+        p_epilog = ('You can also set the OLX_CMS_URL '
+                    'and OLX_CMS_TOKEN environment variables '
+                    'instead of the --url and '
+                    '--token options.')
+        p_parser = subparsers.add_parser('publish',
+                                         help=p_help,
+                                         epilog=p_epilog)
+        p_parser.add_argument('--url',
+                              help='Open edX CMS URL')
+        p_parser.add_argument('--token',
+                              help='Open edX REST API token')
+        p_parser.add_argument('-r', '--root-directory',
+                              default='.',
+                              help="Root directory of course files")
+        p_parser.add_argument('-f',
+                              '--file',
+                              default='archive.tar.gz',
+                              help=('The file name to upload the archive '
+                                    'as, which "%s status" needs to '
+                                    'check on the upload (default: '
+                                    '%%(default)s)' %
+                                    CANONICAL_COMMAND_NAME))
+        p_parser.add_argument('-c',
+                              '--course-id',
+                              help=('Full Open edX course ID, in '
+                                    '"course-v1:org+course+run" form. '
+                                    'If unspecified, the course ID is '
+                                    'detected from the course.xml file '
+                                    'in the root directory.'))
+        p_parser.add_argument('--wait',
+                              default=False,
+                              action='store_true',
+                              help=('Wait for the course import '
+                                    'to fully complete'))
+        add_wait_arguments(p_parser)
+        add_archive_arguments(p_parser)
+        p_parser.add_argument('--prune-unreferenced',
+                              action='store_true',
+                              help=("Leave out blocks and static assets "
+                                    "that the course doesn't refer to"))
+        add_progress_arguments(p_parser)
+        add_http_arguments(p_parser)
 
         s_help = 'Check the status of a course upload task'
         s_epilog = ('You can also set the OLX_CMS_URL '
@@ -192,6 +519,7 @@ class CLI(object):
                               required=True,
                               help=('Task ID, as returned from '
                                     '%s upload' % CANONICAL_COMMAND_NAME))
+        add_http_arguments(s_parser)
 
         self.parser = parser
 
@@ -204,29 +532,63 @@ class CLI(object):
         # Return the passed-in options as a dictionary
         return vars(opts)
 
+    def make_templates(self,
+                       name,
+                       start_date,
+                       end_date,
+                       suffix=None,
+                       public=False,
+                       cache_dir=None,
+                       output_dir=None,
+                       force=False,
+                       ignore=None,
+                       lookup=None,
+                       profile=False,
+                       source_dir='.',
+                       exclude=None):
+        from olxutils.templates import OLXTemplates, run_context
+
+        return OLXTemplates(run_context(name,
+                                        start_date,
+                                        end_date,
+                                        suffix,
+                                        public),
+                            cache_dir=cache_dir, output_dir=output_dir,
+                            incremental=not force, ignore=ignore,
+                            lookup=lookup, profile=profile,
+                            source_dir=source_dir, exclude=exclude)
+
     def render_templates(self,
                          name,
                          start_date,
                          end_date,
                          suffix=None,
-                         public=False):
+                         public=False,
+                         jobs=None,
+                         cache_dir=None,
+                         output_dir=None,
+                         force=False,
+                         ignore=None,
+                         profile=False):
         # Render templates
-        templates = OLXTemplates({
-            "run_name": name,
-            "start_date": start_date,
-            "end_date": end_date.replace(hour=23,
-                                         minute=59,
-                                         second=59),
-            "run_suffix": suffix,
-            "is_public": public,
-        })
-
-        templates.render()
-
-    def create_symlinks(self, name):
+        templates = self.make_templates(name,
+                                        start_date,
+                                        end_date,
+                                        suffix,
+                                        public,
+                                        cache_dir,
+                                        output_dir,
+                                        force,
+                                        ignore,
+                                        profile=profile)
+
+        return templates.render(jobs=jobs or os.cpu_count() or 1)
+
+    def create_symlinks(self, name, output_dir=None):
+        from olxutils.templates import link_policies
+
         # Create symlink for policies
-        os.symlink('_base',
-                   'policies/{}'.format(name))
+        link_policies(name, output_dir)
 
     def new_run(self,
                 name,
@@ -234,18 +596,24 @@ class CLI(object):
                 end_date,
                 suffix=None,
                 create_branch=False,
-                public=False):
+                public=False,
+                jobs=None,
+                cache_dir=None,
+                no_cache=False,
+                output_dir=None,
+                force=False,
+                ignore=None,
+                profile=None):
+        from olxutils.git import GitHelper, GitHelperException
+        from olxutils.templates import OLXTemplateException
 
-        if name == "_base":
-            message = ("This run name is reserved. "
-                       "Please choose another one.")
+        self.check_run(name, start_date, end_date)
+        if create_branch and output_dir:
+            message = ("Cannot create a git branch when rendering "
+                       "into an output directory.")
             raise CLIException(message)
-        if end_date < start_date:
-            message = ("End date [{:%Y-%m-%d}] "
-                       "must be greater than or equal "
-                       "to start date [{:%Y-%m-%d}].")
-            raise CLIException(message.format(end_date,
-                                              start_date))
+
+        cache_dir = self.get_cache_dir(cache_dir, no_cache)
 
         try:
             if create_branch:
@@ -257,13 +625,19 @@ class CLI(object):
 
                 helper.create_branch()
 
-            self.render_templates(name,
-                                  start_date,
-                                  end_date,
-                                  suffix,
-                                  public)
+            report = self.render_templates(name,
+                                           start_date,
+                                           end_date,
+                                           suffix,
+                                           public,
+                                           jobs,
+                                           cache_dir,
+                                           output_dir,
+                                           force,
+                                           ignore,
+                                           bool(profile))
 
-            self.create_symlinks(name)
+            self.create_symlinks(name, output_dir)
 
             if create_branch:
                 helper.add_to_branch()
@@ -280,6 +654,219 @@ class CLI(object):
             raise CLIException('Failed to render templates:\n' + str(t))
 
         logging.info("All done!")
+        return self.save_profile(report, profile)
+
+    def new_runs(self,
+                 schedule,
+                 output_dir='runs',
+                 jobs=None,
+                 cache_dir=None,
+                 no_cache=False,
+                 force=False,
+                 ignore=None,
+                 profile=None):
+        from olxutils.templates import OLXTemplates, OLXTemplateException
+
+        runs = self.read_schedule(schedule)
+        cache_dir = self.get_cache_dir(cache_dir, no_cache)
+
+        # All runs share one template lookup, so that each template
+        # is compiled only once. No run mirrors the others' output
+        # into its own.
+        templates = []
+        lookup = None
+        for run in runs:
+            t = self.make_templates(run['name'],
+                                    run['start_date'],
+                                    run['end_date'],
+                                    run['suffix'],
+                                    run['public'],
+                                    cache_dir,
+                                    os.path.join(output_dir, run['name']),
+                                    force,
+                                    ignore,
+                                    lookup,
+                                    bool(profile),
+                                    exclude=[output_dir])
+            lookup = t.lookup
+            templates.append(t)
+
+        try:
+            report = OLXTemplates.render_many(
+                templates, jobs=jobs or os.cpu_count() or 1)
+        except OLXTemplateException as t:
+            raise CLIException('Failed to render templates:\n' + str(t))
+
+        for run in runs:
+            self.create_symlinks(run['name'],
+                                 os.path.join(output_dir, run['name']))
+
+        logging.info("All done!")
+        return self.save_profile(report, profile)
+
+    def save_profile(self, report, filename):
+        """Write a render profile to filename, if given, and return its
+        summary."""
+        if not filename:
+            return None
+        report.save(filename)
+        logging.info("Wrote profile to %s" % filename)
+        return report.summary()
+
+    def watch(self,
+              name,
+              start_date,
+              end_date,
+              suffix=None,
+              public=False,
+              jobs=None,
+              cache_dir=None,
+              no_cache=False,
+              output_dir='preview',
+              ignore=None):
+        from olxutils.templates import OLXTemplateException
+        from olxutils.watch import watch
+
+        self.check_run(name, start_date, end_date)
+        if os.path.normpath(output_dir) == '.':
+            raise CLIException("Cannot watch for changes when rendering "
+                               "into the source tree.")
+
+        cache_dir = self.get_cache_dir(cache_dir, no_cache)
+        templates = self.make_templates(name,
+                                        start_date,
+                                        end_date,
+                                        suffix,
+                                        public,
+                                        cache_dir,
+                                        output_dir,
+                                        ignore=ignore)
+        try:
+            templates.render(jobs=jobs or os.cpu_count() or 1)
+        except OLXTemplateException as t:
+            # Keep going: fixing the template re-renders it.
+            logging.error('Failed to render templates:\n' + str(t))
+        self.create_symlinks(name, output_dir)
+
+        try:
+            watch(templates)
+        except KeyboardInterrupt:
+            pass
+
+    def serve(self,
+              socket_path=None,
+              port=None,
+              token_file=None,
+              cache_dir=None,
+              no_cache=False):
+        from olxutils.serve import (RenderService,
+                                    HTTPRenderServer,
+                                    UnixRenderServer,
+                                    default_socket_path,
+                                    default_token_path)
+
+        if socket_path and port:
+            raise CLIException("Cannot listen on both a socket and "
+                               "a port.")
+        service = RenderService(self,
+                                self.get_cache_dir(cache_dir, no_cache))
+        if port:
+            server = HTTPRenderServer(service, port)
+            token_file = token_file or default_token_path()
+            server.save_token(token_file)
+            logging.info("Listening on http://127.0.0.1:%d, with the "
+                         "token in %s" % (port, token_file))
+        else:
+            socket_path = socket_path or default_socket_path()
+            os.makedirs(os.path.dirname(os.path.abspath(socket_path)),
+                        exist_ok=True)
+            server = UnixRenderServer(service, socket_path)
+            logging.info("Listening on %s" % socket_path)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    def read_schedule(self, filename):
+        """Read course runs from a CSV schedule file."""
+        def to_bool(s):
+            if s.strip().lower() in ('', '0', 'false', 'n', 'no'):
+                return False
+            if s.strip().lower() in ('1', 'true', 'y', 'yes'):
+                return True
+            raise ValueError("Not a valid boolean: '{0}'.".format(s))
+
+        runs = []
+        with open(filename, newline='') as f:
+            reader = csv.DictReader(f, skipinitialspace=True)
+            for row in reader:
+                line = reader.line_num
+                try:
+                    run = {
+                        'name': row['name'].strip(),
+                        'start_date': datetime.strptime(
+                            row['start_date'].strip(), "%Y-%m-%d"),
+                        'end_date': datetime.strptime(
+                            row['end_date'].strip(), "%Y-%m-%d"),
+                        'suffix': (row.get('suffix') or '').strip() or None,
+                        'public': to_bool(row.get('public') or ''),
+                    }
+                    if not run['name']:
+                        raise ValueError("no name")
+                except (KeyError, AttributeError, ValueError) as e:
+                    # A missing column, or a row with too few fields
+                    message = "{0}, line {1}: invalid run ({2})"
+                    raise CLIException(message.format(filename, line, e))
+                self.check_run(run['name'],
+                               run['start_date'],
+                               run['end_date'])
+                if run['name'] in [r['name'] for r in runs]:
+                    message = "{0}, line {1}: duplicate run name '{2}'."
+                    raise CLIException(message.format(filename,
+                                                      line,
+                                                      run['name']))
+                runs.append(run)
+
+        if not runs:
+            raise CLIException("No runs found in %s." % filename)
+        return runs
+
+    def check_run(self, name, start_date, end_date):
+        if name == "_base":
+            message = ("This run name is reserved. "
+                       "Please choose another one.")
+            raise CLIException(message)
+        if end_date < start_date:
+            message = ("End date [{:%Y-%m-%d}] "
+                       "must be greater than or equal "
+                       "to start date [{:%Y-%m-%d}].")
+            raise CLIException(message.format(end_date,
+                                              start_date))
+
+    def get_cache_dir(self, cache_dir=None, no_cache=False):
+        if no_cache:
+            return None
+        return cache_dir or default_cache_dir()
+
+    def http_client(self, connect_timeout=None, read_timeout=None):
+        """Return an HTTPClient with the given timeouts, or the
+        default ones."""
+        from olxutils.client import HTTPClient
+
+        return HTTPClient(
+            connect_timeout=connect_timeout or HTTPClient.CONNECT_TIMEOUT,
+            read_timeout=read_timeout or HTTPClient.READ_TIMEOUT)
+
+    def progress_interval(self, interval):
+        """Return how often to report upload progress: every interval
+        seconds, unless the output is to be quiet (showing errors
+        only), in which case never."""
+        if not logging.getLogger().isEnabledFor(logging.WARNING):
+            return 0
+        return interval
 
     def setup_logging(self):
         env_loglevel = os.getenv('OLX_LOG_LEVEL', 'WARNING').upper()
@@ -298,53 +885,152 @@ class CLI(object):
         loglevel = root.getEffectiveLevel() - (verbosity * 10)
         root.setLevel(loglevel)
 
-    def archive(self, root_directory='.', base_name="archive"):
+    def archive(self, root_directory='.', base_name="archive",
+                compress_threads=1, compression_level=9,
+                reproducible=False, cache_dir=None, no_cache=False,
+                prune_unreferenced=False, from_ref=None, report=None):
+        from olxutils.archive import ArchiveHelper
+        from olxutils.profiling import ArchiveReport
+
         helper = ArchiveHelper(root_directory,
-                               base_name)
+                               base_name,
+                               compress_threads,
+                               compression_level,
+                               reproducible,
+                               self.get_cache_dir(cache_dir, no_cache),
+                               prune_unreferenced,
+                               from_ref)
 
-        helper.make_archive()
+        archive_report = report and ArchiveReport(compression_level)
+        helper.make_archive(archive_report)
+
+        output = []
+        if prune_unreferenced:
+            output.append("Pruned %d unreferenced files, saving %d bytes" %
+                          (helper.pruned_files, helper.pruned_bytes))
+        if report:
+            archive_report.save(report)
+            logging.info("Wrote report to %s" % report)
+            output.append(archive_report.summary())
+        return '\n'.join(output)
 
     def token(self,
               url=None,
               client_id=None,
-              client_secret=None):
+              client_secret=None,
+              connect_timeout=None,
+              read_timeout=None):
+        from olxutils.token import TokenHelper
 
-        helper = TokenHelper(
-            url or os.getenv('OLX_LMS_URL'),
-            client_id or os.getenv('OLX_LMS_CLIENT_ID'),
-            client_secret or os.getenv('OLX_LMS_CLIENT_SECRET')
-        )
-        return helper.fetch_token()
+        with self.http_client(connect_timeout, read_timeout) as client:
+            helper = TokenHelper(
+                url or os.getenv('OLX_LMS_URL'),
+                client_id or os.getenv('OLX_LMS_CLIENT_ID'),
+                client_secret or os.getenv('OLX_LMS_CLIENT_SECRET'),
+                client=client
+            )
+            return helper.fetch_token()
 
     def upload(self,
                url=None,
                file='archive.tar.gz',
                token=None,
                course_id=None,
-               wait=False):
+               wait=False,
+               timeout=None,
+               poll_interval=None,
+               poll_max_interval=None,
+               progress_interval=10,
+               connect_timeout=None,
+               read_timeout=None):
+        from olxutils.upload import UploadHelper
+
+        with self.http_client(connect_timeout, read_timeout) as client:
+            helper = UploadHelper(
+                url or os.getenv('OLX_CMS_URL'),
+                archive=file,
+                token=token or os.getenv('OLX_CMS_TOKEN'),
+                course_id=course_id,
+                client=client,
+                timeout=timeout,
+                poll_interval=(poll_interval or
+                               UploadHelper.POLL_INTERVAL),
+                poll_max_interval=(poll_max_interval or
+                                   UploadHelper.POLL_MAX_INTERVAL),
+                progress_interval=self.progress_interval(progress_interval)
+            )
+            return helper.upload(wait)
 
-        helper = UploadHelper(
-            url or os.getenv('OLX_CMS_URL'),
-            archive=file,
-            token=token or os.getenv('OLX_CMS_TOKEN'),
-            course_id=course_id
-        )
-        return helper.upload(wait)
+    def publish(self,
+                url=None,
+                token=None,
+                root_directory='.',
+                file='archive.tar.gz',
+                course_id=None,
+                wait=False,
+                compress_threads=1,
+                compression_level=9,
+                reproducible=False,
+                prune_unreferenced=False,
+                timeout=None,
+                poll_interval=None,
+                poll_max_interval=None,
+                progress_interval=10,
+                connect_timeout=None,
+                read_timeout=None):
+        from olxutils.archive import ArchiveHelper
+        from olxutils.upload import UploadHelper, UploadHelperException
+
+        if not course_id:
+            filename = os.path.join(root_directory, 'course.xml')
+            try:
+                with open(filename, 'rb') as f:
+                    course_id = UploadHelper.course_id_from_xml(f.read())
+            except Exception as e:
+                msg = "Unable to determine course ID from %s: %s"
+                raise UploadHelperException(msg % (filename, e))
+
+        archive = ArchiveHelper(root_directory,
+                                None,
+                                compress_threads,
+                                compression_level,
+                                reproducible,
+                                prune_unreferenced=prune_unreferenced)
+        with self.http_client(connect_timeout, read_timeout) as client:
+            helper = UploadHelper(
+                url or os.getenv('OLX_CMS_URL'),
+                archive=file,
+                token=token or os.getenv('OLX_CMS_TOKEN'),
+                course_id=course_id,
+                client=client,
+                timeout=timeout,
+                poll_interval=(poll_interval or
+                               UploadHelper.POLL_INTERVAL),
+                poll_max_interval=(poll_max_interval or
+                                   UploadHelper.POLL_MAX_INTERVAL),
+                progress_interval=self.progress_interval(progress_interval)
+            )
+            return helper.upload_stream(archive.iter_archive(), wait)
 
     def status(self,
                task_id,
                url=None,
                file='archive.tar.gz',
                token=None,
-               course_id=None):
-
-        helper = UploadHelper(
-            url or os.getenv('OLX_CMS_URL'),
-            archive=file,
-            token=token or os.getenv('OLX_CMS_TOKEN'),
-            course_id=course_id
-        )
-        return helper.fetch_upload_task_state(task_id)
+               course_id=None,
+               connect_timeout=None,
+               read_timeout=None):
+        from olxutils.upload import UploadHelper
+
+        with self.http_client(connect_timeout, read_timeout) as client:
+            helper = UploadHelper(
+                url or os.getenv('OLX_CMS_URL'),
+                archive=file,
+                token=token or os.getenv('OLX_CMS_TOKEN'),
+                course_id=course_id,
+                client=client
+            )
+            return helper.fetch_upload_task_state(task_id)
 
     def main(self, argv=sys.argv):
         """Main CLI entry point.
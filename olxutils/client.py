@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+class HTTPClient(object):
+    """
+    Makes HTTP requests to the LMS and CMS through one requests
+    session, keeping connections (and their TLS sessions) alive from
+    one request to the next, rather than opening a new connection for
+    each request.
+
+    """
+    # How many connections to keep alive, per host
+    POOL_SIZE = 4
+
+    # Seconds to wait for a connection, and for a response. Course
+    # imports can take a while to be accepted.
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 300
+
+    def __init__(self, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_client():
+    """Return the HTTPClient shared by all helpers that aren't given
+    one of their own."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HTTPClient()
+        return _default_client
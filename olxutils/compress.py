@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import struct
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelGzipWriter(object):
+    """
+    A write-only file object that gzip-compresses everything written
+    to it into another file object, compressing blocks of data in
+    parallel threads, as pigz does.
+
+    Each block is compressed on its own (zlib releases the GIL while
+    it does so), primed with the end of the previous block so that
+    compression hardly suffers, and flushed to a byte boundary, so
+    that the compressed blocks concatenate into a single deflate
+    stream. The result is a standard gzip file.
+
+    """
+    BLOCKSIZE = 128 * 1024
+
+    # How much of the previous block to prime compression with (the
+    # size of the deflate window)
+    DICTSIZE = 32 * 1024
+
+    def __init__(self, fileobj, compresslevel=9, threads=None,
+                 mtime=None, blocksize=BLOCKSIZE):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.blocksize = blocksize
+        threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(threads)
+        # Blocks being compressed, in order, and how many we allow
+        # before waiting for the first one
+        self.pending = deque()
+        self.max_pending = 2 * threads
+        self.buffer = bytearray()
+        self.dictionary = None
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        self._write_header(time.time() if mtime is None else mtime)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.blocksize:
+            self._submit(bytes(self.buffer[:self.blocksize]))
+            del self.buffer[:self.blocksize]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._write_next()
+            # An empty final block ends the deflate stream.
+            compressor = zlib.compressobj(self.compresslevel,
+                                          zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+            self.fileobj.write(compressor.flush(zlib.Z_FINISH))
+            self.fileobj.write(struct.pack('<II',
+                                           self.crc & 0xffffffff,
+                                           self.size & 0xffffffff))
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_header(self, mtime):
+        if self.compresslevel == zlib.Z_BEST_COMPRESSION:
+            extra_flags = b'\x02'
+        elif self.compresslevel == zlib.Z_BEST_SPEED:
+            extra_flags = b'\x04'
+        else:
+            extra_flags = b'\x00'
+        # Magic number, deflate, no flags, mtime, extra flags, and an
+        # unknown OS (as Python's gzip module writes it)
+        self.fileobj.write(b'\x1f\x8b\x08\x00' +
+                           struct.pack('<I', int(mtime)) +
+                           extra_flags +
+                           b'\xff')
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        if len(self.pending) >= self.max_pending:
+            self._write_next()
+        self.pending.append(self.executor.submit(self._compress,
+                                                 block,
+                                                 self.dictionary))
+        self.dictionary = block[-self.DICTSIZE:]
+
+    def _write_next(self):
+        self.fileobj.write(self.pending.popleft().result())
+
+    def _compress(self, block, dictionary):
+        if dictionary:
+            compressor = zlib.compressobj(self.compresslevel,
+                                          zlib.DEFLATED,
+                                          -zlib.MAX_WBITS,
+                                          zlib.DEF_MEM_LEVEL,
+                                          zlib.Z_DEFAULT_STRATEGY,
+                                          dictionary)
+        else:
+            compressor = zlib.compressobj(self.compresslevel,
+                                          zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+        # A sync flush ends the block on a byte boundary, without
+        # ending the stream.
+        return (compressor.compress(block) +
+                compressor.flush(zlib.Z_SYNC_FLUSH))
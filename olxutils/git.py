@@ -1,7 +1,7 @@
 from __future__ import unicode_literals
 
 import logging
-from subprocess import check_output, CalledProcessError
+from subprocess import check_output, CalledProcessError, Popen, PIPE
 
 
 class GitHelperException(Exception):
@@ -80,3 +80,113 @@ class GitHelper(object):
             "$ git checkout {s.old_branch}\n"
         ).format(s=self)
         logging.warn(message)
+
+
+class GitTree(object):
+    """
+    The files in a git commit (or tree), read straight from the object
+    store of the repository in directory, without a checkout.
+
+    Blobs are read through a single "git cat-file --batch" process,
+    started on first use and kept running until close().
+
+    """
+    # Git modes of the entries we handle
+    TREE = 0o040000
+    LINK = 0o120000
+
+    def __init__(self, ref, directory='.'):
+        self.ref = ref
+        self.directory = directory
+        self.process = None
+        try:
+            self.mtime = int(self._git('log', '-1', '--format=%ct', ref,
+                                       '--'))
+            listing = self._git('ls-tree', '-r', '-t', '-l', '-z',
+                                '--full-tree', ref)
+        except (CalledProcessError, ValueError):
+            raise GitHelperException('Unknown git ref: %s' % ref)
+
+        # Mode, object name and size by path, and names by directory
+        self.objects = {'': (self.TREE, None, 0)}
+        self.children = {'': []}
+        for line in listing.split(b'\0'):
+            if not line:
+                continue
+            info, path = line.split(b'\t', 1)
+            mode, kind, sha, size = info.split()
+            if kind not in (b'tree', b'blob'):
+                # A submodule
+                continue
+            path = path.decode('utf-8', 'surrogateescape')
+            mode = int(mode, 8)
+            self.objects[path] = (mode,
+                                  sha.decode('ascii'),
+                                  0 if size == b'-' else int(size))
+            parent, _, name = path.rpartition('/')
+            self.children[parent].append(name)
+            if mode == self.TREE:
+                self.children[path] = []
+
+    def _git(self, *args):
+        command = ('git', '-C', self.directory) + args
+        logging.debug("+ %s" % ' '.join(command))
+        return check_output(command).strip()
+
+    def exists(self, path):
+        return path in self.objects
+
+    def isdir(self, path):
+        return self.mode(path) == self.TREE
+
+    def islink(self, path):
+        return self.mode(path) == self.LINK
+
+    def isfile(self, path):
+        mode = self.mode(path)
+        return mode is not None and mode not in (self.TREE, self.LINK)
+
+    def mode(self, path):
+        return self.objects.get(path, (None, None, 0))[0]
+
+    def sha(self, path):
+        return self.objects[path][1]
+
+    def size(self, path):
+        return self.objects[path][2]
+
+    def listdir(self, path):
+        return sorted(self.children[path])
+
+    def readlink(self, path):
+        return self.read(path).decode('utf-8', 'surrogateescape')
+
+    def read(self, path):
+        size, stream = self.open(path)
+        data = stream.read(size)
+        stream.read(1)
+        return data
+
+    def open(self, path):
+        """Return the size of the blob at path, and a stream to read
+        exactly that many bytes of it from, followed by a newline that
+        the caller must read before reading anything else."""
+        if self.process is None:
+            self.process = Popen(('git', '-C', self.directory,
+                                  'cat-file', '--batch'),
+                                 stdin=PIPE,
+                                 stdout=PIPE)
+        self.process.stdin.write(self.sha(path).encode('ascii') + b'\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[1] != b'blob':
+            raise GitHelperException('Unable to read %s from %s' %
+                                     (path, self.ref))
+        return int(header[2]), self.process.stdout
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
@@ -3,11 +3,314 @@
 from __future__ import unicode_literals
 
 import textwrap
+import threading
 import markdown2
 import codecs
+import functools
+import hashlib
+import hmac
+import inspect
+import json
+import tempfile
+import time
 
-from os import environ
-from swiftclient.utils import generate_temp_url
+from collections import OrderedDict
+from os import environ, path, makedirs, replace, stat, unlink, utime
+
+from olxutils.cache import prune_cache
+
+# Extras used by OLXHelpers.markdown() unless told otherwise
+DEFAULT_MARKDOWN_EXTRAS = [
+    "fenced-code-blocks",
+    "footnotes",
+    "tables",
+    "use-file-vars"
+]
+
+
+def _extras_key(extras):
+    """Return a string that identifies a set of markdown2 extras (given
+    as either a list, or a dictionary of extras and their
+    arguments)."""
+    return json.dumps(extras, sort_keys=True, default=str)
+
+
+class RenderState(threading.local):
+    """
+    State of the template rendering in progress in the current thread,
+    maintained by OLXTemplates.
+
+    """
+    # The directory relative file names passed to helpers resolve
+    # against, if not the current working directory
+    root = None
+
+    # The directories that templates may import Python modules from
+    module_dirs = None
+
+    # If not None, the set of files the template being rendered
+    # depends on
+    dependencies = None
+
+    # The directory in which to cache HTML converted from Markdown,
+    # if not MarkdownCache's own
+    markdown_cache_dir = None
+
+    # The SwiftTempURLSigner for the render in progress, set up by
+    # the first helper that needs it
+    swift_signer = None
+
+    # If not None, a dictionary in which to accumulate the number of
+    # calls to, and the time spent in, each helper method while
+    # rendering the current template
+    profile = None
+
+    def resolve(self, filename):
+        if self.root:
+            return path.join(self.root, filename)
+        return filename
+
+    def record(self, filename):
+        if self.dependencies is not None:
+            self.dependencies.add(filename)
+
+
+render_state = RenderState()
+
+
+class MarkdownCache(object):
+    """
+    Cache of HTML converted from Markdown, keyed by a digest of the
+    Markdown source and the extras used to convert it.
+
+    The most recently used entries are kept in memory. If the cache
+    has a directory, all entries are also written there, so that they
+    outlast the process, until they go unused for DISK_AGE seconds,
+    or take up more than DISK_BYTES.
+
+    """
+    SIZE = 512
+
+    DISK_AGE = 30 * 24 * 3600
+    DISK_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, directory=None, size=SIZE):
+        self.directory = directory
+        self.size = size
+        self.entries = OrderedDict()
+        # The keys of Markdown files converted previously, by path
+        # and extras, along with the files' size and mtime
+        self.files = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(content, extras_key):
+        data = json.dumps([markdown2.__version__, extras_key, content])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+        if html is None and self._directory():
+            try:
+                with codecs.open(self._path(key), 'r', 'utf-8') as f:
+                    html = f.read()
+                # Mark the entry used, so that prune() keeps it
+                utime(self._path(key))
+                self._remember(key, html)
+            except (IOError, OSError):
+                pass
+        with self.lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return html
+
+    def put(self, key, html):
+        self._remember(key, html)
+        if self._directory():
+            filename = self._path(key)
+            dirname = path.dirname(filename)
+            try:
+                makedirs(dirname)
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=dirname)
+            try:
+                with open(fd, 'w', encoding='utf-8', newline='') as f:
+                    f.write(html)
+                replace(tmp, filename)
+            except:  # noqa: E722
+                unlink(tmp)
+                raise
+
+    def get_file(self, filename, extras_key):
+        """Return the HTML previously converted from a Markdown file, if
+        the file's size and mtime are the same as they were then."""
+        entry = self.files.get((filename, extras_key))
+        if entry:
+            st = stat(filename)
+            if entry[:2] == (st.st_size, st.st_mtime_ns):
+                return self.get(entry[2])
+        return None
+
+    def put_file(self, filename, extras_key, st, key):
+        entry = (st.st_size, st.st_mtime_ns, key)
+        self.files[(filename, extras_key)] = entry
+
+    def prune(self, directory=None):
+        """Remove the entries from the cache directory (or from
+        directory, if given) that went unused for longest, if there
+        are too many."""
+        directory = directory or self._directory()
+        if directory:
+            prune_cache(directory, self.DISK_BYTES, self.DISK_AGE)
+
+    def _remember(self, key, html):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _directory(self):
+        return render_state.markdown_cache_dir or self.directory
+
+    def _path(self, key):
+        return path.join(self._directory(), key[:2], key + '.html')
+
+
+markdown_cache = MarkdownCache()
+
+
+class MarkdownConverters(threading.local):
+    """
+    Reusable markdown2 converters, one per set of extras.
+
+    Setting up a converter, and its extras, is expensive enough to
+    show up when converting many small snippets. A converter resets
+    itself at the start of every conversion, but keeps state while
+    converting, so each thread gets converters of its own.
+
+    """
+    def __init__(self):
+        self.converters = {}
+
+    def get(self, extras, extras_key):
+        converter = self.converters.get(extras_key)
+        if converter is None:
+            converter = markdown2.Markdown(extras=extras)
+            self.converters[extras_key] = converter
+        return converter
+
+
+markdown_converters = MarkdownConverters()
+
+
+class SwiftTempURLSigner(object):
+    """
+    Generates Swift temporary URLs, as swiftclient's
+    generate_temp_url() does, but for many objects in a row.
+
+    It prepares its HMAC key only once, and memoizes the URLs it
+    generates by path and expiry time.
+
+    """
+    METHOD = 'GET'
+
+    def __init__(self, endpoint, swift_path, key, digest=None):
+        if digest is None:
+            digest = self.default_digest()
+        self.endpoint = endpoint
+        self.swift_path = swift_path
+        self.hmac = hmac.new(key.encode('utf-8'),
+                             digestmod=getattr(hashlib, digest))
+        self.urls = {}
+
+    @staticmethod
+    def default_digest():
+        """Return the digest the installed swiftclient signs temporary
+        URLs with by default (older versions have no choice, and use
+        SHA-1)."""
+        # Importing swiftclient takes a while, and most courses never
+        # need it.
+        from swiftclient.utils import generate_temp_url
+
+        try:
+            return inspect.signature(
+                generate_temp_url).parameters['digest'].default
+        except KeyError:
+            return 'sha1'
+
+    @classmethod
+    def from_environ(cls):
+        swift_endpoint = environ.get('SWIFT_ENDPOINT')
+        swift_path = environ.get('SWIFT_PATH')
+        swift_tempurl_key = environ.get('SWIFT_TEMPURL_KEY')
+
+        assert (swift_endpoint)
+        assert (swift_path)
+        assert (swift_tempurl_key)
+
+        return cls(swift_endpoint, swift_path, swift_tempurl_key)
+
+    @staticmethod
+    def expires(date):
+        # Equivalent to the (platform dependent) date.strftime("%s"),
+        # i.e. date as a local time, in seconds since the epoch
+        return int(time.mktime(date.timetuple()))
+
+    def sign(self, path, date):
+        return self._sign(path, self.expires(date))
+
+    def sign_many(self, paths, date):
+        expires = self.expires(date)
+        return [self._sign(path, expires) for path in paths]
+
+    def _sign(self, path, expires):
+        url = self.urls.get((path, expires))
+        if url is None:
+            object_path = "{}{}".format(self.swift_path, path)
+            # generate_temp_url() only signs full object paths
+            parts = object_path.split('/', 4)
+            if len(parts) != 5 or parts[0] or not all(parts[1:]):
+                raise ValueError('path must be full path to an object'
+                                 ' e.g. /v1/a/c/o')
+            body = '\n'.join([self.METHOD, str(expires), object_path])
+            mac = self.hmac.copy()
+            mac.update(body.encode('utf-8'))
+            url = ('{}{}?temp_url_sig={}'
+                   '&temp_url_expires={}').format(self.endpoint,
+                                                  object_path,
+                                                  mac.hexdigest(),
+                                                  expires)
+            self.urls[(path, expires)] = url
+        return url
+
+
+def _profiled(func):
+    """Record calls to a helper method in render_state.profile, if
+    we are profiling."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = render_state.profile
+        if profile is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            entry = profile.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+    return wrapper
 
 
 class OLXHelpers(object):
@@ -16,57 +319,100 @@ class OLXHelpers(object):
 
     """
     @staticmethod
+    @_profiled
     def suffix(s):
         return ' ({})'.format(s) if s else ''
 
     @staticmethod
+    @_profiled
     def date(d):
         return d.strftime('%Y-%m-%dT%H:%M:%SZ')
 
     @staticmethod
+    @_profiled
     def markdown(content, extras=None):
+        # Default extras
+        if extras is None:
+            extras = DEFAULT_MARKDOWN_EXTRAS
+
+        return OLXHelpers._markdown(content,
+                                    extras,
+                                    _extras_key(extras))[1]
+
+    @staticmethod
+    @_profiled
+    def markdown_many(contents, extras=None):
+        """Convert a list of Markdown snippets, all with the same extras,
+        returning a list of HTML strings."""
+        if extras is None:
+            extras = DEFAULT_MARKDOWN_EXTRAS
+
+        extras_key = _extras_key(extras)
+        return [OLXHelpers._markdown(content, extras, extras_key)[1]
+                for content in contents]
+
+    @staticmethod
+    def _markdown(content, extras, extras_key):
+        """Convert Markdown to HTML, returning the cache key and the
+        HTML."""
         # Fix up whitespace.
         if content[0] == "\n":
             content = content[1:]
         content = content.rstrip()
         content = textwrap.dedent(content)
 
-        # Default extras
-        if extras is None:
-            extras = [
-                "fenced-code-blocks",
-                "footnotes",
-                "tables",
-                "use-file-vars"
-            ]
-
-        return markdown2.markdown(content,
-                                  extras=extras)
+        key = markdown_cache.key(content, extras_key)
+        html = markdown_cache.get(key)
+        if html is None:
+            converter = markdown_converters.get(extras, extras_key)
+            html = converter.convert(content)
+            markdown_cache.put(key, html)
+        return key, html
 
     @classmethod
+    @_profiled
     def markdown_file(cls, filename, extras=None):
+        filename = render_state.resolve(filename)
+        render_state.record(filename)
+        if extras is None:
+            extras = DEFAULT_MARKDOWN_EXTRAS
+        extras_key = _extras_key(extras)
+
+        # Don't even read a file we have converted before, unless it
+        # has changed since.
+        html = markdown_cache.get_file(filename, extras_key)
+        if html is not None:
+            return html
+
+        st = stat(filename)
         content = ''
         with codecs.open(filename, 'r', encoding="utf-8") as f:
             content = f.read()
-        return cls.markdown(content,
-                            extras=extras)
+        key, html = cls._markdown(content,
+                                  extras,
+                                  extras_key)
+        markdown_cache.put_file(filename, extras_key, st, key)
+        return html
 
     @staticmethod
+    @_profiled
     def swift_tempurl(path, date):
-        swift_endpoint = environ.get('SWIFT_ENDPOINT')
-        swift_path = environ.get('SWIFT_PATH')
-        swift_tempurl_key = environ.get('SWIFT_TEMPURL_KEY')
+        return OLXHelpers._swift_signer().sign(path, date)
 
-        assert (swift_endpoint)
-        assert (swift_path)
-        assert (swift_tempurl_key)
-
-        path = "{}{}".format(swift_path, path)
-        timestamp = int(date.strftime("%s"))
-        temp_url = generate_temp_url(path,
-                                     timestamp,
-                                     swift_tempurl_key,
-                                     'GET',
-                                     absolute=True)
+    @staticmethod
+    @_profiled
+    def swift_tempurls(paths, date):
+        """Generate temporary URLs for a list of objects, all expiring at
+        the same time."""
+        return OLXHelpers._swift_signer().sign_many(paths, date)
 
-        return "{}{}".format(swift_endpoint, temp_url)
+    @staticmethod
+    def _swift_signer():
+        # While rendering, read the configuration from the environment
+        # only once. Otherwise, read it every time.
+        if render_state.swift_signer is None:
+            signer = SwiftTempURLSigner.from_environ()
+            if render_state.dependencies is not None:
+                render_state.swift_signer = signer
+            return signer
+        return render_state.swift_signer
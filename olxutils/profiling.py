@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+import zlib
+
+
+class RenderProfile(object):
+    """
+    Where the time went while rendering a course: how long template
+    discovery spent in each directory, and how long each template took
+    to compile and render, how much output it produced, and how much
+    time it spent in each helper method.
+
+    """
+    def __init__(self):
+        # Seconds spent scanning each directory for templates
+        self.discovery = {}
+        # One entry per template rendered (per run)
+        self.templates = []
+
+    def add_template(self, run, filename, entry):
+        entry = dict(entry, template=filename)
+        if run is not None:
+            entry['run'] = run
+        self.templates.append(entry)
+
+    def helpers(self):
+        """Sum up the calls to, and time spent in, each helper method
+        across all templates."""
+        totals = {}
+        for entry in self.templates:
+            for name, (calls, seconds) in entry['helpers'].items():
+                total = totals.setdefault(name, [0, 0.0])
+                total[0] += calls
+                total[1] += seconds
+        return totals
+
+    def as_dict(self):
+        return {
+            'discovery': self.discovery,
+            'templates': self.templates,
+            'helpers': dict((name, {'calls': calls, 'time': seconds})
+                            for name, (calls, seconds)
+                            in self.helpers().items()),
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def summary(self, top=10):
+        """Summarize the slowest templates and helpers, as text."""
+        lines = ["Discovery: %.3fs in %d directories" % (
+            sum(self.discovery.values()), len(self.discovery))]
+
+        templates = sorted(self.templates,
+                           key=lambda e: e['compile'] + e['render'],
+                           reverse=True)[:top]
+        lines.append("Slowest templates (compile, render, bytes):")
+        for entry in templates:
+            name = entry['template']
+            if 'run' in entry:
+                name = '%s [%s]' % (name, entry['run'])
+            lines.append("  %8.3fs %8.3fs %10d  %s" % (
+                entry['compile'], entry['render'], entry['bytes'], name))
+
+        helpers = sorted(self.helpers().items(),
+                         key=lambda item: item[1][1],
+                         reverse=True)[:top]
+        lines.append("Slowest helpers (time, calls):")
+        for name, (calls, seconds) in helpers:
+            lines.append("  %8.3fs %8d  %s" % (seconds, calls, name))
+        return '\n'.join(lines)
+
+
+class ArchiveReport(object):
+    """
+    What went into a course archive: for each allowlisted directory
+    (and file), how many files it holds, their size before and after
+    compression, and how long it took to read and to compress them;
+    and the same for each archive member.
+
+    Compressors work on blocks of the archive rather than on members,
+    so each file is also compressed on its own, as it is read, to tell
+    how well it compresses, and how long that takes. The size and
+    compression time of the archive as a whole are recorded, too.
+
+    """
+    def __init__(self, compresslevel=9):
+        self.compresslevel = compresslevel
+        # One entry per archive member
+        self.members = []
+        # Bytes in and out of the compressor, and seconds spent in it
+        self.archive = {'bytes': 0, 'compressed': 0, 'compress': 0.0}
+
+    def reader(self, fileobj):
+        """Wrap fileobj, a member's content, to measure reading and
+        compressing it."""
+        return _MemberReader(fileobj, self.compresslevel)
+
+    def add_member(self, arcname, kind, size, reader=None):
+        """Record a member (a 'file', 'directory' or 'symlink') of size
+        bytes, read through reader, if it has content."""
+        parts = arcname.split('/')
+        self.members.append({
+            'member': arcname,
+            'directory': parts[1] if len(parts) > 1 else '.',
+            'type': kind,
+            'bytes': size,
+            'compressed': reader.compressed() if reader else 0,
+            'read': reader.read_seconds if reader else 0.0,
+            'compress': reader.compress_seconds if reader else 0.0,
+        })
+
+    def directories(self):
+        """Sum up the members in each allowlisted directory."""
+        totals = {}
+        for member in self.members:
+            total = totals.setdefault(member['directory'], {
+                'files': 0,
+                'bytes': 0,
+                'compressed': 0,
+                'read': 0.0,
+                'compress': 0.0,
+            })
+            total['files'] += member['type'] == 'file'
+            for key in ('bytes', 'compressed', 'read', 'compress'):
+                total[key] += member[key]
+        return totals
+
+    def largest(self, top=10):
+        return sorted(self.members,
+                      key=lambda m: m['bytes'],
+                      reverse=True)[:top]
+
+    def as_dict(self, top=10):
+        return {
+            'archive': self.archive,
+            'directories': self.directories(),
+            'members': self.members,
+            'largest': [m['member'] for m in self.largest(top)],
+        }
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+    def summary(self, top=10):
+        """Summarize the archive by directory, and its largest members,
+        as text."""
+        lines = ["Archive: %d bytes, compressed to %d in %.3fs" % (
+            self.archive['bytes'], self.archive['compressed'],
+            self.archive['compress'])]
+        lines.append("Directories (files, bytes, compressed, read, "
+                     "compress):")
+        directories = sorted(self.directories().items(),
+                             key=lambda item: item[1]['bytes'],
+                             reverse=True)
+        for name, total in directories:
+            lines.append("  %6d %12d %12d %8.3fs %8.3fs  %s" % (
+                total['files'], total['bytes'], total['compressed'],
+                total['read'], total['compress'], name))
+        lines.append("Largest members (bytes, compressed):")
+        for member in self.largest(top):
+            lines.append("  %12d %12d  %s" % (
+                member['bytes'], member['compressed'], member['member']))
+        return '\n'.join(lines)
+
+
+class _MemberReader(object):
+    """A file object timing reads from another, and compressing what
+    it reads on the side."""
+
+    def __init__(self, fileobj, compresslevel):
+        self.fileobj = fileobj
+        self.compressor = zlib.compressobj(compresslevel,
+                                           zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
+        self.size = 0
+        self.read_seconds = 0.0
+        self.compress_seconds = 0.0
+
+    def read(self, *args):
+        start = time.monotonic()
+        data = self.fileobj.read(*args)
+        self.read_seconds += time.monotonic() - start
+        start = time.monotonic()
+        self.size += len(self.compressor.compress(data))
+        self.compress_seconds += time.monotonic() - start
+        return data
+
+    def compressed(self):
+        start = time.monotonic()
+        self.size += len(self.compressor.flush())
+        self.compress_seconds += time.monotonic() - start
+        return self.size
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import json
+import logging
+import posixpath
+import re
+
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+
+class ReferenceIndex(object):
+    """
+    The files of a rendered course that its OLX refers to, directly or
+    indirectly, starting from course.xml and any other root files.
+
+    Blocks refer to the files defining their children by url_name
+    (<chapter url_name="foo"/> is defined in chapter/foo.xml), and
+    HTML blocks to their content by filename. Static assets are
+    referred to by /static/ URLs, by asset URLs (in which their path
+    is flattened to a name, static/images/foo.png becoming
+    images_foo.png), or by name alone, in policies. Static HTML, CSS
+    and SVG files may also refer to other static assets by relative
+    URLs, and scripts by strings naming files in their own directory.
+
+    Only files in PRUNED directories can be unreferenced; the index
+    considers all others referenced. Open edX loads the IMPLICIT
+    files by convention, without any reference, so the index always
+    starts from those, too.
+
+    Files are read from root_directory, or from a GitTree, if given.
+
+    """
+    # Directories holding blocks, by url_name, and static assets
+    PRUNED = [
+        'chapter',
+        'conditional',
+        'course',
+        'html',
+        'library_content',
+        'problem',
+        'sequential',
+        'split_test',
+        'static',
+        'vertical',
+        'video',
+    ]
+
+    # Files that Open edX loads without any reference to them:
+    # python_lib.zip holds Python code for capa problems' scripts.
+    IMPLICIT = [
+        'static/python_lib.zip',
+    ]
+
+    # The policy listing all static assets, whether referenced or not
+    ASSET_POLICY = 'policies/assets.json'
+
+    # Files that may refer to static assets
+    TEXT = ['.css', '.htm', '.html', '.js', '.json', '.svg', '.xml']
+
+    STATIC_URL = re.compile(r'/static/([^\s"\'<>()\\?#]+)')
+    ASSET_URL = re.compile(r'(?:block@|/c4x/[^/\s"\']+/[^/\s"\']+/asset/)'
+                           r'([^\s"\'<>()\\?#/]+)')
+    RELATIVE_URL = re.compile(r'(?:\b(?:src|href)\s*=\s*["\']|'
+                              r'\burl\(\s*["\']?)([^\s"\'()]+)')
+
+    # Static files that may refer to other static files by relative
+    # URLs, and how to find them
+    RELATIVE = {
+        '.css': RELATIVE_URL,
+        '.htm': RELATIVE_URL,
+        '.html': RELATIVE_URL,
+        '.svg': RELATIVE_URL,
+        # Scripts may load files from their own directory, so keep
+        # any that a string names (as in 'notes.html').
+        '.js': re.compile(r'["\']([^\s"\'()]+\.\w+)["\']'),
+    }
+
+    def __init__(self, root_directory, roots=('course.xml',), tree=None):
+        self.root_directory = root_directory
+        self.tree = tree
+        self.assets = self._assets()
+        self.referenced = set()
+        pending = list(roots) + self.IMPLICIT
+        while pending:
+            path = pending.pop()
+            if path not in self.referenced:
+                pending.extend(self._visit(path))
+
+    def __contains__(self, path):
+        """Return whether the course refers to path (relative to the
+        root directory, with forward slashes)."""
+        top = path.split('/', 1)[0]
+        return top not in self.PRUNED or path in self.referenced
+
+    def _assets(self):
+        """Map the name of each static asset to its path."""
+        assets = {}
+        for path in self._static_files():
+            assets.setdefault(path[len('static/'):].replace('/', '_'), path)
+        return assets
+
+    def _static_files(self):
+        if self.tree:
+            return sorted(path for path in self.tree.objects
+                          if path.startswith('static/') and
+                          not self.tree.isdir(path))
+        paths = []
+        static = os.path.join(self.root_directory, 'static')
+        for dirpath, dirnames, filenames in os.walk(static):
+            dirnames.sort()
+            directory = os.path.relpath(dirpath, self.root_directory)
+            for filename in sorted(filenames):
+                paths.append(posixpath.join(directory.replace(os.sep, '/'),
+                                            filename))
+        return paths
+
+    def _visit(self, path):
+        """Mark path referenced, and return the paths it refers to."""
+        if self._islink(path):
+            # Keep what the symlink points to, too.
+            self.referenced.add(path)
+            target = posixpath.join(posixpath.dirname(path),
+                                    self._readlink(path))
+            return self._resolve(posixpath.normpath(target))
+        if not self._isfile(path):
+            return []
+        self.referenced.add(path)
+
+        references = []
+        extension = posixpath.splitext(path)[1].lower()
+        if extension not in self.TEXT:
+            return references
+        text = self._read(path).decode('utf-8', 'replace')
+
+        if extension == '.xml':
+            references.extend(self._xml_references(path, text))
+        elif extension == '.json' and path != self.ASSET_POLICY:
+            references.extend(self._json_references(path, text))
+        for match in self.STATIC_URL.finditer(text):
+            references.extend(self._static(unquote(match.group(1))))
+        for match in self.ASSET_URL.finditer(text):
+            references.extend(self._asset(unquote(match.group(1))))
+        if path.startswith('static/') and extension in self.RELATIVE:
+            for match in self.RELATIVE[extension].finditer(text):
+                url = match.group(1).split('#')[0].split('?')[0]
+                if not url or url.startswith('/') or ':' in url:
+                    # Absolute, or handled above
+                    continue
+                target = posixpath.join(posixpath.dirname(path),
+                                        unquote(url))
+                references.extend(self._resolve(posixpath.normpath(target)))
+        return references
+
+    def _xml_references(self, path, text):
+        try:
+            root = ElementTree.fromstring(text.encode('utf-8'))
+        except ElementTree.ParseError as e:
+            logging.warning("Unable to follow references in %s: %s" %
+                            (path, e))
+            return []
+        references = []
+        for element in root.iter():
+            if not isinstance(element.tag, str):
+                continue
+            url_name = element.get('url_name')
+            if url_name:
+                url_name = url_name.replace(':', '/')
+                references.append('%s/%s.xml' % (element.tag, url_name))
+            filename = element.get('filename')
+            if element.tag == 'html' and filename:
+                if not filename.endswith('.html'):
+                    filename += '.html'
+                references.append('html/%s' % filename)
+            if element.tag == 'video' and element.get('sub'):
+                references.extend(
+                    self._asset('subs_%s.srt.sjson' % element.get('sub')))
+            if element.tag == 'transcript' and element.get('src'):
+                references.extend(self._asset(element.get('src')))
+        return references
+
+    def _json_references(self, path, text):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            logging.warning("Unable to follow references in %s: %s" %
+                            (path, e))
+            return []
+        references = []
+        pending = [data]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                pending.extend(value.values())
+            elif isinstance(value, list):
+                pending.extend(value)
+            elif isinstance(value, str):
+                references.extend(self._asset(value))
+        return references
+
+    def _static(self, name):
+        path = posixpath.normpath('static/' + name)
+        if self._islink(path) or self._isfile(path):
+            return [path]
+        return self._asset(name)
+
+    def _asset(self, name):
+        path = self.assets.get(name)
+        return [path] if path else []
+
+    def _islink(self, path):
+        if self.tree:
+            return self.tree.islink(path)
+        return os.path.islink(os.path.join(self.root_directory, path))
+
+    def _isfile(self, path):
+        if self.tree:
+            return self.tree.isfile(path)
+        return os.path.isfile(os.path.join(self.root_directory, path))
+
+    def _readlink(self, path):
+        if self.tree:
+            return self.tree.readlink(path)
+        return os.readlink(os.path.join(self.root_directory, path))
+
+    def _read(self, path):
+        if self.tree:
+            return self.tree.read(path)
+        with open(os.path.join(self.root_directory, path), 'rb') as f:
+            return f.read()
+
+    def _resolve(self, path):
+        if path.startswith('../') or posixpath.isabs(path):
+            return []
+        return [path]
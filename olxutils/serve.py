@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from olxutils import __version__
+from olxutils.archive import ArchiveHelper
+from olxutils.cache import default_cache_dir
+from olxutils.git import GitHelperException
+from olxutils.templates import OLXTemplateException
+
+DEFAULT_PORT = 8470
+
+
+def default_socket_path():
+    """Return where to listen on a Unix socket, unless told otherwise:
+    in $XDG_RUNTIME_DIR if set, and otherwise in the cache directory."""
+    return os.path.join(os.getenv('XDG_RUNTIME_DIR') or default_cache_dir(),
+                        'olx.sock')
+
+
+def default_token_path():
+    """Return where to save the token that clients must send to a
+    daemon listening on TCP."""
+    return os.path.join(default_cache_dir(), 'serve.token')
+
+
+class JobError(Exception):
+    """
+    A job that failed, along with the HTTP status to report it with.
+
+    """
+    def __init__(self, message, status=400):
+        super(JobError, self).__init__(message)
+        self.status = status
+
+
+class RenderService(object):
+    """
+    Runs render and archive jobs, described by JSON objects, keeping
+    template lookups (and thus compiled templates) warm from one job
+    to the next.
+
+    Jobs may run concurrently, each in its own thread, except that
+    only one job at a time renders into any one directory.
+
+    """
+    # How many courses to keep compiled templates in memory for
+    LOOKUPS = 16
+
+    def __init__(self, cli, cache_dir=None):
+        self.cli = cli
+        self.cache_dir = cache_dir and os.path.abspath(cache_dir)
+        # Template lookups by source directory, least recently used
+        # first
+        self.lookups = OrderedDict()
+        # Locks by output directory
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def render(self, job):
+        """Render a course run, in place or into an output directory."""
+        source_dir = os.path.abspath(self._get(job, 'source_dir'))
+        output_dir = job.get('output_dir')
+        output_dir = output_dir and os.path.abspath(output_dir)
+        name = self._get(job, 'name')
+        start_date = self._get_date(job, 'start_date')
+        end_date = self._get_date(job, 'end_date')
+        try:
+            self.cli.check_run(name, start_date, end_date)
+        except Exception as e:
+            raise JobError(str(e))
+
+        with self._lock(output_dir or source_dir):
+            templates = self.cli.make_templates(name,
+                                                start_date,
+                                                end_date,
+                                                job.get('suffix'),
+                                                bool(job.get('public')),
+                                                self.cache_dir,
+                                                output_dir,
+                                                bool(job.get('force')),
+                                                job.get('ignore'),
+                                                self._lookup(source_dir),
+                                                source_dir=source_dir)
+            self._keep_lookup(source_dir, templates.lookup)
+            try:
+                templates.render()
+            except OLXTemplateException as e:
+                raise JobError('Failed to render templates:\n' + str(e),
+                               422)
+            self.cli.create_symlinks(name, output_dir or source_dir)
+        return {'output_dir': output_dir or source_dir}
+
+    def archive(self, job):
+        """Create a course archive from a (rendered) course."""
+        root_directory = os.path.abspath(self._get(job, 'root_directory'))
+        base_name = os.path.abspath(
+            job.get('base_name') or os.path.join(root_directory,
+                                                 'archive'))
+        threads = self._get_int(job, 'compress_threads', 1, 1)
+        level = self._get_int(job, 'compression_level', 9, 0, 9)
+        prune = bool(job.get('prune_unreferenced'))
+        ref = job.get('ref')
+        if ref:
+            # Reading from the object store, we needn't wait for
+            # jobs rendering into the working tree.
+            lock = threading.Lock()
+        else:
+            lock = self._lock(root_directory)
+        with lock:
+            try:
+                helper = ArchiveHelper(root_directory,
+                                       base_name,
+                                       threads,
+                                       level,
+                                       bool(job.get('reproducible')),
+                                       self.cache_dir,
+                                       prune,
+                                       ref)
+            except GitHelperException as e:
+                raise JobError(str(e))
+            filename = helper.make_archive()
+        result = {'filename': os.path.abspath(filename)}
+        if prune:
+            result['pruned_files'] = helper.pruned_files
+            result['pruned_bytes'] = helper.pruned_bytes
+        return result
+
+    @staticmethod
+    def _get(job, key):
+        value = job.get(key)
+        if not value:
+            raise JobError("Missing %s" % key)
+        return value
+
+    def _get_date(self, job, key):
+        value = self._get(job, key)
+        try:
+            return datetime.strptime(value, "%Y-%m-%d")
+        except (TypeError, ValueError):
+            raise JobError("Not a valid %s: '%s'." % (key, value))
+
+    @staticmethod
+    def _get_int(job, key, default, minimum, maximum=None):
+        value = job.get(key, default)
+        if (not isinstance(value, int) or value < minimum or
+                (maximum is not None and value > maximum)):
+            raise JobError("Not a valid %s: '%s'." % (key, value))
+        return value
+
+    def _lock(self, directory):
+        with self.lock:
+            return self.locks.setdefault(directory, threading.Lock())
+
+    def _lookup(self, source_dir):
+        with self.lock:
+            lookup = self.lookups.get(source_dir)
+            if lookup:
+                self.lookups.move_to_end(source_dir)
+            return lookup
+
+    def _keep_lookup(self, source_dir, lookup):
+        with self.lock:
+            self.lookups[source_dir] = lookup
+            self.lookups.move_to_end(source_dir)
+            while len(self.lookups) > self.LOOKUPS:
+                self.lookups.popitem(last=False)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles GET / (returning our version), and POST /render and POST
+    /archive (running the job in the request body).
+
+    Jobs must be sent as application/json, which a web page can't do
+    without the browser asking us first (and we don't answer). On
+    TCP, which any local user can connect to, every request must also
+    carry the server's token (as "Authorization: Bearer TOKEN"), and
+    the Host must be the address we listen on, which a web page can't
+    point another domain name at.
+
+    """
+    server_version = 'olx'
+
+    def do_GET(self):
+        if not self._check_access():
+            return
+        if self.path != '/':
+            self._respond(404, {'error': 'Not found'})
+            return
+        self._respond(200, {'version': __version__})
+
+    def do_POST(self):
+        service = self.server.service
+        handler = {
+            '/render': service.render,
+            '/archive': service.archive,
+        }.get(self.path)
+        if not handler:
+            self._respond(404, {'error': 'Not found'})
+            return
+        if not self._check_access():
+            return
+        content_type = self.headers.get('Content-Type') or ''
+        if content_type.split(';')[0].strip().lower() != 'application/json':
+            self._respond(415, {'error': 'Jobs must be application/json'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError("not a JSON object")
+        except ValueError as e:
+            self._respond(400, {'error': 'Invalid job: %s' % e})
+            return
+
+        start = time.monotonic()
+        try:
+            result = handler(job)
+        except JobError as e:
+            self._respond(e.status, {'error': str(e)})
+        except Exception as e:
+            logging.exception("Failed to run job %s" % job)
+            self._respond(500, {'error': str(e)})
+        else:
+            result['seconds'] = time.monotonic() - start
+            self._respond(200, result)
+
+    def _check_access(self):
+        """Respond with an error, and return False, unless the request
+        carries the server's token (if it has one), and its Host
+        header names one of the server's allowed hosts."""
+        token = self.server.token
+        if token is not None:
+            authorization = self.headers.get('Authorization') or ''
+            if not hmac.compare_digest(authorization.encode('utf-8'),
+                                       ('Bearer %s' % token).encode('utf-8')):
+                self._respond(401, {'error': 'Missing or invalid token'})
+                return False
+        allowed = self.server.allowed_hosts
+        if allowed is None or self.headers.get('Host') in allowed:
+            return True
+        self._respond(403, {'error': 'Forbidden host: %s' %
+                            self.headers.get('Host')})
+        return False
+
+    def _respond(self, status, result):
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients connecting via a Unix socket have no address.
+        return self.client_address and self.client_address[0] or 'local'
+
+    def log_message(self, format, *args):
+        logging.info("%s %s" % (self.address_string(), format % args))
+
+
+class HTTPRenderServer(ThreadingHTTPServer):
+    """
+    Serves a RenderService via HTTP on localhost, to clients that know
+    its token (a random one, unless given).
+
+    """
+    def __init__(self, service, port=DEFAULT_PORT, token=None):
+        super(HTTPRenderServer, self).__init__(('127.0.0.1', port),
+                                               RequestHandler)
+        self.service = service
+        self.token = token or secrets.token_urlsafe(32)
+        port = self.server_address[1]
+        self.allowed_hosts = {'127.0.0.1:%d' % port, 'localhost:%d' % port}
+
+    def save_token(self, path):
+        """Write the token to path, readable by the current user only."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # The file may have existed with other permissions.
+        os.fchmod(fd, 0o600)
+        with open(fd, 'w') as f:
+            f.write(self.token + '\n')
+
+
+class UnixRenderServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Serves a RenderService via HTTP on a Unix socket, which only the
+    current user may connect to.
+
+    """
+    daemon_threads = True
+
+    # Only the current user can connect, so no token is needed, and
+    # any Host will do.
+    token = None
+    allowed_hosts = None
+
+    def __init__(self, service, path):
+        super(UnixRenderServer, self).__init__(path, RequestHandler)
+        self.service = service
+
+    def server_bind(self):
+        super(UnixRenderServer, self).server_bind()
+        # Before we listen, so nobody else can connect in between
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super(UnixRenderServer, self).server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
@@ -2,14 +2,37 @@
 from __future__ import unicode_literals
 
 import os
+import re
 import sys
 import fnmatch
-import codecs
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from importlib.abc import MetaPathFinder
+from importlib.machinery import PathFinder
+from importlib.util import cache_from_source
 
 from mako.template import Template
 from mako.lookup import TemplateLookup
 from mako import exceptions
 
+from olxutils import __version__
+from olxutils.cache import mark_used, prune_cache
+from olxutils.helpers import markdown_cache, render_state
+from olxutils.profiling import RenderProfile
+
+
+# Mako parses the Python code in templates with the ast module, which
+# isn't thread-safe in all Python versions we support (see CPython
+# issue 106905), so templates are compiled one at a time.
+_compile_lock = threading.RLock()
+
 
 class OLXTemplateException(Exception):
     pass
@@ -65,61 +88,748 @@ class OLXTemplates(object):
         "trim",
     ]
 
-    context = {}
+    # Templates of these types may be read back in by other templates
+    # (via olx_helpers.markdown_file()), so they are rendered in a
+    # pass of their own, before any others.
+    SOURCE_FILETYPES = [
+        "md",
+    ]
 
-    lookup = None
+    # Never mirrored into an output directory
+    IGNORE_DIRS = [
+        ".git",
+    ]
 
-    def __init__(self, context):
+    # Every edited template (and every checkout) adds its own compiled
+    # modules to the cache directory, so drop modules that went unused
+    # for longer than this, in seconds, and the least recently used
+    # ones beyond this many bytes.
+    MODULE_CACHE_AGE = 30 * 24 * 3600
+    MODULE_CACHE_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, context, cache_dir=None, output_dir=None,
+                 incremental=True, ignore=None, lookup=None,
+                 profile=False, source_dir='.', exclude=None):
         self.context = context
-        self.lookup = TemplateLookup(
-            directories=self.LOOKUP_DIRS,
+
+        # Everything is relative to the course's source directory,
+        # rather than to the current working directory, so that
+        # one process can render several courses.
+        self.source_dir = os.path.abspath(source_dir)
+
+        # Look up the file types to render by directory, and note the
+        # directories we must pass through on our way there.
+        self.filetypes = {}
+        self.parent_dirs = set()
+        for directory, filetype in self.OLX_DIRS:
+            directory = os.path.normpath(directory)
+            self.filetypes.setdefault(directory, set()).add(filetype)
+            parent = os.path.dirname(directory)
+            while parent:
+                self.parent_dirs.add(parent)
+                parent = os.path.dirname(parent)
+
+        # Don't look for templates in files or directories whose
+        # path (relative to the course root) matches any of these
+        # shell-style patterns.
+        self.ignore = ignore or []
+        if self.ignore:
+            self.ignore_re = re.compile('|'.join(fnmatch.translate(p)
+                                                 for p in self.ignore))
+        else:
+            self.ignore_re = None
+
+        # Render into a separate output directory, rather than
+        # overwriting the templates in place
+        self.output_dir = output_dir and os.path.abspath(output_dir)
+
+        # Never mirror these directories (such as the parent of the
+        # output directories of several runs) into the output
+        # directory, any more than the output directory itself
+        self.exclude = set(os.path.abspath(d) for d in exclude or [])
+        if self.output_dir:
+            self.exclude.add(self.output_dir)
+
+        # When rendering into an output directory, only re-render
+        # templates if they, anything they depend on, or the context
+        # have changed since the previous run.
+        self.incremental = incremental
+
+        # Time template discovery, compilation, and rendering, and
+        # return a RenderProfile from render()
+        self.profile = profile
+
+        # If we have a cache directory, Mako writes the Python modules
+        # it compiles templates into there, and reuses them on
+        # subsequent runs.
+        self.cache_dir = cache_dir
+        if cache_dir:
+            self.module_directory = os.path.join(cache_dir, 'templates')
+            module_filename = self._module_filename
+            # Likewise for HTML converted from Markdown
+            self.markdown_cache_dir = os.path.join(cache_dir, 'markdown')
+        else:
+            self.module_directory = None
+            self.markdown_cache_dir = None
+            module_filename = None
+
+        # Several instances (rendering different runs of the same
+        # course) may share a lookup, and thus compiled templates.
+        self.lookup = lookup or _RecordingLookup(
+            directories=[os.path.join(self.source_dir, d)
+                         for d in self.LOOKUP_DIRS],
             imports=self.IMPORTS,
             default_filters=self.DEFAULT_FILTERS,
             input_encoding='utf-8',
+            module_directory=self.module_directory,
+            modulename_callable=module_filename,
         )
 
-        # Add custom module directories to python path
-        cwd = os.getcwd()
-        for module_dir in self.MODULES_DIRS:
-            path = os.path.join(cwd, module_dir)
-            sys.path.append(path)
+        # Templates may import Python modules from these directories
+        # (see _ModuleFinder)
+        self.module_dirs = [os.path.join(self.source_dir, d)
+                            for d in self.MODULES_DIRS]
 
-    def render(self):
-        templates = ['course.xml']
-        for directory, filetype in self.OLX_DIRS:
-            templates.extend(self._find_templates(directory, filetype))
+    def render(self, jobs=1):
+        return self.render_many([self], jobs)
 
+    @classmethod
+    def render_many(cls, runs, jobs=1):
+        """Render several runs of the same course: OLXTemplates instances
+        that differ only in their context and output directory.
+
+        The runs share one pass of template discovery, and one pool
+        of worker processes.
+
+        If the runs are being profiled, return a RenderProfile."""
+        profile = RenderProfile() if runs[0].profile else None
+        templates = ['course.xml'] + runs[0]._find_templates(
+            profile.discovery if profile else None)
+
+        manifests = []
+        for run in runs:
+            manifest = None
+            if run.output_dir:
+                run._mirror_files(set(templates))
+                if run.incremental:
+                    manifest = _Manifest(run.output_dir, run.context,
+                                         run.source_dir)
+            manifests.append(manifest)
+
+        sources = [t for t in templates
+                   if cls._filetype(t) in cls.SOURCE_FILETYPES]
+        others = [t for t in templates
+                  if cls._filetype(t) not in cls.SOURCE_FILETYPES]
+
+        rendered = changed = 0
+        # Markdown cache statistics, from this process and from any
+        # worker processes
+        hits = -markdown_cache.hits
+        misses = -markdown_cache.misses
+        executor = None
         try:
-            self._render_templates(templates)
+            for batch in (sources, others):
+                # This must happen one batch at a time, as a template
+                # may depend on the output of the previous batch.
+                # Each work item is a run's index, and the templates
+                # to render for it.
+                work = []
+                for index, run in enumerate(runs):
+                    manifest = manifests[index]
+                    if manifest:
+                        run_batch = [t for t in batch
+                                     if not manifest.is_current(
+                                             t, run._output_path(t))]
+                    else:
+                        run_batch = batch
+                    if run_batch:
+                        work.append((index, run_batch))
+
+                if jobs > 1 and sum(len(t) for _, t in work) > 1:
+                    # Only start worker processes once there's more
+                    # than one template to render.
+                    if not executor:
+                        executor = ProcessPoolExecutor(
+                            max_workers=jobs,
+                            initializer=_init_worker,
+                            initargs=([(run.context, run._options())
+                                       for run in runs],))
+                    results = []
+                    for index, chunk_results, chunk_stats in \
+                            cls._render_parallel(executor, work, jobs):
+                        results.append((index, chunk_results))
+                        hits += chunk_stats[0]
+                        misses += chunk_stats[1]
+                else:
+                    results = [(index, runs[index]._render_checked(t))
+                               for index, t in work]
+
+                for index, run_results in results:
+                    for filename, written, dependencies, entry \
+                            in run_results:
+                        rendered += 1
+                        changed += written
+                        if manifests[index]:
+                            manifests[index].record(filename,
+                                                    dependencies)
+                        if profile:
+                            # Tell runs apart by their output directory
+                            profile.add_template(
+                                runs[index].output_dir
+                                if len(runs) > 1 else None,
+                                filename,
+                                entry)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        for manifest in manifests:
+            if manifest:
+                manifest.save()
+
+        if runs[0].module_directory:
+            prune_cache(runs[0].module_directory,
+                        cls.MODULE_CACHE_BYTES,
+                        cls.MODULE_CACHE_AGE)
+        if runs[0].markdown_cache_dir:
+            markdown_cache.prune(runs[0].markdown_cache_dir)
+
+        _module_finder.check_conflicts(runs[0].module_dirs)
+
+        logging.info("Rendered %d of %d templates, "
+                     "%d of which changed" % (rendered,
+                                              len(templates) * len(runs),
+                                              changed))
+        logging.info("Markdown cache: %d hits, "
+                     "%d misses" % (hits + markdown_cache.hits,
+                                    misses + markdown_cache.misses))
+        return profile
+
+    @staticmethod
+    def _render_parallel(executor, work, jobs):
+        # Hand out several small chunks per worker rather than one
+        # big one, so that a few expensive templates don't leave the
+        # other workers idle.
+        size = max(1, sum(len(t) for _, t in work) // (jobs * 4))
+        chunks = [(index, templates[i:i + size])
+                  for index, templates in work
+                  for i in range(0, len(templates), size)]
+        # Consuming the results also re-raises the first exception
+        # raised in a worker.
+        return [(index,) + result
+                for (index, _), result in zip(chunks,
+                                              executor.map(_render_worker,
+                                                           chunks))]
+
+    def _options(self):
+        # Constructor arguments (other than the context) for the
+        # OLXTemplates instances in worker processes
+        return {
+            'cache_dir': self.cache_dir,
+            'output_dir': self.output_dir,
+            'source_dir': self.source_dir,
+            'incremental': self.incremental,
+            'profile': self.profile,
+            'exclude': sorted(self.exclude),
+        }
+
+    def _render_checked(self, templates):
+        try:
+            return self._render_templates(templates)
         except:  # noqa: E722
+            # Mako's error template renders the traceback that is
+            # currently being handled, so this must happen in the
+            # process that raised it. The resulting message, unlike
+            # the traceback, can be passed back from a worker process.
             message = exceptions.text_error_template().render()
             raise OLXTemplateException(message)
 
-    def _find_templates(self, directory, filetype):
-        matches = []
-        for root, dirnames, filenames in os.walk(directory):
-            for filename in fnmatch.filter(filenames, '*.' + filetype):
-                matches.append(os.path.join(root, filename))
-        return matches
+    def _module_filename(self, filename, uri):
+        # Key compiled modules not only by the template's path, but
+        # also by its modification time and by everything that goes
+        # into compiling it, so that a stale module is never picked
+        # up (even if the template's mtime went backwards, as it does
+        # on a git checkout).
+        stat = os.stat(filename)
+        key = '\0'.join([
+            os.path.abspath(filename),
+            str(stat.st_mtime_ns),
+            __version__,
+        ] + self.IMPORTS + self.DEFAULT_FILTERS)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        module_filename = os.path.join(self.module_directory,
+                                       digest[:2],
+                                       digest + '.py')
+        # Mako is about to load the module (and Python its bytecode),
+        # if it's there, so keep them from being pruned.
+        mark_used(module_filename)
+        mark_used(cache_from_source(module_filename))
+        return module_filename
 
-    def _render_templates(self, templates):
-        for filename in templates:
+    def _get_template(self, filename, stat):
+        """Return the compiled template for filename, reusing the one
+        compiled previously if the file hasn't changed since."""
+        path = self._source_path(filename)
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self.lookup.course_templates.get(path)
+        if cached and cached[:2] == key:
+            return cached[2]
+
+        if self.module_directory:
+            module_filename = self._module_filename(path, filename)
+        else:
+            module_filename = None
+        with _compile_lock:
             template = Template(
-                filename=filename,
+                filename=path,
+                # Relative to the course root, so that templates find
+                # the templates they include or inherit from relative to
+                # them in the lookup directories
+                uri=filename,
                 lookup=self.lookup,
                 imports=self.IMPORTS,
                 default_filters=self.DEFAULT_FILTERS,
                 input_encoding='utf-8',
+                module_filename=module_filename,
             )
-            context = self.context.copy()
-            basename = os.path.basename(filename)
-            stripped = os.path.splitext(basename)[0]
-            context['filename'] = stripped
-            rendered = template.render_unicode(**context)
-
-            # Remove symlink
-            if os.path.islink(filename):
-                os.unlink(filename)
-
-            with codecs.open(filename, 'w', 'utf-8') as f:
-                f.write(rendered)
+        self.lookup.course_templates[path] = key + (template,)
+        return template
+
+    @staticmethod
+    def _filetype(filename):
+        return os.path.splitext(filename)[1][1:]
+
+    def _source_path(self, filename):
+        return os.path.join(self.source_dir, filename)
+
+    def _output_path(self, filename):
+        return os.path.join(self.output_dir or self.source_dir, filename)
+
+    def _mirror_files(self, templates):
+        """Copy all files that aren't templates to the output directory,
+        unless they are already there."""
+        # Don't recurse into any output directory inside the source
+        # tree: our own, any excluded one, or one that has a manifest
+        # from an earlier render (of another run, say).
+        for root, dirnames, filenames in os.walk(self.source_dir):
+            dirnames[:] = [d for d in dirnames
+                           if d not in self.IGNORE_DIRS and
+                           not self._is_output_dir(os.path.join(root, d))]
+            for filename in filenames:
+                source = os.path.join(root, filename)
+                path = os.path.relpath(source, self.source_dir)
+                if path not in templates:
+                    self._mirror_file(source, self._output_path(path))
+
+    def _is_output_dir(self, path):
+        return path in self.exclude or os.path.exists(
+            os.path.join(path, _Manifest.FILENAME))
+
+    def _mirror_file(self, source, dest):
+        if os.path.islink(source):
+            target = os.readlink(source)
+            if os.path.islink(dest) and os.readlink(dest) == target:
+                return
+            self._replace(dest, lambda tmp: os.symlink(target, tmp))
+            logging.debug("Linked %s" % dest)
+            return
+
+        # Copies retain the modification time of their source, so a
+        # file whose size and modification time match is up to date.
+        if not os.path.islink(dest):
+            try:
+                source_stat = os.stat(source)
+                dest_stat = os.stat(dest)
+                if (source_stat.st_size == dest_stat.st_size and
+                        source_stat.st_mtime_ns == dest_stat.st_mtime_ns):
+                    return
+            except OSError:
+                pass
+        self._replace(dest, lambda tmp: shutil.copy2(source, tmp))
+        logging.debug("Copied %s" % dest)
+
+    @classmethod
+    def _write(cls, filename, data, mode):
+        """Write data to filename, unless that file already has exactly
+        that content. Return whether the file was written."""
+        if not os.path.islink(filename):
+            try:
+                if os.path.getsize(filename) == len(data):
+                    with open(filename, 'rb') as f:
+                        if f.read() == data:
+                            return False
+            except OSError:
+                pass
+
+        def write(tmp):
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, mode)
+        cls._replace(filename, write)
+        return True
+
+    @staticmethod
+    def _replace(filename, create):
+        """Atomically replace filename (which may or may not exist) with
+        a file that create() creates under a temporary name."""
+        dirname = os.path.dirname(filename) or '.'
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        # Grab a unique name in the same directory (and hence on the
+        # same filesystem), and let create() put its file there.
+        fd, tmp = tempfile.mkstemp(dir=dirname,
+                                   prefix='.%s.' % os.path.basename(filename))
+        os.close(fd)
+        os.unlink(tmp)
+        try:
+            create(tmp)
+            # This also replaces a symlink with the new file, rather
+            # than writing to the symlink's target.
+            os.replace(tmp, filename)
+        except:  # noqa: E722
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _find_templates(self, timings=None):
+        """Find all templates in one pass over the course tree.
+
+        If given a timings dictionary, record the time spent scanning
+        each directory in it."""
+        templates = []
+        # Directories to scan, each along with the file types it
+        # (inclusive of its parent directories) holds templates of
+        pending = [('', frozenset())]
+        while pending:
+            directory, filetypes = pending.pop()
+            if timings is not None:
+                start = time.perf_counter()
+            try:
+                entries = list(os.scandir(self._source_path(directory)))
+            except OSError:
+                continue
+            for entry in entries:
+                path = os.path.join(directory, entry.name)
+                if self.ignore_re and self.ignore_re.match(path):
+                    continue
+                # Like os.walk(), only follow symlinks to directories
+                # that we have been told to look into.
+                if entry.is_dir(follow_symlinks=False) or (
+                        (path in self.filetypes or
+                         path in self.parent_dirs) and entry.is_dir()):
+                    subdir_filetypes = filetypes.union(
+                        self.filetypes.get(path, ()))
+                    if subdir_filetypes or path in self.parent_dirs:
+                        pending.append((path, subdir_filetypes))
+                elif filetypes:
+                    filetype = entry.name.rpartition('.')[2]
+                    if filetype in filetypes and '.' in entry.name:
+                        templates.append(path)
+            if timings is not None:
+                timings[directory or '.'] = time.perf_counter() - start
+        return sorted(templates)
+
+    def _render_templates(self, templates):
+        """Render templates, returning a (filename, written, dependencies,
+        profile) tuple for each.
+
+        The profile is None, unless we are profiling."""
+        # Make files the templates read in via olx_helpers resolve
+        # against the tree we render into.
+        render_state.root = self.output_dir or self.source_dir
+        render_state.markdown_cache_dir = self.markdown_cache_dir
+        render_state.module_dirs = self.module_dirs
+        try:
+            return [self._render_template(filename)
+                    for filename in templates]
+        finally:
+            render_state.root = None
+            render_state.module_dirs = None
+            render_state.dependencies = None
+            render_state.markdown_cache_dir = None
+            render_state.swift_signer = None
+            render_state.profile = None
+
+    def _render_template(self, filename):
+        if self.profile:
+            start = time.perf_counter()
+        stat = os.stat(self._source_path(filename))
+        template = self._get_template(filename, stat)
+        context = self.context.copy()
+        basename = os.path.basename(filename)
+        stripped = os.path.splitext(basename)[0]
+        context['filename'] = stripped
+        # Collect the files the template pulls in while rendering:
+        # other templates via the lookup, and files read by helpers.
+        render_state.dependencies = set()
+        if self.profile:
+            compiled = time.perf_counter()
+            render_state.profile = {}
+        rendered = template.render_unicode(**context)
+        dependencies = sorted(render_state.dependencies)
+        data = rendered.encode('utf-8')
+        if self.profile:
+            entry = {
+                'compile': compiled - start,
+                'render': time.perf_counter() - compiled,
+                'bytes': len(data),
+                'helpers': render_state.profile,
+            }
+            render_state.profile = None
+        else:
+            entry = None
+
+        # Give the output file the permissions of the template (or,
+        # if the template is a symlink, of its target).
+        mode = stat.st_mode & 0o7777
+        output = self._output_path(filename)
+        written = self._write(output, data, mode)
+        if written:
+            logging.debug("Rendered %s" % output)
+        else:
+            logging.debug("Unchanged: %s" % output)
+        return (filename, written, dependencies, entry)
+
+
+def run_context(name, start_date, end_date, suffix=None, public=False):
+    """Return the context to render the templates of a course run
+    with. The run ends at the very end of end_date."""
+    return {
+        "run_name": name,
+        "start_date": start_date,
+        "end_date": end_date.replace(hour=23,
+                                     minute=59,
+                                     second=59),
+        "run_suffix": suffix,
+        "is_public": public,
+    }
+
+
+def link_policies(name, directory=None):
+    """Make the course run's policies (in directory, or the current
+    directory) those of the _base run."""
+    link = os.path.join(directory or '',
+                        'policies/{}'.format(name))
+    # An output directory may already have it from a previous run
+    if directory and os.path.islink(link):
+        if os.readlink(link) == '_base':
+            return
+        os.unlink(link)
+    os.symlink('_base', link)
+
+
+def render_course(source_dir,
+                  output_dir,
+                  name,
+                  start_date,
+                  end_date,
+                  suffix=None,
+                  public=False,
+                  jobs=1,
+                  cache_dir=None,
+                  force=False,
+                  ignore=None,
+                  lookup=None,
+                  profile=False):
+    """Render a run of the course in source_dir into output_dir (or in
+    place, if output_dir is None), like "olx new-run" does.
+
+    This neither depends on nor changes the current working directory
+    or the module search path, so a thread pool may render several
+    courses at once. To reuse compiled templates from one call to the
+    next, pass in the lookup of an OLXTemplates instance for the same
+    source_dir.
+
+    Return a RenderProfile if profiling, and None otherwise."""
+    templates = OLXTemplates(run_context(name,
+                                         start_date,
+                                         end_date,
+                                         suffix,
+                                         public),
+                             cache_dir=cache_dir,
+                             output_dir=output_dir,
+                             incremental=not force,
+                             ignore=ignore,
+                             lookup=lookup,
+                             profile=profile,
+                             source_dir=source_dir)
+    report = templates.render(jobs)
+    link_policies(name, templates.output_dir or templates.source_dir)
+    return report
+
+
+class _RecordingLookup(TemplateLookup):
+    """A TemplateLookup that records every template it hands out as a
+    dependency of the template being rendered.
+
+    It also holds on to the course's own templates once compiled, so
+    that rendering them again (for another run, or after something
+    else changed) doesn't compile or load them again."""
+
+    def __init__(self, *args, **kwargs):
+        super(_RecordingLookup, self).__init__(*args, **kwargs)
+        # (size, mtime, Template) by filename
+        self.course_templates = {}
+
+    def get_template(self, uri):
+        with _compile_lock:
+            template = super(_RecordingLookup, self).get_template(uri)
+        render_state.record(template.filename)
+        return template
+
+
+class _ModuleFinder(MetaPathFinder):
+    """Finds the Python modules that templates import in the module
+    directories of the course being rendered in the current thread
+    (rather than having those directories on sys.path)."""
+
+    def __init__(self):
+        # Where we found each module, by name
+        self.origins = {}
+        # The (module name, module directories) we warned about
+        self.warned = set()
+
+    def find_spec(self, fullname, path, target=None):
+        # Submodules are found via their package's __path__.
+        if path is not None or not render_state.module_dirs:
+            return None
+        spec = PathFinder.find_spec(fullname, render_state.module_dirs)
+        if spec and spec.origin:
+            self.origins[fullname] = spec.origin
+        return spec
+
+    def check_conflicts(self, module_dirs):
+        """Warn about modules in module_dirs that templates can't
+        import, because a module of the same name has already been
+        imported from another course's module directories.
+
+        (Once imported, a module is shared by the whole process.)"""
+        for name, origin in list(self.origins.items()):
+            if (name not in sys.modules or
+                    (name, tuple(module_dirs)) in self.warned or
+                    any(origin.startswith(os.path.join(d, ''))
+                        for d in module_dirs)):
+                continue
+            spec = PathFinder.find_spec(name, module_dirs)
+            if spec:
+                self.warned.add((name, tuple(module_dirs)))
+                logging.warning("Templates importing %s get %s, "
+                                "rather than %s" % (name,
+                                                    origin,
+                                                    spec.origin))
+
+
+# Like directories appended to sys.path, this comes after all the
+# usual places to find modules.
+_module_finder = _ModuleFinder()
+sys.meta_path.append(_module_finder)
+
+
+class _Manifest(object):
+    """
+    Record of a render into an output directory: the files each
+    template depended on, and digests of those files.
+
+    """
+    FILENAME = '.olx-manifest.json'
+
+    def __init__(self, output_dir, context, source_dir):
+        self.path = os.path.join(output_dir, self.FILENAME)
+        # Templates are relative to this directory
+        self.source_dir = source_dir
+
+        # A manifest is only any use if it was written by the same
+        # olx-utils version, rendering with the same context.
+        key = json.dumps([__version__, context],
+                         sort_keys=True,
+                         default=str)
+        self.key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        self.previous_files = {}
+        self.previous_templates = {}
+        try:
+            with open(self.path) as f:
+                previous = json.load(f)
+            if previous['key'] == self.key:
+                self.previous_files = previous['files']
+                self.previous_templates = previous['templates']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # The [size, mtime, digest] of every file we have looked at
+        self.files = {}
+        # The dependencies of every template we have seen
+        self.templates = {}
+
+    def digest(self, path):
+        if path not in self.files:
+            filename = os.path.join(self.source_dir, path)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                return None
+            # Don't bother reading a file whose size and mtime are
+            # the same as last time.
+            previous = self.previous_files.get(path)
+            if (previous and previous[0] == stat.st_size and
+                    previous[1] == stat.st_mtime_ns):
+                digest = previous[2]
+            else:
+                with open(filename, 'rb') as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return self.files[path][2]
+
+    def is_current(self, template, output):
+        dependencies = self.previous_templates.get(template)
+        if dependencies is None or not os.path.exists(output):
+            return False
+        for path in [template] + dependencies:
+            previous = self.previous_files.get(path)
+            if not previous or self.digest(path) != previous[2]:
+                return False
+        self.templates[template] = dependencies
+        return True
+
+    def record(self, template, dependencies):
+        self.templates[template] = dependencies
+        for path in [template] + dependencies:
+            self.digest(path)
+
+    def save(self):
+        paths = set(self.templates)
+        for dependencies in self.templates.values():
+            paths.update(dependencies)
+        manifest = {
+            'key': self.key,
+            'files': dict((p, self.files[p]) for p in paths
+                          if p in self.files),
+            'templates': self.templates,
+        }
+        data = json.dumps(manifest, indent=1, sort_keys=True)
+        OLXTemplates._write(self.path, data.encode('utf-8'), 0o644)
+
+
+# The OLXTemplates instances (one per run) used by a rendering worker
+# process, set up by _init_worker() when the process starts
+_worker_runs = []
+
+
+def _init_worker(runs):
+    global _worker_runs
+    _worker_runs = []
+    lookup = None
+    for context, options in runs:
+        run = OLXTemplates(context, lookup=lookup, **options)
+        lookup = run.lookup
+        _worker_runs.append(run)
+
+
+def _render_worker(chunk):
+    """Render a chunk of templates for one run, returning the results
+    and this process's Markdown cache (hits, misses) while doing so."""
+    index, templates = chunk
+    hits, misses = markdown_cache.hits, markdown_cache.misses
+    results = _worker_runs[index]._render_checked(templates)
+    return (results, (markdown_cache.hits - hits,
+                      markdown_cache.misses - misses))
@@ -2,7 +2,7 @@ from __future__ import unicode_literals
 
 import logging
 
-import requests
+from olxutils.client import default_client
 
 
 class TokenHelperException(Exception):
@@ -13,10 +13,11 @@ class TokenHelper(object):
 
     TOKEN_URL_FORMAT = '%s/oauth2/access_token'
 
-    def __init__(self, url, client_id, client_secret):
+    def __init__(self, url, client_id, client_secret, client=None):
         self.token_url = self.TOKEN_URL_FORMAT % url
         self.client_id = client_id
         self.client_secret = client_secret
+        self.client = client or default_client()
 
     def fetch_token(self):
         if not self.client_id:
@@ -29,8 +30,8 @@ class TokenHelper(object):
             'client_id': self.client_id,
             'client_secret': self.client_secret,
         }
-        r = requests.post(self.token_url,
-                          data=request_data)
+        r = self.client.post(self.token_url,
+                             data=request_data)
         # Raise an HTTPError if we didn't get an OK response
         r.raise_for_status()
         logging.debug("Request took %s to complete" % r.elapsed)
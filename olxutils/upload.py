@@ -1,13 +1,19 @@
 from __future__ import unicode_literals
 
+import os
+import sys
+import functools
 import logging
+import random
 import re
 import tarfile
 import time
+import uuid
 
-import requests
 import xmltodict
 
+from olxutils.client import default_client
+
 
 class UploadHelperException(Exception):
     pass
@@ -17,10 +23,35 @@ class UploadHelper(object):
 
     UPLOAD_URL_FORMAT = '%s/api/courses/v0/import/%s/'
 
-    def __init__(self, url, archive, token=None, course_id=None):
+    # When waiting for an import to complete, poll for its state after
+    # POLL_INTERVAL seconds, and then back off by POLL_BACKOFF times
+    # the interval, up to POLL_MAX_INTERVAL. Each interval is
+    # lengthened or shortened by up to POLL_JITTER of it, at random, so
+    # that many uploads started at once don't poll in lockstep.
+    POLL_INTERVAL = 1.0
+    POLL_BACKOFF = 1.5
+    POLL_MAX_INTERVAL = 30.0
+    POLL_JITTER = 0.2
+
+    # Read archives to upload in chunks of this size
+    CHUNKSIZE = 1024 * 1024
+
+    def __init__(self, url, archive, token=None, course_id=None,
+                 client=None, timeout=None, poll_interval=POLL_INTERVAL,
+                 poll_max_interval=POLL_MAX_INTERVAL,
+                 progress_interval=None):
         self.url = url
         self.archive = archive
         self.token = token
+        self.client = client or default_client()
+        # How long to wait for an import to complete, in seconds (or
+        # forever)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.poll_max_interval = max(poll_max_interval, poll_interval)
+        # How often to report upload progress on stderr, in seconds
+        # (or never)
+        self.progress_interval = progress_interval
         if course_id:
             self.course_id = course_id
         else:
@@ -62,28 +93,88 @@ class UploadHelper(object):
                     raise UploadHelperException(msg)
 
                 coursexml = tf.extractfile(match_members[0])
-                course = xmltodict.parse(coursexml.read())['course']
-                course_id = 'course-v1:%s+%s+%s' % (course['@org'],
-                                                    course['@course'],
-                                                    course['@url_name'])
+                course_id = self.course_id_from_xml(coursexml.read())
         except Exception as e:
             msg = "Unable to determine course ID from archive: %s" % e
             raise UploadHelperException(msg)
 
         return course_id
 
+    @staticmethod
+    def course_id_from_xml(data):
+        """Return the course ID defined by the content of a course.xml
+        file."""
+        course = xmltodict.parse(data)['course']
+        return 'course-v1:%s+%s+%s' % (course['@org'],
+                                       course['@course'],
+                                       course['@url_name'])
+
     def upload(self, wait=False):
-        request_headers = {
+        """Upload the archive, streaming it from disk in chunks of
+        CHUNKSIZE bytes."""
+        boundary = uuid.uuid4().hex
+        with open(self.archive, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            chunks = iter(functools.partial(f.read, self.CHUNKSIZE), b'')
+            body = self._multipart(boundary,
+                                   self._progress(chunks, size))
+            r = self.client.post(self.upload_url,
+                                 data=_SizedBody(body,
+                                                 self._multipart_size(
+                                                     boundary, size)),
+                                 headers=self._multipart_headers(boundary))
+        return self._uploaded(r, wait)
+
+    def upload_stream(self, chunks, wait=False):
+        """Upload an archive while it is being created, as an iterable
+        of chunks of bytes, in a chunked request body."""
+        boundary = uuid.uuid4().hex
+        r = self.client.post(self.upload_url,
+                             data=self._multipart(boundary,
+                                                  self._progress(chunks)),
+                             headers=self._multipart_headers(boundary))
+        return self._uploaded(r, wait)
+
+    def _multipart_headers(self, boundary):
+        return {
             'Authorization': 'JWT %s' % self.token,
+            'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
         }
-        request_files = {
-            'course_data': (self.archive,
-                            open(self.archive, 'rb')),
-        }
-        r = requests.post(self.upload_url,
-                          files=request_files,
-                          headers=request_headers)
 
+    def _multipart_parts(self, boundary):
+        # The same form requests builds from a file, before and after
+        # its content
+        filename = self.archive.replace('"', '%22')
+        return (('--%s\r\n'
+                 'Content-Disposition: form-data; name="course_data"; '
+                 'filename="%s"\r\n'
+                 '\r\n' % (boundary, filename)).encode('utf-8'),
+                ('\r\n--%s--\r\n' % boundary).encode('utf-8'))
+
+    def _multipart_size(self, boundary, size):
+        return size + sum(len(part)
+                          for part in self._multipart_parts(boundary))
+
+    def _multipart(self, boundary, chunks):
+        head, tail = self._multipart_parts(boundary)
+        yield head
+        for chunk in chunks:
+            yield chunk
+        yield tail
+
+    def _progress(self, chunks, size=None):
+        """Pass chunks through, reporting how many bytes went by, and
+        how fast, every progress_interval seconds."""
+        if not self.progress_interval:
+            yield from chunks
+            return
+        progress = _Progress(self.archive, size, self.progress_interval)
+        for chunk in chunks:
+            yield chunk
+            progress.update(len(chunk))
+        progress.done()
+
+    def _uploaded(self, r, wait):
         logging.debug("Request took %s to complete" % r.elapsed)
         # Raise an HTTPError if we didn't get an OK response
         r.raise_for_status()
@@ -94,23 +185,58 @@ class UploadHelper(object):
         self.task_id = json_result['task_id']
 
         if wait:
-            while True:
-                task_state = self.fetch_upload_task_state()
-                if task_state == 'Succeeded':
-                    logging.info('Course upload to %s '
-                                 'from %s succeeded.' % (self.course_id,
-                                                         self.archive))
-                    break
-                elif task_state == 'Failed':
-                    msg = ('Course upload to %s '
-                           'from %s failed') % (self.course_id,
-                                                self.archive)
-                    raise UploadHelperException(msg)
-                else:
-                    time.sleep(1)
+            elapsed, polls = self.wait_for_task()
+            logging.info('Course upload to %s from %s succeeded after '
+                         '%.1f seconds (%d polls).' % (self.course_id,
+                                                       self.archive,
+                                                       elapsed,
+                                                       polls))
         else:
             return self.task_id
 
+    def wait_for_task(self, task_id=None):
+        """Poll for the state of an import task until it succeeds, and
+        return how many seconds that took, and how many polls.
+
+        Raise an UploadHelperException if the task fails, or doesn't
+        complete within the timeout."""
+        start = time.monotonic()
+        interval = self.poll_interval
+        polls = 0
+        while True:
+            task_state = self.fetch_upload_task_state(task_id)
+            polls += 1
+            elapsed = time.monotonic() - start
+            logging.debug("Task state after %.1f seconds (%d polls): %s" %
+                          (elapsed, polls, task_state))
+            if task_state == 'Succeeded':
+                return elapsed, polls
+            elif task_state == 'Failed':
+                msg = ('Course upload to %s from %s failed after %.1f '
+                       'seconds (%d polls)') % (self.course_id,
+                                                self.archive,
+                                                elapsed,
+                                                polls)
+                raise UploadHelperException(msg)
+
+            delay = interval * random.uniform(1 - self.POLL_JITTER,
+                                              1 + self.POLL_JITTER)
+            if self.timeout is not None:
+                remaining = self.timeout - elapsed
+                if remaining <= 0:
+                    msg = ('Course upload to %s from %s did not complete '
+                           'within %s seconds (%d polls)') % (
+                               self.course_id,
+                               self.archive,
+                               self.timeout,
+                               polls)
+                    raise UploadHelperException(msg)
+                # Poll once more when the time is up.
+                delay = min(delay, remaining)
+            time.sleep(delay)
+            interval = min(interval * self.POLL_BACKOFF,
+                           self.poll_max_interval)
+
     def fetch_upload_task_state(self, task_id=None):
         request_headers = {
             'Authorization': 'JWT %s' % self.token,
@@ -119,9 +245,9 @@ class UploadHelper(object):
             'task_id': task_id or self.task_id,
             'filename': self.archive,
         }
-        r = requests.get(self.upload_url,
-                         params=request_params,
-                         headers=request_headers)
+        r = self.client.get(self.upload_url,
+                            params=request_params,
+                            headers=request_headers)
         logging.debug("Request took %s to complete" % r.elapsed)
         # Raise an HTTPError if we didn't get an OK response
         r.raise_for_status()
@@ -130,3 +256,53 @@ class UploadHelper(object):
         logging.debug("Request returned JSON result %s" % json_result)
 
         return json_result['state']
+
+
+class _SizedBody(object):
+    """An iterable request body of a known size, which requests sends
+    with a Content-Length, rather than in chunks."""
+
+    def __init__(self, chunks, size):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        return self.size
+
+
+class _Progress(object):
+    """Reports the progress of an upload on stderr."""
+
+    def __init__(self, name, size, interval, stream=None):
+        self.name = name
+        self.size = size
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.bytes = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, count):
+        self.bytes += count
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report(now)
+
+    def done(self):
+        self.report(time.monotonic())
+
+    def report(self, now):
+        mb = self.bytes / 1e6
+        rate = mb / max(now - self.start, 1e-6)
+        if self.size:
+            message = "Uploaded %.1f of %.1f MB of %s (%d%%), %.1f MB/s" % (
+                mb, self.size / 1e6, self.name,
+                100 * self.bytes // self.size, rate)
+        else:
+            message = "Uploaded %.1f MB of %s, %.1f MB/s" % (
+                mb, self.name, rate)
+        self.stream.write(message + '\n')
+        self.stream.flush()
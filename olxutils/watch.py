@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import errno
+import select
+import shutil
+import struct
+import logging
+import time
+
+import ctypes
+import ctypes.util
+
+from olxutils.templates import OLXTemplateException
+
+
+class PollingWatcher(object):
+    """
+    Watches a directory tree for changes, by comparing the size and
+    modification time of every file in it at regular intervals.
+
+    """
+    INTERVAL = 0.5
+
+    def __init__(self, root='.', exclude=None, interval=INTERVAL):
+        self.root = root
+        # Paths (relative to root) of directories not to watch
+        self.exclude = set(os.path.normpath(p) for p in exclude or [])
+        self.interval = interval
+        self.files = self._snapshot()
+
+    def wait(self, timeout=None):
+        """Wait for changes, for up to timeout seconds (or forever), and
+        return the paths (relative to root) of files that changed."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+            files = self._snapshot()
+            changed = set(path for path in set(files) | set(self.files)
+                          if files.get(path) != self.files.get(path))
+            self.files = files
+            if changed or (deadline is not None and
+                           time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+    def _snapshot(self):
+        files = {}
+        for root, dirnames, filenames in os.walk(self.root):
+            relroot = os.path.relpath(root, self.root)
+            dirnames[:] = [d for d in dirnames
+                           if os.path.normpath(os.path.join(relroot, d))
+                           not in self.exclude]
+            for filename in filenames:
+                path = os.path.normpath(os.path.join(relroot, filename))
+                try:
+                    stat = os.lstat(os.path.join(root, filename))
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+
+class InotifyWatcher(object):
+    """
+    Watches a directory tree for changes, via the Linux inotify API.
+
+    Raises OSError if inotify is unavailable.
+
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    # struct inotify_event, followed by a name of len bytes
+    EVENT = struct.Struct('iIII')
+
+    # Editors tend to save a file in several steps, so once something
+    # changed, wait until no more events arrive for this long.
+    SETTLE = 0.1
+
+    def __init__(self, root='.', exclude=None):
+        self.root = root
+        self.exclude = set(os.path.normpath(p) for p in exclude or [])
+
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._add_watch.argtypes = [ctypes.c_int,
+                                    ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = init(self.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        # Watched directories (relative to root) by watch descriptor
+        self.directories = {}
+        self._watch_tree('.')
+
+    def wait(self, timeout=None):
+        """Wait for changes, for up to timeout seconds (or forever), and
+        return the paths (relative to root) of files that changed."""
+        changed = set()
+        if select.select([self.fd], [], [], timeout)[0]:
+            changed.update(self._read())
+            while select.select([self.fd], [], [], self.SETTLE)[0]:
+                changed.update(self._read())
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _watch_tree(self, directory):
+        """Watch directory and everything below it, returning all files
+        in it."""
+        files = set()
+        for root, dirnames, filenames in os.walk(
+                os.path.join(self.root, directory)):
+            relroot = os.path.normpath(os.path.relpath(root, self.root))
+            dirnames[:] = [d for d in dirnames
+                           if os.path.normpath(os.path.join(relroot, d))
+                           not in self.exclude]
+            wd = self._add_watch(self.fd,
+                                 os.fsencode(root),
+                                 self.MASK)
+            if wd < 0:
+                # Most likely, the directory has been removed already
+                logging.debug("Can't watch %s: %s" % (
+                    root, os.strerror(ctypes.get_errno())))
+                continue
+            self.directories[wd] = relroot
+            files.update(os.path.normpath(os.path.join(relroot, f))
+                         for f in filenames)
+        return files
+
+    def _read(self):
+        changed = set()
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                # We lost track of what changed, so report the
+                # whole tree
+                logging.debug("inotify event queue overflowed")
+                changed.add('.')
+                continue
+            if mask & self.IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.normpath(os.path.join(directory,
+                                                 os.fsdecode(name)))
+            if path in self.exclude:
+                continue
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                                                self.IN_MOVED_TO):
+                # Watch the new directory, and everything that
+                # showed up in it before we did.
+                changed.update(self._watch_tree(path))
+            else:
+                changed.add(path)
+        return changed
+
+
+def create_watcher(root='.', exclude=None):
+    """Return an InotifyWatcher if we can, and a PollingWatcher
+    otherwise."""
+    try:
+        return InotifyWatcher(root, exclude)
+    except OSError as e:
+        logging.info("Can't use inotify (%s), "
+                     "polling for changes instead" % e)
+        return PollingWatcher(root, exclude)
+
+
+def watch(templates, watcher=None, stop=None):
+    """Re-render templates (an OLXTemplates instance rendering into an
+    output directory) whenever something in its source tree changes.
+
+    This happens in this process, where compiled templates and
+    converted Markdown stay in memory from one render to the next.
+
+    Stop once stop (a threading.Event) is set, if given."""
+    if watcher is None:
+        # Don't watch the output directory (or any excluded one), if
+        # it's in the source tree.
+        exclude = templates.IGNORE_DIRS + [
+            os.path.relpath(d, templates.source_dir)
+            for d in sorted(templates.exclude)]
+        watcher = create_watcher(templates.source_dir, exclude)
+    logging.info("Watching for changes")
+    try:
+        while not (stop and stop.is_set()):
+            changed = watcher.wait(timeout=0.5 if stop else None)
+            if not changed:
+                continue
+            logging.info("Changed: %s" % ', '.join(sorted(changed)))
+            for path in changed:
+                # Files deleted from the source tree go away from the
+                # output directory as well.
+                output = templates._output_path(path)
+                if (os.path.lexists(templates._source_path(path)) or
+                        not os.path.lexists(output)):
+                    continue
+                if os.path.isdir(output) and not os.path.islink(output):
+                    shutil.rmtree(output)
+                else:
+                    os.unlink(output)
+                logging.debug("Removed %s" % output)
+            try:
+                # Only templates that are affected by what changed
+                # (including those that depend on a changed partial)
+                # are re-rendered.
+                templates.render()
+            except (OLXTemplateException, OSError) as e:
+                # Keep watching, so the next change can fix this.
+                logging.error("Failed to render templates:\n%s" % e)
+    finally:
+        watcher.close()
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from benchmarks.importtime import measure
+from benchmarks.pipeline import run_benchmarks
+
+from unittest import TestCase
+
+
+class PipelineBenchmarkTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(self.tmpdir,
+                                 repeat=2,
+                                 chapters=1,
+                                 sequentials=2,
+                                 verticals=2,
+                                 static_files=1,
+                                 static_size=16)
+        self.assertEqual(set(results['timings']),
+                         set(['discovery',
+                              'render_cold',
+                              'render_warm',
+                              'render_noop',
+                              'make_archive',
+                              'make_archive_copy',
+                              'make_archive_threads',
+                              'course_id_from_archive',
+                              'upload',
+                              'publish']))
+        for timing in results['timings'].values():
+            self.assertEqual(len(timing['runs']), 2)
+            self.assertLessEqual(timing['min'], timing['median'])
+
+        # The synthetic course renders to a complete course
+        output = os.path.join(self.tmpdir, 'output')
+        with open(os.path.join(output, 'course.xml')) as f:
+            self.assertIn('<chapter url_name="chapter_01"/>', f.read())
+        with open(os.path.join(output,
+                               'html',
+                               'chapter_01_sequential_02_unit_02.html')) as f:
+            self.assertIn('<h1>chapter 01 sequential 02 unit 02</h1>',
+                          f.read())
+        self.assertTrue(os.path.islink(os.path.join(output,
+                                                    'policies',
+                                                    'synth')))
+        self.assertGreater(results['archive_bytes'], 0)
+        io = results['archive_io']
+        if io['make_archive']:
+            # Not copying files first saves writing them out once
+            self.assertLess(io['make_archive']['written'],
+                            io['make_archive_copy']['written'])
+
+
+class ImportTimeBenchmarkTestCase(TestCase):
+
+    def test_measure(self):
+        results = measure('olxutils.cli', repeat=1)
+        self.assertGreater(results['time'], 0)
+        self.assertIn('olxutils.cli',
+                      [entry['module'] for entry in results['slowest']])
+        self.assertEqual(results['heavy'], [])
@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from olxutils.archive import ArchiveCache
+from olxutils.cache import PRUNED, mark_used, prune_cache
+
+from unittest import TestCase
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class PruneCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        now = time.time()
+        # Files of 100 bytes, one of them a day old, and each of the
+        # others an hour older than the one before
+        self.files = []
+        for i, age in enumerate([3600, 7200, 10800, 14400, 86400]):
+            path = os.path.join(self.tmpdir, '%02d' % i, 'module.py')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (now - age, now - age))
+            self.files.append(path)
+
+    def remaining(self):
+        return [path for path in self.files if os.path.exists(path)]
+
+    def test_size(self):
+        prune_cache(self.tmpdir, 250, 7 * 86400)
+        self.assertEqual(self.remaining(), self.files[:2])
+
+    def test_age(self):
+        prune_cache(self.tmpdir, 1024, 43200)
+        self.assertEqual(self.remaining(), self.files[:4])
+
+    def test_mark_used(self):
+        mtime = os.stat(self.files[4]).st_mtime
+        mark_used(self.files[4])
+        self.assertEqual(os.stat(self.files[4]).st_mtime, mtime)
+        # The oldest file, used just now, is kept, and the least
+        # recently used one goes.
+        prune_cache(self.tmpdir, 450, 43200)
+        self.assertEqual(self.remaining(),
+                         self.files[:3] + self.files[4:])
+
+    def test_interval(self):
+        prune_cache(self.tmpdir, 1024, 7 * 86400)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, PRUNED)))
+        # Pruned just now, so not again
+        prune_cache(self.tmpdir, 0, 0)
+        self.assertEqual(self.remaining(), self.files)
+
+    def test_missing_directory(self):
+        prune_cache(os.path.join(self.tmpdir, 'missing'), 0, 0)
+        self.assertEqual(self.remaining(), self.files)
+
+
+class ArchiveCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.cache = ArchiveCache(os.path.join(self.tmpdir, 'cache'))
+
+    def entries(self, course, names):
+        entries = []
+        for name in names:
+            path = os.path.join(self.tmpdir, course, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+            entries.append((path, name))
+        return entries
+
+    def files(self):
+        with open(os.path.join(self.cache.directory,
+                               ArchiveCache.FILES)) as f:
+            return set(json.load(f))
+
+    def test_files_age(self):
+        foo = self.entries('foo', ['a', 'b'])
+        self.cache.key(foo, {})
+        # Another course, archived long after the first one
+        bar = self.entries('bar', ['a'])
+        with patch('time.time',
+                   return_value=time.time() + ArchiveCache.FILES_AGE + 1):
+            self.cache.key(bar, {})
+        self.assertEqual(self.files(), {path for path, name in bar})
+
+    def test_files_size(self):
+        self.cache.FILES_SIZE = 2
+        foo = self.entries('foo', ['a', 'b'])
+        self.cache.key(foo, {})
+        bar = self.entries('bar', ['a'])
+        with patch('time.time', return_value=time.time() + 1):
+            self.cache.key(bar, {})
+        # The most recently used ones, ties going by path
+        self.assertEqual(self.files(),
+                         {foo[1][0]} | {path for path, name in bar})
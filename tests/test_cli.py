@@ -26,6 +26,8 @@ except ImportError:
 
 from subprocess import Popen, PIPE
 
+from tempfile import NamedTemporaryFile
+
 from unittest import TestCase
 
 
@@ -78,6 +80,12 @@ class OLXUtilsCLITestCase(TestCase):
         self.execute_and_check_error(cmdline,
                                      expected_output)
 
+    def test_invalid_jobs(self):
+        cmdline = self.create_command('-j 0 foo 2019-01-01 2019-01-31')
+        expected_output = "Not a positive integer:"
+        self.execute_and_check_error(cmdline,
+                                     expected_output)
+
 
 class NewRunTestCase(TestCase):
     """
@@ -108,6 +116,81 @@ class NewRunTestCase(TestCase):
         self.execute_and_check_error(expected_output,
                                      *args)
 
+    def test_branch_and_output_dir(self):
+        args = ('foo',
+                datetime.strptime('2019-01-01', "%Y-%m-%d"),
+                datetime.strptime('2019-01-31', "%Y-%m-%d"))
+        expected_output = "Cannot create a git branch"
+        with self.assertRaises(CLIException) as e:
+            CLI().new_run(*args,
+                          create_branch=True,
+                          output_dir='output')
+        self.assertIn(expected_output, str(e.exception))
+
+
+class ScheduleTestCase(TestCase):
+    """
+    Read schedule files for the new-runs subcommand
+    """
+
+    def read_schedule(self, content):
+        with NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write(content)
+            f.flush()
+            return CLI().read_schedule(f.name)
+
+    def execute_and_check_error(self, content, expected_output):
+        with self.assertRaises(CLIException) as e:
+            self.read_schedule(content)
+        self.assertIn(expected_output, str(e.exception))
+
+    def test_read_schedule(self):
+        runs = self.read_schedule('name, start_date, end_date, public\n'
+                                  'foo, 2019-01-01, 2019-12-31, yes\n'
+                                  'bar, 2020-01-01, 2020-12-31\n')
+        self.assertEqual(runs, [
+            {'name': 'foo',
+             'start_date': datetime(2019, 1, 1),
+             'end_date': datetime(2019, 12, 31),
+             'suffix': None,
+             'public': True},
+            {'name': 'bar',
+             'start_date': datetime(2020, 1, 1),
+             'end_date': datetime(2020, 12, 31),
+             'suffix': None,
+             'public': False},
+        ])
+
+    def test_invalid_date(self):
+        self.execute_and_check_error('name,start_date,end_date\n'
+                                     'foo,2019-02-01,2019-02-31\n',
+                                     'line 2: invalid run')
+
+    def test_missing_column(self):
+        self.execute_and_check_error('name,start_date\n'
+                                     'foo,2019-02-01\n',
+                                     'line 2: invalid run')
+
+    def test_invalid_public(self):
+        self.execute_and_check_error('name,start_date,end_date,public\n'
+                                     'foo,2019-01-01,2019-02-01,maybe\n',
+                                     'Not a valid boolean')
+
+    def test_invalid_name(self):
+        self.execute_and_check_error('name,start_date,end_date\n'
+                                     '_base,2019-01-01,2019-02-01\n',
+                                     'This run name is reserved.')
+
+    def test_duplicate_name(self):
+        self.execute_and_check_error('name,start_date,end_date\n'
+                                     'foo,2019-01-01,2019-02-01\n'
+                                     'foo,2019-03-01,2019-04-01\n',
+                                     "line 3: duplicate run name 'foo'")
+
+    def test_empty(self):
+        self.execute_and_check_error('name,start_date,end_date\n',
+                                     'No runs found')
+
 
 class OLXUtilsCustomArgsTestCase(OLXUtilsCLITestCase):
     """
@@ -204,3 +287,50 @@ class NewRunPyTestCase(OLXUtilsShellTestCase):
     """
     CLI_PATH = 'new_run.py'
     SUBCOMMAND = None
+
+
+class StartupTestCase(TestCase):
+    """
+    Check that the CLI starts up without importing anything it
+    doesn't need yet
+    """
+
+    HEAVY_MODULES = [
+        'importlib.metadata',
+        'mako',
+        'markdown2',
+        'requests',
+        'swiftclient',
+        'tarfile',
+        'xmltodict',
+    ]
+
+    def imported_modules(self, code):
+        """Run code in a fresh interpreter, and return the heavy modules
+        it imported."""
+        code += ('\nimport sys\n'
+                 'print(" ".join(m for m in %r if m in sys.modules))'
+                 % self.HEAVY_MODULES)
+        p = Popen([sys.executable, '-c', code], stdout=PIPE)
+        stdout, stderr = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        return stdout.decode().split()
+
+    def test_import(self):
+        self.assertEqual(self.imported_modules(
+            'from olxutils.cli import CLI\n'
+            'CLI()'), [])
+
+    def test_parse_status(self):
+        self.assertEqual(self.imported_modules(
+            'from olxutils.cli import CLI\n'
+            'CLI().parse_args(["status", "-f", "x", "-t", "y"])'), [])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_version(self, mock_stdout):
+        from olxutils import __version__
+
+        with self.assertRaises(SystemExit) as se:
+            CLI().main(['olx', '--version'])
+        self.assertEqual(se.exception.code, 0)
+        self.assertEqual(mock_stdout.getvalue(), 'olx %s\n' % __version__)
@@ -0,0 +1,53 @@
+from __future__ import unicode_literals
+
+from olxutils.client import HTTPClient, default_client
+from olxutils.token import TokenHelper
+from olxutils.upload import UploadHelper
+
+import requests_mock
+
+from unittest import TestCase
+
+
+class HTTPClientTestCase(TestCase):
+
+    FAKE_CMS_URL = 'https://cms.pohgha9thaom4ii7.6t8'
+
+    def test_default_client(self):
+        client = default_client()
+        self.assertIs(default_client(), client)
+        self.assertIs(TokenHelper(self.FAKE_CMS_URL, 'foo', 'bar').client,
+                      client)
+
+    def test_timeout(self):
+        with HTTPClient(connect_timeout=1, read_timeout=2) as client:
+            with requests_mock.Mocker() as m:
+                m.register_uri('GET', self.FAKE_CMS_URL, text='foo')
+                client.get(self.FAKE_CMS_URL)
+                client.get(self.FAKE_CMS_URL, timeout=3)
+            self.assertEqual([r.timeout for r in m.request_history],
+                             [(1, 2), 3])
+
+    def test_shared_session(self):
+        course_id = 'course-v1:example+course+run'
+        upload_uri = '%s/api/courses/v0/import/%s/' % (self.FAKE_CMS_URL,
+                                                       course_id)
+        with HTTPClient() as client:
+            token_helper = TokenHelper(self.FAKE_CMS_URL, 'foo', 'bar',
+                                       client=client)
+            upload_helper = UploadHelper(self.FAKE_CMS_URL,
+                                         'archive.tar.gz',
+                                         'blatch',
+                                         course_id,
+                                         client=client)
+            # Only mock requests made through the client's session
+            with requests_mock.Mocker(session=client.session) as m:
+                m.register_uri('POST',
+                               '%s/oauth2/access_token' % self.FAKE_CMS_URL,
+                               json={'access_token': 'blatch'})
+                m.register_uri('GET',
+                               upload_uri,
+                               json={'state': 'Succeeded'})
+                token_helper.fetch_token()
+                upload_helper.fetch_upload_task_state('foo')
+            self.assertEqual(m.call_count, 2)
@@ -0,0 +1,64 @@
+from __future__ import unicode_literals
+
+import gzip
+import io
+import os
+import random
+import zlib
+
+from olxutils.compress import ParallelGzipWriter
+
+from unittest import TestCase
+
+
+class ParallelGzipWriterTestCase(TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        # Compressible text as well as incompressible noise, spanning
+        # several blocks
+        self.data = b''.join(
+            b'line %d of some compressible text\n' % i
+            for i in range(20000)) + rng.getrandbits(8 * 300000).to_bytes(
+                300000, 'little')
+
+    def compress(self, data, chunk=10000, **kwargs):
+        f = io.BytesIO()
+        with ParallelGzipWriter(f, **kwargs) as gz:
+            for i in range(0, len(data), chunk):
+                gz.write(data[i:i + chunk])
+        return f.getvalue()
+
+    def test_roundtrip(self):
+        for level in (0, 1, 6, 9):
+            compressed = self.compress(self.data,
+                                       compresslevel=level,
+                                       threads=4,
+                                       blocksize=64 * 1024)
+            self.assertEqual(gzip.decompress(compressed), self.data)
+
+    def test_single_member(self):
+        compressed = self.compress(self.data, threads=4)
+        # One deflate stream, rather than concatenated gzip members
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(d.decompress(compressed), self.data)
+        self.assertTrue(d.eof)
+        self.assertEqual(d.unused_data, b'')
+
+    def test_ratio(self):
+        compressed = self.compress(self.data, threads=4)
+        # Priming each block with the previous one's end keeps the
+        # result close to what single-threaded gzip achieves.
+        self.assertLess(len(compressed),
+                        len(gzip.compress(self.data)) * 1.01)
+
+    def test_header(self):
+        compressed = self.compress(b'', compresslevel=1, mtime=1234)
+        self.assertEqual(compressed[:10],
+                         b'\x1f\x8b\x08\x00\xd2\x04\x00\x00\x04\xff')
+        self.assertEqual(gzip.decompress(compressed), b'')
+
+    def test_small_writes(self):
+        data = os.urandom(5000)
+        compressed = self.compress(data, chunk=1, blocksize=1000)
+        self.assertEqual(gzip.decompress(compressed), data)
@@ -1,17 +1,37 @@
 from __future__ import unicode_literals
 
+import io
 import os
+import sys
+import json
+import logging
 import tempfile
+import threading
+import time
+import functools
+import socket
 
 import shutil
 import shlex
 import tarfile
 
-from subprocess import check_call, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from subprocess import check_call, CalledProcessError, Popen
 
+from olxutils import __version__
+from olxutils.cache import PRUNED
 from olxutils.cli import CLI, CLIException
+from olxutils.git import GitHelperException
+from olxutils.serve import (HTTPRenderServer,
+                            RenderService,
+                            UnixRenderServer)
+from olxutils.templates import OLXTemplates, render_course, _module_finder
+from olxutils.watch import watch
 
 import git
+import requests
+import requests_mock
 
 from invoke import MockContext
 import tasks
@@ -113,6 +133,14 @@ class FullCourseTestCase(TestCase):
                         self.resultdir,
                         symlinks=True)
 
+        # Keep compiled templates out of the user's cache directory
+        self.cachedir = os.path.join(self.tmpdir,
+                                     'cache')
+        env = patch.dict(os.environ,
+                         {'OLX_CACHE_DIR': self.cachedir})
+        env.start()
+        self.addCleanup(env.stop)
+
     def diff(self):
         # There's no Pythonic way that's any more efficient than
         # calling out to "diff -r" here
@@ -126,6 +154,9 @@ class FullCourseTestCase(TestCase):
         with tarfile.open(filename) as tf:
             self.assertEqual(set(tf.getnames()),
                              set(self.ARCHIVE_MEMBERS))
+            policies = tf.getmember('course/policies/foo')
+            self.assertTrue(policies.issym())
+            self.assertEqual(policies.linkname, '_base')
 
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
@@ -137,20 +168,22 @@ class CLIFullCourseTestCase(FullCourseTestCase):
                       name,
                       start_date_string,
                       end_date_string,
-                      create_branch=False):
+                      create_branch=False,
+                      options=''):
         os.chdir(self.sourcedir)
         cmdline = ("olx new-run "
-                   "%s %s %s %s") % ('-b' if create_branch else '',
-                                     name,
-                                     start_date_string,
-                                     end_date_string)
+                   "%s %s %s %s %s") % ('-b' if create_branch else '',
+                                        options,
+                                        name,
+                                        start_date_string,
+                                        end_date_string)
 
         args = shlex.split(cmdline)
         CLI().main(args)
 
-    def create_archive(self):
+    def create_archive(self, options=''):
         os.chdir(self.sourcedir)
-        cmdline = "olx archive"
+        cmdline = "olx archive %s" % options
         args = shlex.split(cmdline)
         CLI().main(args)
 
@@ -162,6 +195,506 @@ class CLIFullCourseTestCase(FullCourseTestCase):
         self.create_archive()
         self.verify_archive()
 
+    def test_render_course_archive_threads(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        self.create_archive('--compress-threads 4 --compression-level 1')
+        self.verify_archive()
+
+    def read_archive(self):
+        with open(os.path.join(self.sourcedir, 'archive.tar.gz'),
+                  'rb') as f:
+            return f.read()
+
+    def test_render_course_archive_reproducible(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        for options in ('--reproducible --no-cache',
+                        '--reproducible --no-cache --compress-threads 2'):
+            self.create_archive(options)
+            self.verify_archive()
+            archive = self.read_archive()
+
+            # Touching files changes nothing
+            for root, dirnames, filenames in os.walk(self.sourcedir):
+                for name in dirnames + filenames:
+                    os.utime(os.path.join(root, name),
+                             (0, time.time() + 60),
+                             follow_symlinks=False)
+            self.create_archive(options)
+            self.assertEqual(self.read_archive(), archive)
+
+        with tarfile.open(os.path.join(self.sourcedir,
+                                       'archive.tar.gz')) as tf:
+            for member in tf.getmembers():
+                self.assertEqual(member.mtime, 0)
+                self.assertEqual((member.uid, member.gid), (0, 0))
+                self.assertIn(member.mode, (0o644, 0o755, 0o777))
+            self.assertEqual(tf.getmember('course/policies/foo').linkname,
+                             '_base')
+
+    def test_render_course_archive_cached(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        self.create_archive('--reproducible')
+        archive = self.read_archive()
+
+        with self.assertLogs(level='INFO') as logs:
+            self.create_archive('--reproducible')
+        self.assertIn('Reused cached archive', '\n'.join(logs.output))
+        self.assertEqual(self.read_archive(), archive)
+        self.verify_archive()
+
+        # A changed file means a new archive
+        with open(os.path.join(self.sourcedir, 'course.xml'), 'a') as f:
+            f.write('\n')
+        with self.assertLogs(level='INFO') as logs:
+            self.create_archive('--reproducible')
+        self.assertNotIn('Reused cached archive', '\n'.join(logs.output))
+        self.assertNotEqual(self.read_archive(), archive)
+
+    def test_render_course_archive_cache_intact(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        self.create_archive('--reproducible')
+        archive = self.read_archive()
+        self.create_archive('--reproducible')
+
+        # Creating another archive over the one from the cache, with
+        # and without --reproducible, leaves the cached one alone.
+        course_xml = os.path.join(self.sourcedir, 'course.xml')
+        with open(course_xml) as f:
+            content = f.read()
+        with open(course_xml, 'a') as f:
+            f.write('\n')
+        self.create_archive('--reproducible')
+        self.create_archive()
+        with open(course_xml, 'w') as f:
+            f.write(content)
+        with self.assertLogs(level='INFO') as logs:
+            self.create_archive('--reproducible')
+        self.assertIn('Reused cached archive', '\n'.join(logs.output))
+        self.assertEqual(self.read_archive(), archive)
+
+    def test_render_course_archive_prune(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        self.append('html/introduction_unit_01.html',
+                    '<a href="/static/presentation/index.html">Slides</a>')
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.create_archive('--prune-unreferenced')
+        self.assertRegex(stdout.getvalue(),
+                         r'Pruned 11 unreferenced files, saving \d+ bytes')
+
+        pruned = [
+            'course/chapter/conclusion.xml',
+            'course/html/README.md',
+            'course/sequential/README.md',
+            'course/static/hot',
+            'course/static/hot/README.md',
+            'course/static/images',
+            'course/static/images/README.md',
+            'course/static/markdown',
+            'course/static/markdown/README.md',
+            'course/static/markdown/introduction_unit_01.md',
+            'course/static/markdown/introduction_unit_02.md',
+            'course/static/markdown/introduction_unit_03.md',
+            'course/static/presentation/css/reveal-override.css.map',
+            'course/static/presentation/css/reveal-override.scss',
+        ]
+        with tarfile.open(os.path.join(self.sourcedir,
+                                       'archive.tar.gz')) as tf:
+            self.assertEqual(set(tf.getnames()),
+                             set(self.ARCHIVE_MEMBERS) - set(pruned))
+
+    def test_render_course_archive_report(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        report = os.path.join(self.tmpdir, 'report.json')
+        with patch('olxutils.cli.print') as mock_print:
+            self.create_archive('--compress-threads 2 --report %s' % report)
+        self.verify_archive()
+        summary = mock_print.call_args[0][0]
+        self.assertIn('Largest members', summary)
+        self.assertIn('course/static/presentation/js/highlight.js',
+                      summary)
+
+        with open(report) as f:
+            report = json.load(f)
+        self.assertEqual(report['archive']['compressed'],
+                         len(self.read_archive()))
+        directories = report['directories']
+        self.assertEqual(directories['html']['files'], 4)
+        self.assertEqual(directories['chapter']['files'], 2)
+        self.assertEqual(directories['course.xml']['files'], 1)
+        self.assertGreater(directories['static']['bytes'],
+                           directories['static']['compressed'])
+        self.assertEqual(sum(d['files'] for d in directories.values()),
+                         sum(m['type'] == 'file'
+                             for m in report['members']))
+        self.assertEqual(report['largest'][0],
+                         'course/static/presentation/js/highlight.js')
+        members = dict((m['member'], m) for m in report['members'])
+        self.assertEqual(members['course/policies/foo']['type'], 'symlink')
+        self.assertEqual(members['course/course.xml']['bytes'],
+                         os.path.getsize(os.path.join(self.sourcedir,
+                                                      'course.xml')))
+
+    def test_render_course_publish(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        url = 'https://cms.example.com'
+        upload_url = ('%s/api/courses/v0/import/'
+                      'course-v1:Foo+foo101+foo/' % url)
+        uploads = []
+
+        def uploaded(request, context):
+            # Consume the body while it is being generated
+            uploads.append((request.headers, b''.join(request.body)))
+            return {'task_id': 'task'}
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', upload_url, json=uploaded)
+            CLI().main(shlex.split('olx publish --url %s --token t '
+                                   '--compress-threads 2' % url))
+
+        headers, body = uploads[0]
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        boundary = headers['Content-Type'].split('boundary=')[1]
+        self.assertTrue(body.startswith(('--%s\r\n' % boundary).encode()))
+        self.assertIn(b'filename="archive.tar.gz"', body)
+        self.assertTrue(body.endswith(('\r\n--%s--\r\n' %
+                                       boundary).encode()))
+        archive = body.split(b'\r\n\r\n', 1)[1][:-len(boundary) - 8]
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tf:
+            self.assertEqual(set(tf.getnames()),
+                             set(self.ARCHIVE_MEMBERS))
+        # Nothing was written to disk
+        self.assertFalse(os.path.exists(os.path.join(self.sourcedir,
+                                                     'archive.tar.gz')))
+
+    def test_render_course_publish_progress(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31")
+        url = 'https://cms.example.com'
+        upload_url = ('%s/api/courses/v0/import/'
+                      'course-v1:Foo+foo101+foo/' % url)
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+
+        def uploaded(request, context):
+            b''.join(request.body)
+            return {'task_id': 'task'}
+
+        for options, expected in (('', True), ('-q', False)):
+            root.setLevel(logging.WARNING)
+            with requests_mock.Mocker() as m, \
+                    patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                m.register_uri('POST', upload_url, json=uploaded)
+                CLI().main(shlex.split('olx %s publish --url %s --token t '
+                                       '--progress-interval 0.001' %
+                                       (options, url)))
+            self.assertEqual('Uploaded' in stderr.getvalue(), expected)
+
+    def test_render_course_archive_invalid_level(self):
+        with self.assertRaises(SystemExit):
+            self.create_archive('--compression-level 10')
+
+    def test_render_course_matching_serial(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-j 1')
+        self.diff()
+
+    def test_render_course_matching_parallel(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-j 4')
+        self.diff()
+
+    def test_render_course_cached(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-j 1')
+        self.assertTrue(os.listdir(os.path.join(self.cachedir,
+                                                'templates')))
+
+        # Restore the unrendered sources, with their original
+        # modification times. Rendering them again must not compile
+        # a single template.
+        shutil.rmtree(self.sourcedir)
+        shutil.copytree(self.SOURCE_DIR,
+                        self.sourcedir,
+                        symlinks=True)
+        # Modules compiled long ago, but used now, stay in the cache,
+        # even when it is pruned.
+        modules = os.path.join(self.cachedir, 'templates')
+        os.remove(os.path.join(modules, PRUNED))
+        long_ago = time.time() - 2 * OLXTemplates.MODULE_CACHE_AGE
+        compiled = []
+        for root, dirnames, filenames in os.walk(modules):
+            for filename in filenames:
+                compiled.append(os.path.join(root, filename))
+                os.utime(compiled[-1], (long_ago, long_ago))
+        with patch('mako.template._compile_module_file') as compile:
+            self.render_course("foo",
+                               "2019-01-01",
+                               "2019-12-31",
+                               options='-j 1')
+        compile.assert_not_called()
+        self.diff()
+        self.assertTrue(os.path.exists(os.path.join(modules, PRUNED)))
+        self.assertTrue(all(os.path.exists(path) for path in compiled))
+
+    def test_render_course_uncached(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='--no-cache')
+        self.diff()
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def mtimes(self, directory):
+        mtimes = {}
+        for root, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                mtimes[path] = os.lstat(path).st_mtime_ns
+        return mtimes
+
+    def test_render_course_output_dir(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-o ../output')
+        check_call('diff -q -r -x .olx-manifest.json output result',
+                   cwd=self.tmpdir,
+                   shell=True)
+        # The source tree must be untouched
+        check_call('diff -q -r -x .git %s source' % self.SOURCE_DIR,
+                   cwd=self.tmpdir,
+                   shell=True)
+
+        # Rendering the same run again must not write a single file
+        outputdir = os.path.join(self.tmpdir, 'output')
+        mtimes = self.mtimes(outputdir)
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-o ../output')
+        self.assertEqual(self.mtimes(outputdir), mtimes)
+
+    def render_incremental(self, name='foo', options=''):
+        """Render into an output directory, and return the set of
+        templates that were rendered."""
+        with patch.object(OLXTemplates,
+                          '_render_template',
+                          autospec=True,
+                          side_effect=OLXTemplates._render_template) as r:
+            self.render_course(name,
+                               "2019-01-01",
+                               "2019-12-31",
+                               options='-j 1 -o ../output ' + options)
+        return set(c[0][1] for c in r.call_args_list)
+
+    def append(self, filename, text):
+        with open(os.path.join(self.sourcedir, filename), 'a') as f:
+            f.write(text)
+
+    def test_render_course_incremental(self):
+        self.assertIn('course.xml', self.render_incremental())
+        self.assertEqual(self.render_incremental(), set())
+
+        # Editing Markdown re-renders it, and the HTML including it
+        self.append('static/markdown/introduction_unit_02.md',
+                    '\nMore text.\n')
+        self.assertEqual(self.render_incremental(),
+                         set(['static/markdown/introduction_unit_02.md',
+                              'html/introduction_unit_02.html']))
+
+        # Editing a partial re-renders everything that uses it
+        self.append('include/course.xml', '\n')
+        rendered = self.render_incremental()
+        self.assertIn('course.xml', rendered)
+        self.assertIn('policies/assets.json', rendered)
+        self.assertNotIn('static/markdown/introduction_unit_02.md',
+                         rendered)
+
+        # Changing the context re-renders everything
+        self.assertIn('static/markdown/introduction_unit_02.md',
+                      self.render_incremental('bar'))
+
+    def test_render_course_incremental_force(self):
+        self.render_incremental()
+        self.assertIn('course.xml',
+                      self.render_incremental(options='--force'))
+
+    def test_render_course_output_dir_in_tree(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-o build')
+        check_call('diff -q -r -x .olx-manifest.json '
+                   'source/build result',
+                   cwd=self.tmpdir,
+                   shell=True)
+
+    def test_render_course_ignore(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-x static/presentation -x "*.json"')
+        # Ignored templates stay as they are
+        for filename in ('static/presentation/index.html',
+                         'policies/assets.json'):
+            check_call('cmp %s %s' % (os.path.join(self.SOURCE_DIR,
+                                                   filename),
+                                      os.path.join(self.sourcedir,
+                                                   filename)),
+                       shell=True)
+        # Everything else is rendered
+        check_call('cmp source/course.xml result/course.xml',
+                   cwd=self.tmpdir,
+                   shell=True)
+
+    def test_render_course_schedule(self):
+        os.chdir(self.sourcedir)
+        schedule = os.path.join(self.tmpdir, 'schedule.csv')
+        with open(schedule, 'w') as f:
+            f.write('name,start_date,end_date,suffix,public\n'
+                    'foo,2019-01-01,2019-12-31,,\n'
+                    'bar,2020-01-01,2020-06-30,Spring,true\n')
+        CLI().main(shlex.split('olx new-runs -j 2 -o ../runs %s' % schedule))
+
+        check_call('diff -q -r -x .olx-manifest.json runs/foo result',
+                   cwd=self.tmpdir,
+                   shell=True)
+        with open(os.path.join(self.tmpdir,
+                               'runs', 'bar', 'course.xml')) as f:
+            coursexml = f.read()
+        self.assertIn('url_name="bar"', coursexml)
+        self.assertIn('(Spring)', coursexml)
+        self.assertEqual(os.readlink(os.path.join(self.tmpdir,
+                                                  'runs', 'bar',
+                                                  'policies', 'bar')),
+                         '_base')
+
+    def test_render_course_schedule_default_output(self):
+        os.chdir(self.sourcedir)
+        schedule = os.path.join(self.tmpdir, 'schedule.csv')
+        with open(schedule, 'w') as f:
+            f.write('name,start_date,end_date,suffix,public\n'
+                    'foo,2019-01-01,2019-12-31,,\n'
+                    'bar,2020-01-01,2020-06-30,Spring,true\n')
+        # Render into runs/, in the source tree, more than once, and
+        # into another output directory that's there as well.
+        for _ in range(2):
+            CLI().main(shlex.split('olx new-runs %s' % schedule))
+        self.render_course("baz",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-o preview')
+        CLI().main(shlex.split('olx new-runs %s' % schedule))
+
+        for name in ('foo', 'bar'):
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(self.sourcedir, 'runs',
+                                               name))),
+                sorted(os.listdir(os.path.join(self.sourcedir,
+                                               'preview'))))
+        self.assertFalse(os.path.exists(os.path.join(self.sourcedir,
+                                                     'preview', 'runs')))
+
+    def test_render_course_profile(self):
+        report = os.path.join(self.tmpdir, 'profile.json')
+        with patch('olxutils.cli.print') as mock_print:
+            self.render_course("foo",
+                               "2019-01-01",
+                               "2019-12-31",
+                               options='-j 2 --profile %s' % report)
+        self.diff()
+        self.assertIn('Slowest templates', mock_print.call_args[0][0])
+
+        with open(report) as f:
+            profile = json.load(f)
+        self.assertIn('.', profile['discovery'])
+        templates = dict((entry['template'], entry)
+                         for entry in profile['templates'])
+        self.assertIn('course.xml', templates)
+        entry = templates['html/introduction_unit_01.html']
+        self.assertGreater(entry['bytes'], 0)
+        self.assertEqual(entry['helpers']['markdown_file'][0], 1)
+        self.assertIn('markdown_file', profile['helpers'])
+
+    def test_render_course_watch(self):
+        os.chdir(self.sourcedir)
+        stop = threading.Event()
+        watcher = threading.Thread(
+            target=CLI().main,
+            args=(shlex.split('olx watch -j 1 -o ../preview '
+                              'foo 2019-01-01 2019-12-31'),))
+        outputdir = os.path.join(self.tmpdir, 'preview')
+        html = os.path.join(outputdir, 'html', 'introduction_unit_02.html')
+
+        def wait_for(condition):
+            deadline = time.monotonic() + 10
+            while not condition():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+
+        with patch('olxutils.watch.watch',
+                   functools.partial(watch, stop=stop)):
+            watcher.start()
+            try:
+                # The policies symlink is the last thing to show up
+                wait_for(lambda: os.path.lexists(
+                    os.path.join(outputdir, 'policies', 'foo')))
+                check_call('diff -q -r -x .olx-manifest.json '
+                           'preview result',
+                           cwd=self.tmpdir,
+                           shell=True)
+
+                # Editing Markdown re-renders the HTML that includes it
+                self.append('static/markdown/introduction_unit_02.md',
+                            '\nMore text.\n')
+
+                def updated():
+                    with open(html) as f:
+                        return 'More text.' in f.read()
+                wait_for(updated)
+
+                # Deleting a file deletes it from the preview, too
+                os.unlink(os.path.join(self.sourcedir, 'html', 'README.md'))
+                wait_for(lambda: not os.path.exists(
+                    os.path.join(outputdir, 'html', 'README.md')))
+            finally:
+                stop.set()
+                watcher.join()
+
+    def test_render_course_sys_path(self):
+        """Rendering must leave the import path alone."""
+        path = list(sys.path)
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-j 1 -o output')
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           options='-j 1 -o output --force')
+        self.assertEqual(sys.path, path)
+
     def test_render_course_nonmatching(self):
         self.render_course("bar",
                            "2019-01-01",
@@ -179,6 +712,21 @@ class CLIFullCourseTestCase(FullCourseTestCase):
                                "2019-01-01",
                                "2019-12-31")
 
+    def test_render_course_error_parallel(self):
+        """Force an exception in a rendering worker process."""
+        os.remove(os.path.join(self.sourcedir,
+                               'include',
+                               'course.xml'))
+        with self.assertRaises(CLIException) as e:
+            self.render_course("foo",
+                               "2019-01-01",
+                               "2019-12-31",
+                               options='-j 2')
+        # The message must carry Mako's rendered traceback from
+        # the worker process.
+        self.assertIn('Traceback', str(e.exception))
+        self.assertIn('course.xml', str(e.exception))
+
     def test_render_course_force_git_error(self):
         # Simulate an empty PATH, so a git command fails
         with patch.dict(os.environ,
@@ -219,6 +767,55 @@ class CLIGitFullCourseTestCase(CLIFullCourseTestCase):
         self.diff()
         self.assertIn('run/foo', self.repo.branches)
 
+    def test_render_course_archive_from_ref(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           True)
+        self.create_archive('--reproducible --no-cache')
+        checkout_archive = self.read_archive()
+
+        # Back on the original branch, with unrendered templates, the
+        # archive from the run branch is the same.
+        self.repo.git.checkout('-')
+        self.create_archive('--reproducible --no-cache --from-ref run/foo')
+        self.assertEqual(self.read_archive(), checkout_archive)
+        self.create_archive('--from-ref run/foo --compress-threads 2')
+        self.verify_archive()
+
+        # Pruning reads the course from git, too
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.create_archive('--from-ref run/foo --prune-unreferenced')
+        self.assertRegex(stdout.getvalue(),
+                         r'Pruned 25 unreferenced files, saving \d+ bytes')
+
+        with self.assertRaises(GitHelperException):
+            self.create_archive('--from-ref run/bar')
+
+    def test_render_course_archive_from_ref_cached(self):
+        self.render_course("foo",
+                           "2019-01-01",
+                           "2019-12-31",
+                           True)
+        self.repo.git.checkout('-')
+        options = '--from-ref run/foo --reproducible --prune-unreferenced'
+        self.create_archive(options)
+
+        # Pruning reads blobs even when the archive comes from the
+        # cache, and the process reading them must go away.
+        processes = []
+
+        def popen(*args, **kwargs):
+            processes.append(Popen(*args, **kwargs))
+            return processes[-1]
+
+        with patch('olxutils.git.Popen', popen), \
+                self.assertLogs(level='INFO') as logs:
+            self.create_archive(options)
+        self.assertIn('Reused cached archive', '\n'.join(logs.output))
+        self.assertTrue(processes)
+        self.assertEqual([p.poll() for p in processes], [0] * len(processes))
+
     def test_render_course_matching_git_dirty(self):
         dirtypath = os.path.join(self.sourcedir,
                                  'dirty.txt')
@@ -258,3 +855,244 @@ class InvokeFullCourseTestCase(FullCourseTestCase):
         ctx = MockContext()
         with self.assertRaises(CLIException):
             tasks.new_run(ctx)
+
+
+class ServeFullCourseTestCase(FullCourseTestCase):
+
+    def setUp(self):
+        super(ServeFullCourseTestCase, self).setUp()
+
+        # Jobs name their directories, so the daemon's working
+        # directory doesn't matter
+        os.chdir(self.tmpdir)
+        self.service = RenderService(CLI(), self.cachedir)
+        self.server = HTTPRenderServer(self.service, 0)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = ('Bearer %s' %
+                                                 self.server.token)
+        self.addCleanup(self.session.close)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+
+        def stop():
+            self.server.shutdown()
+            self.server.server_close()
+            thread.join()
+        self.addCleanup(stop)
+
+    def post(self, path, headers=None, **job):
+        return self.session.post(self.url + path, json=job, headers=headers)
+
+    def render(self, name='foo', output_dir=None):
+        return self.post('/render',
+                         source_dir=self.sourcedir,
+                         output_dir=output_dir,
+                         name=name,
+                         start_date='2019-01-01',
+                         end_date='2019-12-31')
+
+    def test_render_course_matching(self):
+        response = self.render()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['output_dir'], self.sourcedir)
+        self.diff()
+
+        response = self.post('/archive',
+                             root_directory=self.sourcedir,
+                             base_name=os.path.join(self.sourcedir,
+                                                    'archive'))
+        self.assertEqual(response.status_code, 200)
+        self.verify_archive()
+
+    def test_render_course_concurrent(self):
+        outputs = ['foo%d' % i for i in range(4)]
+        with ThreadPoolExecutor(len(outputs) + 1) as executor:
+            responses = list(executor.map(
+                lambda output: self.render(
+                    output_dir=os.path.join(self.tmpdir, output)),
+                outputs))
+            other = executor.submit(self.render, 'bar',
+                                    os.path.join(self.tmpdir, 'bar'))
+        self.assertEqual([r.status_code for r in responses],
+                         [200] * len(outputs))
+        self.assertEqual(other.result().status_code, 200)
+        for output in outputs:
+            check_call('diff -q -r -x .olx-manifest.json %s result' %
+                       output,
+                       cwd=self.tmpdir,
+                       shell=True)
+        with self.assertRaises(CalledProcessError):
+            check_call('diff -q -r -x .olx-manifest.json bar result',
+                       cwd=self.tmpdir,
+                       shell=True)
+        # All jobs shared one set of compiled templates
+        self.assertEqual(list(self.service.lookups), [self.sourcedir])
+
+    def test_render_course_error(self):
+        os.remove(os.path.join(self.sourcedir,
+                               'include',
+                               'course.xml'))
+        response = self.render()
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('course.xml', response.json()['error'])
+
+    def test_invalid_jobs(self):
+        response = self.post('/render', source_dir=self.sourcedir)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('name', response.json()['error'])
+
+        response = self.post('/render',
+                             source_dir=self.sourcedir,
+                             name='foo',
+                             start_date='2019-12-31',
+                             end_date='2019-01-01')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.session.post(self.url + '/render', data='[',
+                                     headers={'Content-Type':
+                                              'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post('/archive',
+                             root_directory=self.sourcedir,
+                             compression_level=10)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.post('/publish')
+        self.assertEqual(response.status_code, 404)
+
+    def test_cross_origin(self):
+        # A form, as any web page may send
+        response = self.session.post(self.url + '/render',
+                                     data={'source_dir': self.sourcedir})
+        self.assertEqual(response.status_code, 415)
+
+        # A domain name rebound to 127.0.0.1
+        headers = {'Host': 'evil.example:%d' % self.server.server_address[1]}
+        response = self.session.get(self.url, headers=headers)
+        self.assertEqual(response.status_code, 403)
+        response = self.post('/render',
+                             headers=headers,
+                             source_dir=self.sourcedir)
+        self.assertEqual(response.status_code, 403)
+
+        response = self.session.get(self.url.replace('127.0.0.1',
+                                                     'localhost'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_token(self):
+        for headers in ({},
+                        {'Authorization': 'Bearer wrong'},
+                        {'Authorization': self.server.token}):
+            response = requests.get(self.url, headers=headers)
+            self.assertEqual(response.status_code, 401)
+            response = requests.post(self.url + '/render',
+                                     headers=headers,
+                                     json={'source_dir': self.sourcedir})
+            self.assertEqual(response.status_code, 401)
+
+        # Saved for the current user only
+        path = os.path.join(self.tmpdir, 'serve.token')
+        self.server.save_token(path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as f:
+            self.assertEqual(f.read().strip(), self.server.token)
+
+    def test_version(self):
+        response = self.session.get(self.url)
+        self.assertEqual(response.json(), {'version': __version__})
+
+    def test_unix_socket(self):
+        path = os.path.join(self.tmpdir, 'olx.sock')
+        server = UnixRenderServer(self.service, path)
+        # Only the current user may connect.
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(path)
+            with client:
+                client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+                response = b''.join(iter(lambda: client.recv(4096), b''))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertTrue(response.startswith(b'HTTP/1.0 200'))
+        self.assertIn(__version__.encode('utf-8'), response)
+        self.assertFalse(os.path.exists(path))
+
+
+class LibraryFullCourseTestCase(FullCourseTestCase):
+
+    def setUp(self):
+        super(LibraryFullCourseTestCase, self).setUp()
+        # Nothing may depend on the current working directory
+        os.chdir(self.tmpdir)
+
+    def render(self, output_dir, name='foo', source_dir=None):
+        render_course(source_dir or self.sourcedir,
+                      output_dir and os.path.join(self.tmpdir, output_dir),
+                      name,
+                      datetime(2019, 1, 1),
+                      datetime(2019, 12, 31),
+                      cache_dir=self.cachedir)
+
+    def test_render_course_matching(self):
+        self.render(None)
+        self.diff()
+
+    def test_render_course_concurrent(self):
+        # Several courses, each rendered into several directories
+        sources = []
+        for i in range(3):
+            source = os.path.join(self.tmpdir, 'source%d' % i)
+            shutil.copytree(self.SOURCE_DIR, source, symlinks=True)
+            sources.append(source)
+        jobs = [(source, 'output%d_%d' % (s, i))
+                for s, source in enumerate(sources)
+                for i in range(3)]
+        path = list(sys.path)
+
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda job: self.render(job[1], source_dir=job[0]),
+                jobs))
+
+        for _, output in jobs:
+            check_call('diff -q -r -x .olx-manifest.json %s result' %
+                       output,
+                       cwd=self.tmpdir,
+                       shell=True)
+        self.assertEqual(sys.path, path)
+
+    def test_render_course_modules(self):
+        module = 'olx_test_module_%d' % os.getpid()
+        self.addCleanup(sys.modules.pop, module, None)
+        self.addCleanup(_module_finder.origins.pop, module, None)
+
+        other = os.path.join(self.tmpdir, 'other')
+        shutil.copytree(self.SOURCE_DIR, other, symlinks=True)
+        for source, value in ((self.sourcedir, 'one'), (other, 'two')):
+            with open(os.path.join(source, 'include',
+                                   module + '.py'), 'w') as f:
+                f.write('VALUE = %r\n' % value)
+            with open(os.path.join(source, 'html',
+                                   'module.html'), 'w') as f:
+                f.write('<%%! import %s %%>${%s.VALUE}' %
+                        (module, module))
+
+        self.render('output')
+        with open(os.path.join(self.tmpdir, 'output', 'html',
+                               'module.html')) as f:
+            self.assertEqual(f.read(), 'one')
+        self.assertNotIn(os.path.join(self.sourcedir, 'include'),
+                         sys.path)
+
+        # Another course's module of the same name can't be imported
+        # anymore, which deserves a warning
+        with self.assertLogs(level='WARNING') as logs:
+            self.render('other_output', source_dir=other)
+        self.assertIn(module, logs.output[0])
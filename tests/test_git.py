@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 
-from olxutils.git import GitHelper, GitHelperException
+from olxutils.git import GitHelper, GitHelperException, GitTree
 
 import shutil
 
@@ -146,5 +146,43 @@ class GitHelperTestCase(TestCase):
             expected_msg = 'Error committing new run.'
             self.assertEqual(str(e.exception), expected_msg)
 
+    def test_tree(self):
+        """
+        Read files from a commit, rather than from the working tree
+        """
+        os.makedirs('static/js')
+        with open('static/js/app.js', 'w') as f:
+            f.write('app')
+        os.symlink('js/app.js', 'static/app.js')
+        self.create_file('Hello world')
+        self.repo.git.add('.')
+        self.repo.git.commit('-m', 'Test 1')
+        # Changes in the working tree don't matter
+        with open('static/js/app.js', 'w') as f:
+            f.write('changed')
+
+        tree = GitTree('HEAD', self.tmpdir)
+        try:
+            name = os.path.basename(self.tmpfile)
+            self.assertEqual(tree.listdir(''), sorted([name, 'static']))
+            self.assertEqual(tree.listdir('static'), ['app.js', 'js'])
+            self.assertTrue(tree.isdir('static'))
+            self.assertTrue(tree.islink('static/app.js'))
+            self.assertEqual(tree.readlink('static/app.js'), 'js/app.js')
+            self.assertTrue(tree.isfile('static/js/app.js'))
+            self.assertFalse(tree.exists('static/css'))
+            self.assertEqual(tree.size(name), 11)
+            # Several blobs through the same process
+            self.assertEqual(tree.read('static/js/app.js'), b'app')
+            self.assertEqual(tree.read(name), b'Hello world')
+        finally:
+            tree.close()
+
+    def test_tree_unknown_ref(self):
+        self.create_file('Hello world')
+        self.add_and_commit('Test 1')
+        with self.assertRaises(GitHelperException):
+            GitTree('run/%s' % self.RUN_NAME, self.tmpdir)
+
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
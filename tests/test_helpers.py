@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
 import os
+import shutil
+import tempfile
+import threading
 
 from olxutils import helpers
 
@@ -80,28 +83,219 @@ class MarkdownTest(OLXHelpersTestCase):
                                  o.read())
 
 
+class MarkdownCacheTest(OLXHelpersTestCase):
+
+    def setUp(self):
+        super(MarkdownCacheTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.cache = helpers.MarkdownCache()
+        patcher = patch.object(helpers, 'markdown_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_memoize(self):
+        with patch.object(helpers.markdown2.Markdown,
+                          'convert',
+                          autospec=True,
+                          side_effect=helpers.markdown2.Markdown.convert) as m:
+            for i in range(3):
+                self.assertEqual(self.h.markdown('**foo**'),
+                                 '<p><strong>foo</strong></p>\n')
+            # Different extras make for a different cache entry
+            self.h.markdown('**foo**', extras=[])
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_memoize_dedented(self):
+        self.h.markdown('\n    *bar*\n')
+        self.h.markdown('*bar*')
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_lru(self):
+        self.cache.size = 2
+        for content in ('*a*', '*b*', '*a*', '*c*'):
+            self.h.markdown(content)
+        # "b" was least recently used when "c" came along
+        self.assertEqual(len(self.cache.entries), 2)
+        self.h.markdown('*a*')
+        self.h.markdown('*b*')
+        self.assertEqual(self.cache.hits, 2)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_disk_cache(self):
+        self.cache.directory = self.tmpdir
+        self.h.markdown('*spam*')
+
+        # A fresh cache, as in a new process, finds the entry on disk
+        cache = helpers.MarkdownCache(directory=self.tmpdir)
+        with patch.object(helpers, 'markdown_cache', cache):
+            with patch.object(helpers.markdown2.Markdown, 'convert') as m:
+                self.assertEqual(self.h.markdown('*spam*'),
+                                 '<p><em>spam</em></p>\n')
+            m.assert_not_called()
+        self.assertEqual(cache.hits, 1)
+
+    def test_disk_cache_prune(self):
+        self.cache.directory = self.tmpdir
+        extras_key = helpers._extras_key(helpers.DEFAULT_MARKDOWN_EXTRAS)
+        paths = {}
+        for content in ('*ham*', '*spam*'):
+            self.h.markdown(content)
+            paths[content] = self.cache._path(self.cache.key(content,
+                                                             extras_key))
+            # Long unused
+            os.utime(paths[content], (0, 0))
+        # Used just now, by another process
+        helpers.MarkdownCache(directory=self.tmpdir).get(
+            self.cache.key('*ham*', extras_key))
+
+        self.cache.prune()
+        self.assertTrue(os.path.exists(paths['*ham*']))
+        self.assertFalse(os.path.exists(paths['*spam*']))
+
+    def test_markdown_file_unchanged(self):
+        filename = os.path.join(self.tmpdir, 'test.md')
+        with open(filename, 'w') as f:
+            f.write('*eggs*')
+
+        with patch('codecs.open', wraps=helpers.codecs.open) as o:
+            for i in range(3):
+                self.assertEqual(self.h.markdown_file(filename),
+                                 '<p><em>eggs</em></p>\n')
+        self.assertEqual(o.call_count, 1)
+
+        # A changed file is read again
+        with open(filename, 'w') as f:
+            f.write('**eggs**')
+        self.assertEqual(self.h.markdown_file(filename),
+                         '<p><strong>eggs</strong></p>\n')
+
+
+class MarkdownConvertersTest(OLXHelpersTestCase):
+
+    def setUp(self):
+        super(MarkdownConvertersTest, self).setUp()
+        # Keep the cache from hiding conversions
+        patcher = patch.object(helpers, 'markdown_cache',
+                               helpers.MarkdownCache(size=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        converters = helpers.MarkdownConverters()
+        with patch.object(helpers, 'markdown_converters', converters):
+            with patch('markdown2.Markdown',
+                       wraps=helpers.markdown2.Markdown) as m:
+                for content in ('*a*', '**b**', '`c`'):
+                    self.h.markdown(content)
+                self.h.markdown('*a*', extras=[])
+        # One converter for the default extras, one for none
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(len(converters.converters), 2)
+
+    def test_per_thread(self):
+        converters = helpers.MarkdownConverters()
+        mine = converters.get([], '[]')
+        self.assertIs(converters.get([], '[]'), mine)
+
+        theirs = []
+        thread = threading.Thread(
+            target=lambda: theirs.append(converters.get([], '[]')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(theirs[0], mine)
+
+    def test_reset_between_documents(self):
+        # Footnotes and link definitions must not leak from one
+        # document into the next
+        first = self.h.markdown('a[^1]\n\n[^1]: one\n\n[x]: http://x/')
+        second = self.h.markdown('b[^1]\n\n[^1]: two\n\n[y][x]')
+        self.assertIn('one', first)
+        self.assertNotIn('one', second)
+        self.assertNotIn('http://x/', second)
+
+    def test_markdown_many(self):
+        contents = ['*a*', '**b**', '\n  `c`  ']
+        self.assertEqual(self.h.markdown_many(contents),
+                         [self.h.markdown(c) for c in contents])
+        self.assertEqual(self.h.markdown_many(contents, extras=[]),
+                         ['<p><em>a</em></p>\n',
+                          '<p><strong>b</strong></p>\n',
+                          '<p><code>c</code></p>\n'])
+
+    def test_extras_with_arguments(self):
+        content = '# Title'
+        self.assertEqual(self.h.markdown(content,
+                                         extras={'header-ids': 'x'}),
+                         '<h1 id="x-title">Title</h1>\n')
+        self.assertEqual(self.h.markdown(content,
+                                         extras={'header-ids': 'y'}),
+                         '<h1 id="y-title">Title</h1>\n')
+
+
 class SwiftTempURLTest(OLXHelpersTestCase):
 
-    def test_swift_tempurl(self):
-        endpoint = 'https://swift.example.com'
-        swift_path = '/v1/AUTH_bd1de33b3eae4287800cfe59f53b6fde'
-        path = '/container/object'
-        key = 'foobar'
-        expiry = datetime(2019, 1, 1)
-        timestamp = int(expiry.strftime('%s'))
+    endpoint = 'https://swift.example.com'
+    swift_path = '/v1/AUTH_bd1de33b3eae4287800cfe59f53b6fde'
+    key = 'foobar'
+    expiry = datetime(2019, 1, 1)
+
+    def setUp(self):
+        super(SwiftTempURLTest, self).setUp()
+        patcher = patch.dict(os.environ,
+                             {'SWIFT_ENDPOINT': self.endpoint,
+                              'SWIFT_PATH': self.swift_path,
+                              'SWIFT_TEMPURL_KEY': self.key})
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
-        expected_tempurl = ''.join([
-            endpoint,
-            generate_temp_url(swift_path + path,
+    def expected_tempurl(self, path):
+        timestamp = int(self.expiry.strftime('%s'))
+        return ''.join([
+            self.endpoint,
+            generate_temp_url(self.swift_path + path,
                               timestamp,
-                              key,
+                              self.key,
                               'GET',
                               absolute=True)
         ])
 
-        with patch.dict(os.environ,
-                        {'SWIFT_ENDPOINT': endpoint,
-                         'SWIFT_PATH': swift_path,
-                         'SWIFT_TEMPURL_KEY': key}):
-            tempurl = self.h.swift_tempurl(path, expiry)
-            self.assertEqual(tempurl, expected_tempurl)
+    def test_swift_tempurl(self):
+        path = '/container/object'
+        tempurl = self.h.swift_tempurl(path, self.expiry)
+        self.assertEqual(tempurl, self.expected_tempurl(path))
+
+    def test_swift_tempurls(self):
+        paths = ['/container/object%d' % i for i in range(5)]
+        self.assertEqual(self.h.swift_tempurls(paths, self.expiry),
+                         [self.expected_tempurl(path) for path in paths])
+
+    def test_invalid_path(self):
+        with self.assertRaises(ValueError):
+            self.h.swift_tempurl('/container', self.expiry)
+
+    def test_signer_memoizes(self):
+        signer = helpers.SwiftTempURLSigner(self.endpoint,
+                                            self.swift_path,
+                                            self.key)
+        path = '/container/object'
+        tempurl = signer.sign(path, self.expiry)
+        with patch.object(signer, 'hmac') as mock_hmac:
+            self.assertEqual(signer.sign(path, self.expiry), tempurl)
+        mock_hmac.copy.assert_not_called()
+
+    def test_signer_reused_while_rendering(self):
+        helpers.render_state.dependencies = set()
+        try:
+            first = helpers.OLXHelpers._swift_signer()
+            with patch.dict(os.environ, {'SWIFT_TEMPURL_KEY': 'other'}):
+                self.assertIs(helpers.OLXHelpers._swift_signer(), first)
+        finally:
+            helpers.render_state.dependencies = None
+            helpers.render_state.swift_signer = None
+
+        # Outside a render, the environment is read every time
+        self.assertIsNot(helpers.OLXHelpers._swift_signer(), first)
@@ -0,0 +1,105 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from olxutils.references import ReferenceIndex
+
+from unittest import TestCase
+
+
+class ReferenceIndexTestCase(TestCase):
+
+    FILES = {
+        'course.xml': '<course url_name="run" org="Foo" course="foo"/>',
+        'course/run.xml': ('<course><chapter url_name="one"/></course>'),
+        'chapter/one.xml': ('<chapter><sequential url_name="seq"/>'
+                            '</chapter>'),
+        'chapter/two.xml': '<chapter/>',
+        'sequential/seq.xml': (
+            '<sequential><vertical url_name="vert">'
+            '<html url_name="text" filename="text"/>'
+            '<problem url_name="quiz"/>'
+            '<video url_name="clip" sub="clip">'
+            '<transcript language="de" src="clip_de.srt"/></video>'
+            '</vertical></sequential>'),
+        'html/text.html': ('<img src="/static/images/figure.png"/>'
+                           '<a href="/static/slides/index.html#2">'),
+        'html/unused.html': '<img src="/static/images/unused.png"/>',
+        'problem/quiz.xml': (
+            '<problem><img src="/asset-v1:Foo+foo+run+type@asset+'
+            'block@images_diagram.svg"/></problem>'),
+        'policies/run/policy.json': ('{"course/run": '
+                                     '{"course_image": "images_logo.png"}}'),
+        'policies/assets.json': '{"images_unused.png": {}}',
+        'about/overview.html': '<img src="/static/images/team.jpg"/>',
+        'static/images/figure.png': 'png',
+        'static/images/diagram.svg': '<image href="../pattern.png"/>',
+        'static/images/logo.png': 'png',
+        'static/images/team.jpg': 'jpg',
+        'static/images/unused.png': 'unused',
+        'static/pattern.png': 'png',
+        'static/subs_clip.srt.sjson': '{}',
+        'static/clip_de.srt': 'srt',
+        'static/slides/index.html': (
+            '<link href="css/slides.css"><script src="//cdn/x.js">'),
+        'static/slides/css/slides.css': 'a { background: url(../bg.png) }',
+        'static/slides/bg.png': 'png',
+        'static/slides/unused.js': 'js',
+        'static/python_lib.zip': 'zip',
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, content in self.FILES.items():
+            path = os.path.join(self.tmpdir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        self.roots = ['course.xml',
+                      'about/overview.html',
+                      'policies/assets.json',
+                      'policies/run/policy.json']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_referenced(self):
+        index = ReferenceIndex(self.tmpdir, self.roots)
+        self.assertEqual(index.referenced, set(self.FILES) - {
+            'chapter/two.xml',
+            'html/unused.html',
+            'static/images/unused.png',
+            'static/slides/unused.js',
+        })
+
+    def test_contains(self):
+        index = ReferenceIndex(self.tmpdir, self.roots)
+        self.assertIn('static/images/figure.png', index)
+        self.assertNotIn('static/images/unused.png', index)
+        self.assertNotIn('chapter/two.xml', index)
+        # Files outside the PRUNED directories are always referenced
+        self.assertIn('markdown/unused.md', index)
+
+    def test_implicit(self):
+        index = ReferenceIndex(self.tmpdir, ['course.xml'])
+        self.assertIn('static/python_lib.zip', index)
+        self.assertNotIn('static/images/logo.png', index)
+
+    def test_symlink(self):
+        os.symlink('figure.png',
+                   os.path.join(self.tmpdir, 'static/images/alias.png'))
+        with open(os.path.join(self.tmpdir, 'html/text.html'), 'w') as f:
+            f.write('<img src="/static/images/alias.png"/>')
+        index = ReferenceIndex(self.tmpdir, self.roots)
+        self.assertIn('static/images/alias.png', index)
+        self.assertIn('static/images/figure.png', index)
+
+    def test_invalid_xml(self):
+        with open(os.path.join(self.tmpdir, 'chapter/one.xml'), 'w') as f:
+            f.write('<chapter>')
+        with self.assertLogs(level='WARNING'):
+            index = ReferenceIndex(self.tmpdir, self.roots)
+        self.assertIn('chapter/one.xml', index)
+        self.assertNotIn('sequential/seq.xml', index)
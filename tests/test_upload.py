@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 
 from olxutils.upload import UploadHelper, UploadHelperException
 
+from io import StringIO
 from tempfile import NamedTemporaryFile, gettempdir
 
 from requests.exceptions import HTTPError
@@ -18,6 +19,11 @@ except ImportError:
     # Python 2
     from urllib import urlencode
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
 from unittest import TestCase
 
 
@@ -176,3 +182,154 @@ class UploadHelperTestCase(TestCase):
                            json={'state': 'Failed'})
             with self.assertRaises(UploadHelperException):
                 helper.upload(wait=True)
+
+
+class UploadWaitTestCase(TestCase):
+
+    FAKE_CMS_URL = 'https://cms.pohgha9thaom4ii7.6t8'
+    COURSE_ID = 'course-v1:example+course+run'
+    TASK_ID = '01c47bac-89a5-41d0-a968-961dce5212f2'
+
+    def setUp(self):
+        self.upload_uri = '%s/api/courses/v0/import/%s/' % (
+            self.FAKE_CMS_URL, self.COURSE_ID)
+
+        # A clock that only moves when we sleep
+        self.now = 0.0
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        for name, mock in (('sleep', sleep),
+                           ('monotonic', lambda: self.now)):
+            p = patch('olxutils.upload.time.%s' % name, mock)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def wait(self, states, **kwargs):
+        archive = NamedTemporaryFile()
+        self.addCleanup(archive.close)
+        helper = UploadHelper(self.FAKE_CMS_URL,
+                              archive.name,
+                              'token',
+                              self.COURSE_ID,
+                              **kwargs)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.upload_uri,
+                           json={'task_id': self.TASK_ID})
+            m.register_uri('GET',
+                           self.upload_uri,
+                           [{'json': {'state': state}} for state in states])
+            return helper.upload(wait=True)
+
+    def test_backoff(self):
+        with self.assertLogs(level='INFO') as logs:
+            result = self.wait(['In Progress'] * 9 + ['Succeeded'],
+                               poll_interval=2,
+                               poll_max_interval=10)
+        # Nothing to print
+        self.assertIsNone(result)
+        self.assertEqual(len(self.sleeps), 9)
+        for sleep, interval in zip(self.sleeps,
+                                   [2, 3, 4.5, 6.75, 10, 10, 10, 10, 10]):
+            self.assertGreaterEqual(sleep, interval * 0.8)
+            self.assertLessEqual(sleep, interval * 1.2)
+        # One line to say so
+        successes = [line for line in logs.output if 'succeeded' in line]
+        self.assertEqual(len(successes), 1)
+        self.assertIn('succeeded after %.1f seconds (10 polls)' % self.now,
+                      successes[0])
+
+    def test_failed(self):
+        with self.assertRaises(UploadHelperException) as e:
+            self.wait(['In Progress', 'Failed'])
+        self.assertIn('(2 polls)', str(e.exception))
+
+    def test_timeout(self):
+        with self.assertRaises(UploadHelperException) as e:
+            self.wait(['In Progress'] * 100, timeout=60)
+        self.assertIn('within 60 seconds', str(e.exception))
+        # One last poll when the time is up
+        self.assertEqual(self.now, 60)
+        self.assertLess(len(self.sleeps), 10)
+
+
+class UploadStreamTestCase(TestCase):
+
+    FAKE_CMS_URL = 'https://cms.pohgha9thaom4ii7.6t8'
+    COURSE_ID = 'course-v1:example+course+run'
+    TASK_ID = '01c47bac-89a5-41d0-a968-961dce5212f2'
+
+    def setUp(self):
+        self.upload_uri = '%s/api/courses/v0/import/%s/' % (
+            self.FAKE_CMS_URL, self.COURSE_ID)
+
+        archive = NamedTemporaryFile()
+        archive.write(b'0123456789')
+        archive.flush()
+        self.addCleanup(archive.close)
+        self.archive = archive.name
+
+        # Read the archive in small chunks, a second apart, and keep
+        # hold of it to see that it's closed.
+        self.opened = []
+
+        def opener(*args):
+            self.opened.append(open(*args))
+            return self.opened[-1]
+
+        self.now = 0.0
+
+        def monotonic():
+            self.now += 1
+            return self.now
+
+        self.stderr = StringIO()
+        for target, mock in (('olxutils.upload.UploadHelper.CHUNKSIZE', 4),
+                             ('olxutils.upload.open', opener),
+                             ('olxutils.upload.time.monotonic', monotonic),
+                             ('sys.stderr', self.stderr)):
+            p = patch(target, mock, create=True)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def upload(self, **kwargs):
+        helper = UploadHelper(self.FAKE_CMS_URL,
+                              self.archive,
+                              'token',
+                              self.COURSE_ID,
+                              **kwargs)
+        self.chunks = []
+
+        def callback(request, context):
+            self.chunks.extend(request.body)
+            return {'task_id': self.TASK_ID}
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.upload_uri, json=callback)
+            self.assertEqual(helper.upload(), self.TASK_ID)
+        return m.last_request
+
+    def test_upload(self):
+        request = self.upload()
+        body = b''.join(self.chunks)
+        self.assertIn(b'\r\n\r\n0123456789\r\n--', body)
+        self.assertEqual([len(chunk) for chunk in self.chunks[1:-1]],
+                         [4, 4, 2])
+        # Sent in one piece of a known size, rather than in chunks
+        self.assertEqual(int(request.headers['Content-Length']), len(body))
+        self.assertNotIn('Transfer-Encoding', request.headers)
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(self.stderr.getvalue(), '')
+
+    def test_progress(self):
+        self.upload(progress_interval=2)
+        lines = self.stderr.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Uploaded 0.0 of 0.0 MB of %s (80%%)' % self.archive,
+                      lines[0])
+        self.assertIn('(100%)', lines[1])
+        self.assertTrue(lines[1].endswith(' MB/s'))
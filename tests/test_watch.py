@@ -0,0 +1,60 @@
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from olxutils.watch import InotifyWatcher, PollingWatcher
+
+from unittest import TestCase, SkipTest
+
+
+class PollingWatcherTestCase(TestCase):
+
+    def create_watcher(self, exclude=None):
+        return PollingWatcher(self.tmpdir, exclude, interval=0.01)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        os.makedirs(os.path.join(self.tmpdir, 'html'))
+        os.makedirs(os.path.join(self.tmpdir, 'build'))
+        self.write('html/foo.html', 'foo')
+
+    def write(self, filename, content):
+        with open(os.path.join(self.tmpdir, filename), 'a') as f:
+            f.write(content)
+
+    def test_unchanged(self):
+        watcher = self.create_watcher()
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.wait(timeout=0.2), set())
+
+    def test_changed(self):
+        watcher = self.create_watcher(exclude=['build'])
+        self.addCleanup(watcher.close)
+        self.write('html/foo.html', 'bar')
+        self.write('build/foo.html', 'bar')
+        self.assertEqual(watcher.wait(timeout=5), set(['html/foo.html']))
+
+    def test_created_and_deleted(self):
+        watcher = self.create_watcher()
+        self.addCleanup(watcher.close)
+        os.unlink(os.path.join(self.tmpdir, 'html', 'foo.html'))
+        os.makedirs(os.path.join(self.tmpdir, 'static', 'images'))
+        self.write('static/images/foo.png', 'foo')
+        changed = set()
+        # A watcher may report these in more than one go.
+        while changed != set(['html/foo.html', 'static/images/foo.png']):
+            new = watcher.wait(timeout=5)
+            self.assertTrue(new)
+            changed.update(new)
+
+
+class InotifyWatcherTestCase(PollingWatcherTestCase):
+
+    def create_watcher(self, exclude=None):
+        try:
+            return InotifyWatcher(self.tmpdir, exclude)
+        except OSError as e:
+            raise SkipTest("inotify is not available: %s" % e)